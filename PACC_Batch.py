@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Batch.py
+
+Runs PACC_PeakFinder over many (prep, NS, channel) jobs at once. Jobs either
+come from a manifest CSV with the columns prep_id, ns_id and channel (green or
+red), or are discovered from every dirCCPs/*/Images/Cropped/NS_* directory
+that holds *.JN0.tif or *.JN1.tif images.
+
+The images of all jobs are spread over a process pool. Results come back in
+job order and, within a job, in sorted image order, so the output workbooks
+are the same no matter how many processes are used. An image that fails
+(e.g. a truncated TIFF) is logged and left out of its workbook; a job that
+fails (e.g. missing metadata) is logged and the batch moves on.
+
+Each job is saved to dirCCPs/<prep>/Analysis/<timestamp>/<NS>.<chExt>/ (as an
+Excel workbook, or as Parquet files with --output parquet) and a summary of
+all jobs is written to dirCCPs/PACC_Batch.<timestamp>.csv. QC figures are drawn by a
+separate pool of processes (see PACC_Figures.py). Every job directory also
+gets the job's telemetry (see PACC_Telemetry.py); set PACC_PROFILE to
+profile the batch process.
+
+Usage:
+    python PACC_Batch.py --ccps /path/to/CCPs/ [--manifest jobs.csv]
+                         [--processes 32] [--output parquet]
+                         [--figures all|preview|flagged|none]
+"""
+#LIBRARIES
+import os
+import glob
+import argparse
+import traceback
+import multiprocessing
+import pandas
+
+import PACC_PeakFinder as pf
+from PACC_Figures import FigureRenderer
+from PACC_Output import TeeOutput
+from PACC_Telemetry import Telemetry
+
+#Columns of the batch summary
+colsSummary = ['prep_id','ns_id','channel','status','images','failed_images',
+               'bytes_read','path','error']
+
+
+def read_manifest(fnManifest):
+    """Returns the (prepID, nsID, channel) jobs listed in a manifest CSV."""
+    dfJobs = pf.clean_columns(pandas.read_csv(fnManifest))
+    jobs = []
+    for row in dfJobs.itertuples(index=False):
+        channel = str(row.channel).strip().lower()
+        if channel not in pf.CHANNELS:
+            raise ValueError("Unknown channel '"+str(row.channel)+"' in "+
+                             fnManifest+"; use one of "+
+                             ', '.join(sorted(pf.CHANNELS)))
+        jobs.append((str(row.prep_id).strip(), str(row.ns_id).strip(),
+                     channel))
+    return jobs
+
+
+def discover_jobs(dirCCPs):
+    """Finds every NS directory (and channel) with images under dirCCPs."""
+    jobs = []
+    for dirNS in sorted(glob.glob(dirCCPs+'*/Images/Cropped/NS_*/')):
+        nsID = os.path.basename(os.path.normpath(dirNS))
+        prepID = dirNS[len(dirCCPs):].split('/')[0]
+        for channel in sorted(pf.CHANNELS):
+            chExt = pf.CHANNELS[channel][1]
+            if glob.glob(dirNS+'*.'+chExt+'.tif'):
+                jobs.append((prepID, nsID, channel))
+    return jobs
+
+
+def _analyze_task(task):
+    """Pool entry point: analyzes a chunk of images and never raises."""
+    iJob, chunk, nsParams, hashImages = task
+    try:
+        return iJob, pf.analyze_images(chunk, nsParams, hashImages)
+    except Exception:
+        err = traceback.format_exc()
+        return iJob, [(x, None, err) for x, md in chunk]
+
+
+def run_batch(dirCCPs, jobs, processes=None, chunksize=16, rdmeNote=None,
+              outputFormat='excel', excelSummary=True, figureMode='all',
+              figureProcesses=None, cache=None, store=None,
+              compactData=None):
+    """Analyzes all jobs and returns the batch summary dataframe (also saved
+    to dirCCPs/PACC_Batch.<timestamp>.csv).
+
+    processes defaults to the number of CPUs. With processes=1 the images are
+    analyzed in this process, which is handy for debugging. chunksize is the
+    number of images of a job that a worker profiles together. outputFormat,
+    excelSummary and compactData are passed to PACC_PeakFinder.open_output;
+    figureMode and figureProcesses to PACC_Figures.FigureRenderer. With a
+    ResultCache only new or changed images are sent to the workers. With a
+    PACC_Store.ResultStore every job is also added to the results store.
+    The results of every job go through PACC_PeakFinder.run_analysis, one
+    chunk at a time.
+    """
+    today, now, timestamp = pf.get_timestamp()
+    if rdmeNote is None:
+        rdmeNote = ["Batch analysis"]
+
+    # *** PREPARE EVERY JOB BEFORE STARTING THE POOL ***
+    summary = []
+    prepared = {}
+    tasks = []
+    chunks = []                                                                # (chunk, cache keys) of every task
+    for iJob, (prepID, nsID, channel) in enumerate(jobs):
+        CH, chExt = pf.CHANNELS[channel]
+        pathRes = (dirCCPs+prepID+"/Analysis/"+timestamp+'/'+nsID+'.'+chExt+
+                   '/')
+        summary.append({'prep_id': prepID, 'ns_id': nsID, 'channel': channel,
+                        'status': 'failed', 'images': 0, 'failed_images': 0,
+                        'bytes_read': 0,
+                        'path': pathRes, 'error': ''})
+        telemetry = Telemetry(profile=[])                                      # Per job stage times (PACC_PROFILE covers the whole batch)
+        try:
+            with telemetry.stage('prepare'):
+                nsParams, nsTasks, dfExclusions, dfPixInd = \
+                    pf.prepare_neurite_set(dirCCPs, prepID, nsID, CH, chExt,
+                                           pathRes, timestamp)
+            if not os.path.isdir(pathRes):
+                os.makedirs(pathRes)
+            pf.write_readme(pathRes, prepID, timestamp,
+                            rdmeNote+["\n"+nsID+" "+channel+" channel"])
+        except Exception as e:
+            print("Error. Job "+prepID+" "+nsID+" "+channel+" could not be"
+                  " prepared & will not be analyzed: "+repr(e))
+            summary[iJob]['error'] = repr(e)
+            continue
+        fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+chExt+'.'+timestamp
+        try:
+            output = pf.open_output(pathRes, fnRes, outputFormat, excelSummary,
+                                    compactData=compactData)
+            if store is not None:
+                output = TeeOutput([output, store.open_run(
+                    prepID, nsID, [channel], timestamp, pathRes)])
+        except Exception as e:
+            print("Error. Output for "+prepID+" "+nsID+" could not be"
+                  " opened: "+repr(e))
+            summary[iJob]['error'] = repr(e)
+            continue
+        prepared[iJob] = [nsParams, dfExclusions, dfPixInd, len(nsTasks),
+                          output, telemetry]
+        summary[iJob]['images'] = len(nsTasks)
+        for i in range(0, len(nsTasks), chunksize):
+            chunk = nsTasks[i:i+chunksize]
+            if cache is None:
+                keys = [None]*len(chunk)
+            else:
+                keys = pf.plan_cached(chunk, nsParams, cache)
+            misses = [t for t, key in zip(chunk, keys) if key is None]
+            tasks.append((iJob, misses, nsParams, cache is not None))
+            chunks.append((chunk, keys))
+
+    # *** ANALYZE ALL IMAGES, WRITING EACH JOB AS SOON AS IT IS COMPLETE ***
+    renderer = FigureRenderer(figureMode, figureProcesses,                     # QC figures are drawn by their own pool
+                              analysisProcesses=processes, cache=cache)
+    if processes == 1:
+        pool = None
+        resIter = (_analyze_task(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        resIter = pool.imap(_analyze_task, tasks)                              # imap keeps results in task order
+
+    def finish(iJob):
+        (nsParams, dfExclusions, dfPixInd, nIms, output,
+         telemetry) = prepared.pop(iJob)
+        prepID, nsID = nsParams['prepID'], nsParams['nsID']
+        summary[iJob]['bytes_read'] = telemetry.counters['bytes_read']
+        summary[iJob]['failed_images'] = telemetry.counters['failed_images']
+        try:
+            with telemetry.stage('write'):
+                pf.write_results(output, dfExclusions, dfPixInd, today, now,
+                                 nsParams['muperpx'], telemetry)
+            telemetry.write(nsParams['pathRes'], prepID, timestamp)
+            summary[iJob]['status'] = 'ok'
+        except Exception as e:
+            print("Error. Results for "+prepID+" "+nsID+" could not be"
+                  " written: "+repr(e))
+            summary[iJob]['error'] = repr(e)
+
+    try:
+        for iJob in [i for i in sorted(prepared) if prepared[i][3] == 0]:
+            finish(iJob)                                                       # Jobs without images still get a workbook
+        for (chunk, keys), (iJob, chunkRes) in zip(chunks, resIter):
+            job = prepared[iJob]
+            nsParams, telemetry = job[0], job[5]
+            if cache is not None:
+                with telemetry.stage('analyze'):                               # Only cache work; workers time their own stages
+                    chunkRes = pf.merge_cached(chunk, keys, chunkRes, nsParams,
+                                               cache)
+            pf.run_analysis([pf.channel_batch(chunkRes, jobs[iJob][2])],
+                            {jobs[iJob][2]: nsParams}, job[4], renderer,
+                            telemetry)
+            job[3] -= len(chunkRes)
+            if job[3] == 0:
+                finish(iJob)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        renderer.close()
+    for x, reasons in renderer.flagged:
+        print("Flagged "+x+": "+', '.join(reasons))
+
+    dfSummary = pandas.DataFrame(summary, columns=colsSummary)
+    fnSummary = dirCCPs+'PACC_Batch.'+timestamp+'.csv'                         # Next to the prep directories (and their Analysis/)
+    dfSummary.to_csv(fnSummary, index=False)
+    print("Batch summary saved to "+fnSummary)
+    return dfSummary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch PACC peak finding.')
+    pf.add_run_arguments(parser, note='Batch analysis')
+    parser.add_argument('--manifest',
+                        help='CSV with prep_id, ns_id and channel columns; '
+                             'jobs are discovered under --ccps if omitted')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='images a worker profiles together')
+    args = parser.parse_args()
+
+    dirCCPs, cache, store = pf.open_resources(args)
+    if args.manifest:
+        jobs = read_manifest(args.manifest)
+    else:
+        jobs = discover_jobs(dirCCPs)
+    print("Analyzing "+str(len(jobs))+" job(s)")
+    profiler = Telemetry()                                                     # PACC_PROFILE=cprofile,tracemalloc profiles this process
+    profiler.start()
+    try:
+        dfSummary = run_batch(dirCCPs, jobs, args.processes, args.chunksize,
+                              [args.note], args.output,
+                              not args.no_excel_summary, args.figures,
+                              args.figure_processes, cache, store,
+                              not args.full_data)
+    finally:
+        pf.close_resources(cache, store)
+    profiler.stop('', 'PACC_Batch', pf.get_timestamp()[2])
+    print(dfSummary.to_string(index=False))
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Bench.py
+
+Benchmark suite for PACC_PeakFinder on synthetic neurite sets (see
+PACC_Synth.py). One neurite set with as many images as the largest size is
+generated (or reused if it was made with the same settings) and the first N
+images are analyzed for every size N. The pipeline is run stage by stage in
+this process so that each stage is timed on its own:
+
+    load        read_channel (only the sampled rows)
+    profile     batch_profiles
+    threshold   batch_thresholds
+    find_peaks  scipy find_peaks calls made by image_result
+    tables      the rest of image_result and building the Data, Peaks, IPDs
+                and Analysis dataframes of each batch (ResultTables)
+    figures     QC figures of the first --figures images (drawn in this
+                process)
+    output      adding every result to the output backend & closing it
+
+Because the puncta positions are known, each size also gets the detection
+recall and precision: a found peak is a true positive if it can be paired
+with a not yet paired punctum within --tol um (closest pairs first).
+
+The stage timings (PACC_Bench.<timestamp>.csv) and the accuracy
+(PACC_Bench.<timestamp>.accuracy.csv) are written to the benchmark
+directory.
+
+Usage:
+    python PACC_Bench.py [--dir ./PACC_Bench/] [--sizes 10 100 1000]
+                         [--muperpx 0.126] [--snr 5] [--figures 20]
+"""
+#LIBRARIES
+import os
+import timeit
+import argparse
+import numpy as np
+import pandas
+
+import PACC_PeakFinder as pf
+import PACC_Synth as synth
+from PACC_Figures import FigureRenderer
+from PACC_ImageIO import read_channel
+from PACC_Profiles import batch_profiles, batch_thresholds
+from PACC_Records import ResultTables
+
+clock = timeit.default_timer
+
+#Dataset sizes (images) benchmarked by default
+benchSizes = [10, 100, 1000, 10000, 50000]
+
+#Stages in the order they run
+benchStages = ['load','profile','threshold','find_peaks','tables','figures',
+               'output']
+
+#Columns of the timing and accuracy tables
+colsBench = ['images','stage','stage_images','seconds','ms_per_image']
+colsAccuracy = ['images','puncta','peaks_found','true_positives','recall',
+                'precision']
+
+
+def match_peaks(truth, found, tol):
+    """Returns the number of found peaks paired with a true punctum.
+
+    Pairs closer than tol are made closest first; every punctum and every
+    found peak is used at most once.
+    """
+    truth = np.sort(np.asarray(truth, dtype=float))
+    found = np.sort(np.asarray(found, dtype=float))
+    lo = np.searchsorted(found, truth-tol, 'left')
+    hi = np.searchsorted(found, truth+tol, 'right')
+    pairs = sorted((abs(found[j]-t), i, j) for i, t in enumerate(truth)
+                   for j in range(lo[i], hi[i]))
+    usedT, usedF = set(), set()
+    for d, i, j in pairs:
+        if i not in usedT and j not in usedF:
+            usedT.add(i)
+            usedF.add(j)
+    return len(usedT)
+
+
+class _Timed(object):
+    """Wraps a function and adds the time spent in it to times[stage]."""
+
+    def __init__(self, fn, times, stage):
+        self.fn, self.times, self.stage = fn, times, stage
+
+    def __call__(self, *args, **kwargs):
+        t0 = clock()
+        try:
+            return self.fn(*args, **kwargs)
+        finally:
+            self.times[self.stage] += clock()-t0
+
+
+def ensure_neurite_set(dirBench, prepID, nsID, nImages, channel, seed,
+                       params):
+    """Generates the synthetic NS unless a large enough one already exists."""
+    prm = dict(synth.synthParams)
+    prm.update(params)
+    old = synth.synth_settings(dirBench, prepID, nsID)
+    # JSON turns tuples into lists
+    want = json_params(prm)
+    if (old is not None and old['nImages'] >= nImages and
+            channel in old['channels'] and old['seed'] == seed and
+            json_params(old['params']) == want):
+        return 0.
+    print("Generating "+str(nImages)+" synthetic images...")
+    t0 = clock()
+    synth.make_neurite_set(dirBench, prepID, nsID, nImages, (channel,), seed,
+                           **params)
+    return clock()-t0
+
+
+def json_params(params):
+    return dict((k, list(v) if isinstance(v, (list, tuple)) else v)
+                for k, v in params.items())
+
+
+def bench_neurite_set(dirBench, prepID, nsID, nImages, channel='green',
+                      batchSize=pf.batchSize, figureSample=20,
+                      outputFormat='excel', tol=0.5, dfTruth=None):
+    """Runs the pipeline on the first nImages images of a synthetic NS.
+
+    Returns (dfTimes, accuracy) with one colsBench row per stage and a dict
+    of colsAccuracy values.
+    """
+    today, now, timestamp = pf.get_timestamp()
+    CH, chExt = pf.CHANNELS[channel]
+    pathRes = (dirBench+prepID+"/Analysis/"+timestamp+'.'+str(nImages)+
+               '/')
+    nsParams, tasks, dfExclusions, dfPixInd = pf.prepare_neurite_set(
+            dirBench, prepID, nsID, CH, chExt, pathRes, timestamp)
+    tasks = tasks[:nImages]
+    if not os.path.isdir(pathRes):
+        os.makedirs(pathRes)
+    pxN, pxB = nsParams['pxN'], nsParams['pxB']
+    rows = [(pxB[0], pxB[1]), (pxN[0], pxN[1]), (pxB[2], pxB[3])]
+
+    times = dict((s, 0.) for s in benchStages)
+    counts = dict((s, len(tasks)) for s in benchStages)
+    counts['figures'] = 0
+    fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+chExt+'.'+timestamp
+    output = pf.open_output(pathRes, fnRes, outputFormat, excelSummary=False)
+    renderer = FigureRenderer('all' if figureSample else 'none', processes=0)
+    found = {}
+    pf.find_peaks(np.zeros(3))                                                 # Import scipy before timing
+    findPeaks = pf.find_peaks
+    pf.find_peaks = _Timed(findPeaks, times, 'find_peaks')
+    try:
+        for b in range(0, len(tasks), batchSize):
+            batch = tasks[b:b+batchSize]
+            t0 = clock()
+            imgs = [read_channel(nsParams['dirNS']+x, CH, rows)[0]
+                    for x, md in batch]
+            t1 = clock()
+            prof = batch_profiles(imgs, pxN, pxB)
+            t2 = clock()
+            th = batch_thresholds(prof['nf'], nsParams['peakParams']['heightSD'])
+            t3 = clock()
+            tables = ResultTables(pf.tablesResults, pf.colsImage,
+                                  pf.compact_tables(pf.tablesResults))
+            results = []
+            for j, (x, md) in enumerate(batch):
+                res = pf.image_result(x, md, imgs[j], prof, th, j, nsParams)
+                res['io'] = {'bytes_read': 0, 'read_method': 'bench'}
+                tables.add(res)
+                results.append(res)
+            tables.build()
+            t4 = clock()
+            times['load'] += t1-t0
+            times['profile'] += t2-t1
+            times['threshold'] += t3-t2
+            times['tables'] += t4-t3                                           # find_peaks is taken out below
+            del imgs, prof, th, tables
+
+            for res in results:
+                found[res['meta']['image_id']] = res['Peaks']['distance']
+                if counts['figures'] < figureSample:
+                    t0 = clock()
+                    renderer.submit(res, nsParams)
+                    times['figures'] += clock()-t0
+                    counts['figures'] += 1
+                t0 = clock()
+                output.add(res)
+                times['output'] += clock()-t0
+        t0 = clock()
+        pf.write_results(output, dfExclusions, dfPixInd, today, now,
+                         nsParams['muperpx'])
+        times['output'] += clock()-t0
+    finally:
+        pf.find_peaks = findPeaks
+        renderer.close()
+    times['tables'] -= times['find_peaks']
+
+    dfTimes = pandas.DataFrame({'images': len(tasks), 'stage': benchStages,
+                                'stage_images': [counts[s] for s in
+                                                 benchStages],
+                                'seconds': [times[s] for s in benchStages]},
+                               columns=colsBench)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dfTimes['ms_per_image'] = (1000*dfTimes['seconds']/
+                                   dfTimes['stage_images'].replace(0, np.nan))
+
+    # *** DETECTION ACCURACY ***
+    if dfTruth is None:
+        dfTruth = synth.load_truth(dirBench, prepID, nsID)
+    truth = dict((x, df['position'].values) for x, df in
+                 dfTruth[dfTruth['channel'] == channel].groupby('image_id'))
+    nTruth = nFound = nTP = 0
+    for x in found:
+        t = truth.get(x, np.array([]))
+        nTruth += len(t)
+        nFound += len(found[x])
+        nTP += match_peaks(t, found[x], tol)
+    accuracy = {'images': len(tasks), 'puncta': nTruth, 'peaks_found': nFound,
+                'true_positives': nTP,
+                'recall': nTP/float(nTruth) if nTruth else np.nan,
+                'precision': nTP/float(nFound) if nFound else np.nan}
+    return dfTimes, accuracy
+
+
+def run_bench(dirBench, sizes=benchSizes, channel='green', seed=0,
+              batchSize=pf.batchSize, figureSample=20, outputFormat='excel',
+              tol=0.5, **params):
+    """Benchmarks every size; returns (dfTimes, dfAccuracy).
+
+    params are passed to PACC_Synth.make_neurite_set.
+    """
+    prepID, nsID = 'SYN_001', 'NS_01.01'
+    today, now, timestamp = pf.get_timestamp()
+    sizes = sorted(sizes)
+    tGen = ensure_neurite_set(dirBench, prepID, nsID, sizes[-1], channel,
+                              seed, params)
+    if tGen:
+        print("Generated in "+str(round(tGen, 1))+" s")
+    dfTruth = synth.load_truth(dirBench, prepID, nsID)
+    times = []
+    accuracy = []
+    for n in sizes:
+        print("Benchmarking "+str(n)+" images...")
+        dfTimes, acc = bench_neurite_set(dirBench, prepID, nsID, n, channel,
+                                         batchSize, figureSample,
+                                         outputFormat, tol, dfTruth)
+        times.append(dfTimes)
+        accuracy.append(acc)
+    dfTimes = pandas.concat(times, ignore_index=True)
+    dfAccuracy = pandas.DataFrame(accuracy, columns=colsAccuracy)
+    dfTimes.to_csv(dirBench+'PACC_Bench.'+timestamp+'.csv', index=False)
+    dfAccuracy.to_csv(dirBench+'PACC_Bench.'+timestamp+'.accuracy.csv',
+                      index=False)
+    return dfTimes, dfAccuracy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark PACC peak '
+                                     'finding on synthetic neurites.')
+    parser.add_argument('--dir', default='PACC_Bench/',
+                        help='directory for the synthetic data & reports')
+    parser.add_argument('--sizes', type=int, nargs='+', default=benchSizes,
+                        help='numbers of images to benchmark')
+    parser.add_argument('--channel', choices=sorted(pf.CHANNELS),
+                        default='green')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--length', type=float, nargs=2,
+                        default=synth.synthParams['lengthUm'],
+                        help='min & max neurite length (um)')
+    parser.add_argument('--line-width', type=int,
+                        default=synth.synthParams['lineWidth'],
+                        help='image height (pixels)')
+    parser.add_argument('--muperpx', type=float, choices=[0.126, 0.252],
+                        default=synth.synthParams['muperpx'])
+    parser.add_argument('--density', type=float,
+                        default=synth.synthParams['density'],
+                        help='mean puncta per micron')
+    parser.add_argument('--width', type=float, nargs=2,
+                        default=synth.synthParams['widthUm'],
+                        help='min & max punctum FWHM (um)')
+    parser.add_argument('--min-spacing', type=float,
+                        default=synth.synthParams['minSpacingUm'],
+                        help='smallest distance between puncta (um)')
+    parser.add_argument('--snr', type=float, default=synth.synthParams['snr'],
+                        help='punctum amplitude / pixel noise std')
+    parser.add_argument('--noise', type=float,
+                        default=synth.synthParams['noise'],
+                        help='pixel noise std')
+    parser.add_argument('--background', type=float,
+                        default=synth.synthParams['background'])
+    parser.add_argument('--shaft', type=float,
+                        default=synth.synthParams['shaft'],
+                        help='neurite shaft intensity above background')
+    parser.add_argument('--batch-size', type=int, default=pf.batchSize,
+                        help='images profiled together')
+    parser.add_argument('--figures', type=int, default=20,
+                        help='number of QC figures to draw & time')
+    parser.add_argument('--output', choices=['excel', 'parquet'],
+                        default='parquet',
+                        help='output backend to time (Excel is limited to '
+                             '1,048,576 Data rows)')
+    parser.add_argument('--tol', type=float, default=0.5,
+                        help='max distance (um) of a true positive')
+    args = parser.parse_args()
+
+    dfTimes, dfAccuracy = run_bench(
+        os.path.join(args.dir, ''), args.sizes, args.channel, args.seed,
+        args.batch_size, args.figures, args.output, args.tol,
+        lengthUm=tuple(args.length), lineWidth=args.line_width,
+        muperpx=args.muperpx, density=args.density, widthUm=tuple(args.width),
+        minSpacingUm=args.min_spacing, snr=args.snr, noise=args.noise,
+        background=args.background, shaft=args.shaft)
+    print(dfTimes.to_string(index=False))
+    print(dfAccuracy.to_string(index=False))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Cache.py
+
+Persistent on-disk cache of per-image results for incremental re-analysis.
+
+An entry is keyed by the SHA-1 of the pixels the analysis uses (the sampled
+row bands of the image's color channel) together with everything else that
+changes the numbers: the color channel, muperpx, line_width, the sampled
+pixel rows, the peak finding parameters, tiledLength (tiled & full-array
+peak widths differ in the last bits) and CACHE_VERSION (bump it whenever
+the analysis code changes its output). Retracing an image in
+PACC_NeuTrace.ijm changes its pixels and therefore its key, so only new or
+changed images are analyzed again.
+
+The pixels are hashed as they are read for the analysis (see
+pixels_sha1), so hashing costs no extra I/O. To find the entry of an image
+without reading it, the cache keeps a small index of (size, mtime) -> hash
+per image path and sampled view (channel & rows). Files whose size and
+mtime have not changed are not read at all. An index entry also records the
+result key it was last stored for and is dropped when that result is
+evicted, so the index does not outgrow the cache.
+
+Entries are pickled into <dirCache>/<key[:2]>/<key>.pkl. Files derived
+from a result, e.g. its QC figure, are kept as <key[:2]>/<file key>.png
+(see file_key) so that a re-run can link or copy them instead of drawing
+them again. Reading an entry marks it as recently used; when the cache
+grows past maxBytes the least recently used entries (results and files
+alike) are deleted.
+"""
+#LIBRARIES
+import os
+import errno
+import pickle
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 2                                                              # Bump when cached results would change
+
+
+def pixels_sha1(img, rows):
+    """Returns the SHA-1 hex digest of the row bands of an image array.
+
+    rows is the list of (start, end) bands that were read (see
+    PACC_ImageIO.read_channel); the image shape and dtype are part of the
+    digest.
+    """
+    h = hashlib.sha1(repr((img.shape, img.dtype.str)).encode('utf-8'))
+    for r0, r1 in rows:
+        h.update(np.ascontiguousarray(img[r0:r1]).data)
+    return h.hexdigest()
+
+
+def stat_signature(path):
+    """Returns the (size, mtime in ns) of a file."""
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+class ResultCache(object):
+    """Size-bounded, content-addressed store of per-image results."""
+
+    fnIndex = 'stat_index.pkl'
+    extensions = ('.pkl', '.png')                                              # Entry files (results & derived files)
+
+    def __init__(self, dirCache, maxBytes=5*2**30):
+        self.dirCache = os.path.join(dirCache, '')
+        self.maxBytes = maxBytes
+        if not os.path.isdir(self.dirCache):
+            os.makedirs(self.dirCache)
+        self.statIndex = {}
+        try:
+            with open(self.dirCache+self.fnIndex, 'rb') as f:
+                self.statIndex = dict((k, v) for k, v in
+                                      pickle.load(f).items() if len(v) == 3)   # Older entries have no result key
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass                                                               # A missing or broken index only costs re-hashing
+        self.totalBytes = sum(size for path, mtime, size in self._entries())
+        self.hits = 0
+        self.misses = 0
+
+    # *** CONTENT HASHES ***
+    def known_hash(self, path, view):
+        """Returns the stored hash of an unchanged file, else None.
+
+        view identifies the pixels that were hashed (e.g. the channel and
+        row bands).
+        """
+        entry = self.statIndex.get((os.path.abspath(path), view))
+        if entry is None:
+            return None
+        try:
+            if stat_signature(path) != entry[0]:
+                return None
+        except OSError:
+            return None
+        return entry[1]
+
+    def remember_hash(self, path, view, contentHash, sig, key):
+        """Stores the hash of a file's pixels with the file's stat_signature
+        at reading time and the key of its cached result."""
+        self.statIndex[(os.path.abspath(path), view)] = (sig, contentHash, key)
+
+    def _forget(self, keys):
+        """Drops the index entries of evicted results."""
+        if keys:
+            self.statIndex = dict((k, v) for k, v in self.statIndex.items()
+                                  if v[2] not in keys)
+
+    def key(self, contentHash, params):
+        """Returns the cache key for an image hash and analysis parameters.
+
+        params must have a stable repr (e.g. a sorted list of pairs).
+        """
+        return hashlib.sha1(repr((CACHE_VERSION, contentHash, params))
+                            .encode('utf-8')).hexdigest()
+
+    def file_key(self, key, *parts):
+        """Returns the key of a file derived from the result with key, e.g.
+        its QC figure for an image name and dpi."""
+        return hashlib.sha1(repr((key,)+parts).encode('utf-8')).hexdigest()
+
+    # *** ENTRIES ***
+    def _path(self, key, ext='.pkl'):
+        return self.dirCache+key[:2]+'/'+key+ext
+
+    def _make_dir(self, path):
+        dirEntry = os.path.dirname(path)
+        if not os.path.isdir(dirEntry):
+            try:
+                os.makedirs(dirEntry)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return dirEntry
+
+    def has(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Returns the cached result for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                res = pickle.load(f)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except Exception:
+            self._remove(path)                                                 # Unreadable entries are dropped
+            self._forget(set([key]))
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)                                               # Mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return res
+
+    def put(self, key, res):
+        """Stores a result; evicts old entries if the cache is too big."""
+        path = self._path(key)
+        dirEntry = self._make_dir(path)
+        # Write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=dirEntry, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(res, f, protocol=2)
+        os.rename(tmp, path)
+        self._added(path)
+
+    def _added(self, path):
+        self.totalBytes += os.path.getsize(path)
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def get_file(self, fileKey, dest, ext='.png'):
+        """Hard-links (or copies) a cached file to dest; returns False if it
+        is not in the cache."""
+        path = self._path(fileKey, ext)
+        try:
+            try:
+                os.link(path, dest)
+            except OSError:
+                if not os.path.exists(path):
+                    return False
+                shutil.copyfile(path, dest)                                    # dest exists or is on another file system
+            os.utime(path, None)                                               # Mark as recently used
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put_file(self, fileKey, src, ext='.png'):
+        """Stores a file derived from a result (hard-linked if possible)."""
+        path = self._path(fileKey, ext)
+        if os.path.exists(path):
+            return
+        dirEntry = self._make_dir(path)
+        try:
+            os.link(src, path)
+        except OSError:
+            fd, tmp = tempfile.mkstemp(dir=dirEntry, suffix='.tmp')
+            os.close(fd)
+            shutil.copyfile(src, tmp)
+            os.rename(tmp, path)
+        self._added(path)
+
+    def _entries(self):
+        """Yields (path, mtime, size) for every cache entry."""
+        for name in os.listdir(self.dirCache):
+            dirEntry = self.dirCache+name
+            if len(name) != 2 or not os.path.isdir(dirEntry):
+                continue
+            for fn in os.listdir(dirEntry):
+                if fn.endswith(self.extensions):
+                    try:
+                        st = os.stat(dirEntry+'/'+fn)
+                    except OSError:
+                        continue
+                    yield dirEntry+'/'+fn, st.st_mtime, st.st_size
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.totalBytes -= size
+        except OSError:
+            pass
+
+    def evict(self, targetBytes=None):
+        """Deletes least recently used entries until the cache fits.
+
+        targetBytes defaults to 90% of maxBytes so that eviction does not run
+        again for every new entry.
+        """
+        if targetBytes is None:
+            targetBytes = int(0.9*self.maxBytes)
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.totalBytes = sum(e[2] for e in entries)
+        evicted = set()
+        for path, mtime, size in entries:
+            if self.totalBytes <= targetBytes:
+                break
+            self._remove(path)
+            if path.endswith('.pkl'):
+                evicted.add(os.path.basename(path)[:-4])
+        self._forget(evicted)
+
+    def close(self):
+        """Saves the (size, mtime) -> hash index."""
+        fd, tmp = tempfile.mkstemp(dir=self.dirCache, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self.statIndex, f, protocol=2)
+        os.rename(tmp, self.dirCache+self.fnIndex)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Channels.py
+
+Multi-channel analysis of a neurite set in a single pass. PACC_NeuTrace.ijm
+saves the straightened images of every color channel of a neurite next to
+each other (<image>.C<i>.JN0.tif for green, <image>.C<i>.JN1.tif for red).
+analyze_channels() pairs these files by their <image>.C<i> name, analyzes
+the images of all requested channels batch by batch (every file is read
+once, and only its own color plane & sampled rows) and writes one output
+for the NS instead of one unrelated workbook per channel.
+
+Every channel gets its own Data, Peaks, IPDs and Analysis sheets, named
+'<sheet>.<channel>' (e.g. 'Peaks.green'). With two channels the puncta of
+each image pair are also matched:
+
+Colocalization
+    One row per punctum: the position (um) & max intensity of the punctum
+    in each channel, their separation and whether it was colocalized. Two
+    puncta are colocalized when each is the other's nearest punctum in the
+    other channel and they are at most colocDistance um apart (nearest
+    neighbors are found with a binary search over the sorted positions).
+    Unmatched puncta have NaN for the other channel.
+Colocalization.Analysis
+    One row per image pair: the number of puncta in each channel, the
+    number colocalized, the fraction of each channel's puncta that was
+    colocalized and the mean separation of the colocalized puncta.
+
+The image_id of both colocalization tables is the <image>.C<i> name shared by
+the channel files. Images without a partner in the other channel are still
+analyzed, they just don't appear in the colocalization tables.
+"""
+#LIBRARIES
+import os
+import numpy as np
+
+import PACC_PeakFinder as pf
+from PACC_Figures import FigureRenderer
+from PACC_Output import TeeOutput
+from PACC_Telemetry import Telemetry
+
+#Default distance (um) below which puncta of two channels are colocalized
+colocDistance = 0.5
+
+
+def channel_tables(channels):
+    """Returns the (sheet, columns) of the per-channel & colocalization tables."""
+    tables = [(name+'.'+channel, cols) for channel in channels
+              for name, cols in pf.tablesResults]
+    if len(channels) == 2:
+        tables += [('Colocalization', cols_coloc(*channels)),
+                   ('Colocalization.Analysis', cols_coloc_analysis(*channels))]
+    return tables
+
+
+def cols_coloc(chA, chB):
+    return pf.colsImage+[chA+'_distance', chB+'_distance', 'separation',
+                         chA+'_max_intensity', chB+'_max_intensity',
+                         'colocalized']
+
+
+def cols_coloc_analysis(chA, chB):
+    return pf.colsImage+[chA+'_peaks', chB+'_peaks', 'colocalized_puncta',
+                         chA+'_fraction_colocalized',
+                         chB+'_fraction_colocalized', 'mean_separation']
+
+
+def pair_key(x):
+    """Returns the name shared by all channel files of an image.
+
+    e.g. 'CCP_127_NS_02.01_im00.C0.JN0.tif' -> 'CCP_127_NS_02.01_im00.C0'
+    """
+    return x.rsplit('.', 2)[0]
+
+
+def pair_tasks(tasksByChannel):
+    """Groups the (x, md) tasks of every channel by image.
+
+    Returns a sorted list of (key, {channel: (x, md)}) pairs.
+    """
+    pairs = {}
+    for channel, tasks in tasksByChannel.items():
+        for x, md in tasks:
+            pairs.setdefault(pair_key(x), {})[channel] = (x, md)
+    return sorted(pairs.items())
+
+
+def nearest(p, q):
+    """Returns the index of the nearest value of sorted q for each p (-1 if
+    q is empty)."""
+    if len(q) == 0:
+        return np.full(len(p), -1, dtype=np.intp)
+    j = np.searchsorted(q, p)
+    j0 = np.clip(j-1, 0, len(q)-1)
+    j1 = np.clip(j, 0, len(q)-1)
+    return np.where(np.abs(q[j0]-p) <= np.abs(q[j1]-p), j0, j1)
+
+
+def match_puncta(pa, pb, maxDist):
+    """Pairs the mutually nearest puncta of two sorted position arrays.
+
+    Returns (ia, ib), the indices of the colocalized puncta in pa and pb.
+    """
+    pa = np.asarray(pa, dtype=float)
+    pb = np.asarray(pb, dtype=float)
+    ia = np.arange(len(pa))
+    if len(pa) == 0 or len(pb) == 0:
+        return ia[:0], ia[:0]
+    ib = nearest(pa, pb)
+    back = nearest(pb, pa)
+    mutual = (back[ib] == ia) & (np.abs(pb[ib]-pa) <= maxDist)
+    return ia[mutual], ib[mutual]
+
+
+def colocalize(key, resA, resB, chA, chB, maxDist):
+    """Builds the colocalization result of an image pair.
+
+    resA and resB are the analyze_image results of the two channels. Returns
+    a result dict for the output backends (meta, Colocalization and
+    Colocalization.Analysis).
+    """
+    pa = resA['Peaks']['distance']
+    pb = resB['Peaks']['distance']
+    ia, ib = match_puncta(pa, pb, maxDist)
+    onlyA = np.setdiff1d(np.arange(len(pa)), ia)
+    onlyB = np.setdiff1d(np.arange(len(pb)), ib)
+    nan = lambda n: np.full(n, np.nan)
+    distA = np.concatenate((pa[ia], pa[onlyA], nan(len(onlyB))))
+    distB = np.concatenate((pb[ib], nan(len(onlyA)), pb[onlyB]))
+    intA = resA['Peaks']['punctum_max_intensity']
+    intB = resB['Peaks']['punctum_max_intensity']
+    rows = {chA+'_distance': distA,
+            chB+'_distance': distB,
+            'separation': distB-distA,
+            chA+'_max_intensity': np.concatenate((intA[ia], intA[onlyA],
+                                                   nan(len(onlyB)))),
+            chB+'_max_intensity': np.concatenate((intB[ib], nan(len(onlyA)),
+                                                   intB[onlyB])),
+            'colocalized': np.arange(len(distA)) < len(ia)}
+    # Puncta in order of position along the neurite
+    order = np.argsort(np.fmin(distA, distB), kind='mergesort')
+    rows = dict((c, v[order]) for c, v in rows.items())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        analysis = {chA+'_peaks': len(pa),
+                    chB+'_peaks': len(pb),
+                    'colocalized_puncta': len(ia),
+                    chA+'_fraction_colocalized': len(ia)/float(len(pa)) if
+                    len(pa) else np.nan,
+                    chB+'_fraction_colocalized': len(ia)/float(len(pb)) if
+                    len(pb) else np.nan,
+                    'mean_separation': np.mean(np.abs(pb[ib]-pa[ia])) if
+                    len(ia) else np.nan}
+    meta = dict(resA['meta'], image_id=key)
+    return {'meta': meta, 'Colocalization': rows,
+            'Colocalization.Analysis': analysis}
+
+
+def channel_result(res, channel):
+    """Renames the tables of an analyze_image result for its channel."""
+    out = dict((k, v) for k, v in res.items()
+               if k not in dict(pf.tablesResults))
+    for name, cols in pf.tablesResults:
+        out[name+'.'+channel] = res[name]
+    return out
+
+
+def analyze_pairs(batch, nsParamsByCh, channels, maxDist=colocDistance,
+                  cache=None):
+    """Analyzes a batch of image pairs from pair_tasks.
+
+    Every channel's images are analyzed (and cached) as in
+    PACC_PeakFinder.analyze_batch. Returns a list of (key, results, coloc)
+    where results maps each channel to its (x, res, err) and coloc is the
+    colocalize() result or None.
+    """
+    byChannel = {}
+    for channel in channels:
+        tasks = [tasks[channel] for key, tasks in batch if channel in tasks]
+        byChannel[channel] = iter(pf.analyze_batch(tasks,
+                                                   nsParamsByCh[channel],
+                                                   cache))
+    out = []
+    for key, tasks in batch:
+        results = dict((channel, next(byChannel[channel])) for channel in
+                       channels if channel in tasks)
+        coloc = None
+        if len(channels) == 2 and len(results) == 2:
+            (xA, resA, errA), (xB, resB, errB) = [results[c] for c in
+                                                  channels]
+            if errA is None and errB is None:
+                coloc = colocalize(key, resA, resB, channels[0], channels[1],
+                                   maxDist)
+        out.append((key, results, coloc))
+    return out
+
+
+def analyzed_pairs(pairs, nsParamsByCh, channels, maxDist=colocDistance,
+                   cache=None, telemetry=None, batchSize=pf.batchSize):
+    """Source of analyzed batches for PACC_PeakFinder.run_analysis: the image
+    pairs from pair_tasks analyzed batchSize pairs at a time (see
+    analyze_pairs)."""
+    if telemetry is None:
+        telemetry = Telemetry(profile=[])
+    for iB in range(0, len(pairs), batchSize):
+        with telemetry.stage('analyze'):
+            batchRes = analyze_pairs(pairs[iB:iB+batchSize], nsParamsByCh,
+                                     channels, maxDist, cache)
+        yield batchRes
+
+
+def analyze_channels(dirCCPs, prepID, nsID, channels=('green', 'red'),
+                     pathRes=None, outputFormat='excel', excelSummary=True,
+                     figureMode='all', figureProcesses=None, cache=None,
+                     rdmeNote=None, batchSize=pf.batchSize,
+                     maxDist=colocDistance, store=None,
+                     compactData=None):
+    """Analyzes several channels of one neurite set in a single pass.
+
+    Arguments are those of PACC_PeakFinder.analyze_neurite_set plus the
+    channels to analyze and the colocalization distance maxDist (um).
+    Returns the same kind of run summary.
+    """
+    channels = list(channels)
+    today, now, timestamp = pf.get_timestamp()
+    telemetry = Telemetry()
+    telemetry.start()
+
+    if pathRes is None:
+        pathRes = dirCCPs+prepID+"/Analysis/"+timestamp+'/'
+    pathRes = os.path.join(pathRes, '')
+    if not os.path.isdir(pathRes):
+        os.makedirs(pathRes)
+    fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+timestamp
+    if rdmeNote is None:
+        rdmeNote = [' & '.join(c.capitalize() for c in channels)+
+                    " channel analysis"]
+    pf.write_readme(pathRes, prepID, timestamp, rdmeNote)
+
+    with telemetry.stage('prepare'):
+        nsParamsByCh = {}
+        tasksByCh = {}
+        for channel in channels:
+            CH, chExt = pf.CHANNELS[channel]
+            (nsParamsByCh[channel], tasksByCh[channel], dfExclusions,
+             dfPixInd) = pf.prepare_neurite_set(dirCCPs, prepID, nsID, CH,
+                                                chExt, pathRes, timestamp)
+        pairs = pair_tasks(tasksByCh)
+
+    tables = channel_tables(channels)
+    output = pf.open_output(pathRes, fnRes, outputFormat, excelSummary, tables,
+                            [name for name, cols in tables if
+                             name.startswith('Analysis.') or
+                             name == 'Colocalization.Analysis'],
+                            compactData)
+    if store is not None:
+        output = TeeOutput([output, store.open_run(prepID, nsID, channels,
+                                                   timestamp, pathRes)])
+    renderer = FigureRenderer(figureMode, figureProcesses, cache=cache)
+    try:
+        pf.run_analysis(analyzed_pairs(pairs, nsParamsByCh, channels, maxDist,
+                                       cache, telemetry, batchSize),
+                        nsParamsByCh, output, renderer, telemetry,
+                        channel_result)
+        print("Read "+str(telemetry.counters['bytes_read'])+" bytes of image "
+              "data for "+str(telemetry.counters['images'])+" images")
+    finally:
+        with telemetry.stage('figures'):
+            renderer.close()
+    for x, reasons in renderer.flagged:
+        print("Flagged "+x+": "+', '.join(reasons))
+
+    with telemetry.stage('write'):
+        pf.write_results(output, dfExclusions, dfPixInd, today, now,
+                         nsParamsByCh[channels[0]]['muperpx'], telemetry)
+    telemetry.stop(pathRes, prepID, timestamp)
+    telemetry.write(pathRes, prepID, timestamp)
+    return {'pathRes': pathRes, 'fnRes': fnRes,
+            'images': telemetry.counters['images'],
+            'failed_images': telemetry.counters['failed_images'],
+            'flagged': renderer.flagged, 'telemetry': telemetry}
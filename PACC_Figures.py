@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Figures.py
+
+QC figure rendering stage for PACC_PeakFinder. The numeric pass no longer
+draws anything; each analyzed image's result (see analyze_image) is handed
+to a FigureRenderer, which draws the image specific analysis file
+(<image>_pf.png) in its own pool of worker processes. Figures are drawn with
+the object-oriented Agg API, so no global pyplot state is touched, and the
+dark background style is set up once per worker.
+
+Figure modes:
+    'all'       every image at 300 dpi (the original output)
+    'preview'   every image at 72 dpi
+    'flagged'   only images flagged by flag_image (e.g. no peaks), 300 dpi
+    'none'      no figures
+
+The renderer re-reads the color channel of each image it draws, so the
+numeric pass only has to read the sampled rows. With a result cache (see
+PACC_Cache.py) every figure drawn is also kept in the cache, and the figure
+of a cached result is hard-linked (or copied) from there instead of being
+drawn again, so re-running a neurite set only draws the figures of new or
+changed images. A reused figure is the one drawn by the earlier run (its
+title shows that run's timestamp).
+"""
+#LIBRARIES
+import traceback
+import multiprocessing
+import numpy as np
+
+from PACC_ImageIO import read_channel
+
+#Figure mode -> dpi of the saved figure (None = no figures)
+FIGURE_MODES = {'all': 300, 'preview': 72, 'flagged': 300, 'none': None}
+
+
+def flag_image(analysis):
+    """Returns the reasons an image should be looked at (empty if none).
+
+    analysis is the image's Analysis row (dict of colsAnalysis values).
+    """
+    reasons = []
+    if analysis['total_peaks'] == 0:
+        reasons.append('no peaks')
+    if not (np.isfinite(analysis['min_height']) and
+            np.isfinite(analysis['prominence'])):
+        reasons.append('undefined threshold')
+    if not analysis['average_neurite_intensity'] > 0:
+        reasons.append('no neurite signal above background')
+    return reasons
+
+
+def setup_style():
+    """Sets the figure style; done once per rendering process."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.style
+    # Set main figure properties
+    SMALL_SIZE = 4
+    MEDIUM_SIZE = 6
+    BIGGER_SIZE = 8
+    matplotlib.style.use('dark_background')
+    matplotlib.rc('font', size=MEDIUM_SIZE)          # controls default text sizes
+    matplotlib.rc('axes', titlesize=MEDIUM_SIZE)     # fontsize of the axes title
+    matplotlib.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
+    matplotlib.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    matplotlib.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    matplotlib.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
+    matplotlib.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
+
+
+def figure_record(res):
+    """Picks the values a figure needs out of an analyze_image result."""
+    return {'x': res['meta']['image_id'],
+            'dist': res['Data']['distance'],
+            'rawf': res['Data']['raw_intensity'],
+            'bgf': res['Data']['background_intensity'],
+            'nf': res['Data']['neurite_intensity'],
+            'pd': res['Peaks']['distance'],
+            'pmi': res['Peaks']['punctum_max_intensity'],
+            'qTh': res['Analysis']['qTh'],
+            'minHeight': res['Analysis']['min_height'],
+            'prom': res['Analysis']['prominence']}
+
+
+def figure_file(x, nsParams):
+    """Returns the path of the QC figure of image x."""
+    return nsParams['pathRes']+x[:-4]+'_pf.png'
+
+
+def plot_image(rec, img, nsParams, dpi=300):
+    """Creates the image specific analysis file (QC figure) for one image."""
+    from matplotlib import cm, colors
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    x = rec['x']
+    dist, rawf, bgf, nf = rec['dist'], rec['rawf'], rec['bgf'], rec['nf']
+    pd, pmi = rec['pd'], rec['pmi']
+    qTh, minHeight, prom = rec['qTh'], rec['minHeight'], rec['prom']
+    pxTot = nsParams['pxTot']
+    pxBgndSize = nsParams['pxBgndSize']
+    inN1, inN2 = nsParams['pxN']
+    inB2, inB3 = nsParams['pxB'][1:3]
+    imsize = np.shape(img)
+
+    fig = Figure(dpi=dpi, figsize=(6.5,4.5))
+    FigureCanvasAgg(fig)
+    fig.suptitle(x+'\nAnalysis '+nsParams['timestamp']+'\nProminence = '+str(round(prom,2))+' Min Height = '+'{:.0f}'.format(minHeight))          # NaN for an undefined threshold
+    fig.subplots_adjust(top = 0.99, bottom=0.01, hspace=.5, wspace=0.4)
+
+    # Plot #1 is the raw image
+    ax1 = fig.add_subplot(311)                                                 #add_subplot(nrows, ncols, index, **kwargs)
+    ax1.set_title('Raw Image')
+    # Shift the plot down so that it doesn't overlap with the title
+    box = ax1.get_position()
+    box.y0 = box.y0 - 0.1
+    box.y1 = box.y1 - 0.1
+    ax1.set_position(box)
+    ax1.set_ylim((0,pxTot))
+    ax1.set_yticks((pxBgndSize/2,pxTot/2,pxTot-(pxBgndSize/2)))
+    labels = ['Background','Neurite','Background']
+    ax1.yaxis.set_ticklabels(labels,position=(0,.05))
+    ax1.set_xlabel('Pixel Index')
+    ax1.hlines((inB2,inN1,inN2,inB3),0,imsize[1],color='w', linewidth =.2,linestyles= 'dashed')
+    ax1.imshow(img, vmin=0,vmax=180)
+
+    # Plot #2 is the histogram of pixel intensities
+    ax3 = fig.add_subplot(323)
+    ax3.set_title('Distribution of Pixel Intensities')
+    ax3.set_xlabel('Pixel Intensity (AU)')
+    ax3.set_ylabel('Pixel Count')
+    n_bins = 25
+    N, bins, patches = ax3.hist(nf, bins=n_bins)
+    ax3.set_ylim((0,N.max()*1.1))
+    p1 = ax3.vlines(qTh, 0, N.max()*1.1, color='w',linewidth=.25)
+    p2 = ax3.vlines(minHeight, 0, N.max()*1.1, color='m',linewidth=.25)
+    p3 = ax3.vlines(prom, 0, N.max()*1.1, color='b',linewidth=.25)
+    # N is the count in each bin, bins is the lower-limit of the bin
+    # We'll color code by height, but you could use any scalar
+    fracs = N / N.max()
+    # we need to normalize the data to 0..1 for the full range of the colormap
+    norm = colors.Normalize(fracs.min(), fracs.max())
+    # Now, we'll loop through our objects and set the color of each accordingly
+    for thisfrac, thispatch in zip(fracs, patches):
+        color = cm.viridis(norm(thisfrac))
+        thispatch.set_facecolor(color)
+    ax3.legend((p1,p2,p3),
+               ('Third Quartile', 'Minimum Height','Prominence'),  loc='upper right', bbox_to_anchor=(1,1))
+
+    # Plot #3 is the raw background and neurite signal
+    ax4 = fig.add_subplot(324)
+    ax4.set_title('Mean Pixel Intensity for Region of Interest')
+    ax4.set_xlabel('Distance (um)')
+    ax4.set_ylabel('Intensity (AU)')
+    ax4.set_xlim(0,max(dist))
+    ax4.set_ylim(0,max(rawf)*1.1)
+    ax4.set_yticks([0,round((max(rawf)*1.1)/2,-1),round((max(rawf)*1.1),-1)])
+    p4 = ax4.plot(dist, bgf, 'c-')
+    p5 = ax4.plot(dist, rawf, 'g-')
+    ax4.legend((p4[0], p5[0]),
+               ('Background', 'Neurite'),  loc='best', bbox_to_anchor=(1,1))
+
+    #Plot #4 is the corrected neurite signal with identified peaks
+    ax5 = fig.add_subplot(313)
+    ax5.set_title('Identified Peaks')
+    ax5.set_xlabel('Distance (um)')
+    ax5.set_ylabel('Intensity (AU)')
+    ax5.set_ylim(0,max(nf)*1.1)
+    ax5.set_xlim(0,max(dist))
+    ax5.set_yticks([0,round((max(nf)*1.1)/2,-1),round((max(nf)*1.1),-1)])
+    p6 = ax5.plot(dist, np.full(len(dist), minHeight), 'm-')
+    p7 = ax5.plot(dist, nf, 'b-')
+    p8 = ax5.plot(pd, pmi, 'mo',markersize=4)
+    ax5.legend((p6[0],p7[0], p8[0]), ('Minimum Height',
+                'Corrected Neurite Signal', 'Identified Peak'),
+                loc='upper right', bbox_to_anchor=(1,1))
+
+    fig.savefig(figure_file(x, nsParams),  bbox_inches='tight',
+                dpi = dpi,
+                format = "png")
+
+
+def _render_task(task):
+    """Worker entry point: reads the image and draws its figure."""
+    rec, nsParams, dpi = task
+    try:
+        img = read_channel(nsParams['dirNS']+rec['x'], nsParams['CH'])[0]
+        plot_image(rec, img, nsParams, dpi)
+        return rec['x'], None
+    except Exception:
+        return rec['x'], traceback.format_exc()
+
+
+def figure_processes(processes=None, analysisProcesses=1):
+    """Returns the number of rendering processes.
+
+    processes None shares the CPUs with the analysis: the CPUs not used by
+    analysisProcesses analysis processes (None = all CPUs), at least 1.
+    """
+    if processes is not None:
+        return processes
+    nCPU = multiprocessing.cpu_count()
+    if analysisProcesses is None:
+        analysisProcesses = nCPU
+    return max(1, nCPU-analysisProcesses)
+
+
+class FigureRenderer(object):
+    """Draws QC figures for analyzed images in a pool of worker processes.
+
+    mode is one of FIGURE_MODES. processes is the number of rendering
+    processes (0 = draw in this process); None leaves the CPUs of the
+    analysisProcesses analysis processes to the analysis (see
+    figure_processes), so the two pools don't oversubscribe the CPUs. At most
+    maxPending figures are queued before submit() waits, which keeps memory
+    bounded when rendering is slower than the analysis. With a ResultCache
+    the figures of results that have a 'cache_key' are kept in the cache and
+    reused (counted in nReused) instead of drawn again. Results taken from
+    the result cache get figures like the others (every run has its own
+    results directory); with renderCached False they are skipped and
+    counted in nSkipped.
+    """
+
+    def __init__(self, mode='all', processes=None, maxPending=256,
+                 renderCached=True, analysisProcesses=1, cache=None):
+        if mode not in FIGURE_MODES:
+            raise ValueError("Unknown figure mode '"+str(mode)+"'; use one of "+
+                             ', '.join(sorted(FIGURE_MODES)))
+        self.mode = mode
+        self.dpi = FIGURE_MODES[mode]
+        self.maxPending = maxPending
+        self.renderCached = renderCached
+        self.cache = cache
+        self.pending = []                                                      # (async result, figure file, cache file key)
+        self.flagged = []                                                      # (image, reasons) for every flagged image
+        self.errors = []
+        self.nRendered = 0
+        self.nSkipped = 0
+        self.nReused = 0
+        self.pool = None
+        if self.dpi is None:
+            return
+        processes = figure_processes(processes, analysisProcesses)
+        if processes == 0:
+            setup_style()
+        else:
+            self.pool = multiprocessing.Pool(processes, initializer=setup_style)
+
+    def submit(self, res, nsParams):
+        """Queues the figure for one analyze_image result (if needed)."""
+        if self.dpi is None:
+            return
+        reasons = flag_image(res['Analysis'])
+        if reasons:
+            self.flagged.append((res['meta']['image_id'], reasons))
+        elif self.mode == 'flagged':
+            return
+        if res['io']['read_method'] == 'cache' and not self.renderCached:
+            self.nSkipped += 1
+            return
+        path = figure_file(res['meta']['image_id'], nsParams)
+        fileKey = None
+        if self.cache is not None and res.get('cache_key') is not None:
+            fileKey = self.cache.file_key(res['cache_key'],
+                                          res['meta']['image_id'], self.dpi)
+            if self.cache.get_file(fileKey, path):
+                self.nReused += 1
+                return
+        task = (figure_record(res), nsParams, self.dpi)
+        if self.pool is None:
+            self._done(_render_task(task), path, fileKey)
+            return
+        self.pending.append((self.pool.apply_async(_render_task, (task,)),
+                             path, fileKey))
+        while len(self.pending) > self.maxPending:
+            r, path, fileKey = self.pending.pop(0)
+            self._done(r.get(), path, fileKey)
+
+    def _done(self, result, path, fileKey=None):
+        x, err = result
+        if err is None:
+            self.nRendered += 1
+            if fileKey is not None:
+                try:
+                    self.cache.put_file(fileKey, path)
+                except (IOError, OSError) as e:
+                    print("Warning. Figure for "+x+" could not be cached: "+
+                          repr(e))
+        else:
+            print("Error. Figure for "+x+" could not be drawn:\n"+err)
+            self.errors.append((x, err))
+
+    def close(self):
+        """Waits for all queued figures; returns the number drawn."""
+        for r, path, fileKey in self.pending:
+            self._done(r.get(), path, fileKey)
+        self.pending = []
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.nSkipped:
+            print("Skipped the figures of "+str(self.nSkipped)+" cached "
+                  "image results")
+        if self.nReused:
+            print("Reused "+str(self.nReused)+" cached figures")
+        return self.nRendered
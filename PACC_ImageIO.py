@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_ImageIO.py
+
+Image loading layer for PACC_PeakFinder. The straightened neurite images
+from PACC_NeuTrace.ijm are RGB TIFFs, but the analysis only needs one color
+channel and, unless a QC figure is drawn, only the neurite and background
+row bands of that channel.
+
+read_channel() memory-maps the image data when the TIFF layout allows it
+(uncompressed, contiguous strips; tifffile required) and copies out just the
+requested channel and rows, so only those parts of the file are read from
+disk. Other TIFFs (e.g. compressed ones) fall back to a full decode with
+imageio.
+
+Each read reports how many bytes it read: the bytes of the row bands that
+were touched for memory-mapped reads, the file size for full decodes.
+"""
+#LIBRARIES
+import os
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:                                                            # Without tifffile every image is fully decoded
+    tifffile = None
+
+
+def read_channel(path, CH, rows=None):
+    """Reads one color channel of an image.
+
+    rows is an optional list of (start, end) row bands to read; the other rows
+    of the returned (rows, columns) array are left at zero. Returns (img,
+    nBytes, method) where method is 'memmap' or 'decode'.
+    """
+    if tifffile is not None:
+        mm = _memmap_tiff(path)
+        if mm is not None:
+            data, planar = mm
+            return _copy_bands(data, planar, CH, rows)
+    import imageio                                                             # Only needed (and loaded) for the fallback
+    img = imageio.imread(path)[:,:,CH]
+    return img, os.path.getsize(path), 'decode'
+
+
+def _memmap_tiff(path):
+    """Returns (memmap, planar) for the first page of a TIFF, or None.
+
+    planar is True when the color samples are stored as separate planes
+    (samples, rows, columns) and False when they are interleaved (rows,
+    columns, samples).
+    """
+    try:
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            if (not page.is_memmappable or page.samplesperpixel < 2 or
+                    len(page.dataoffsets) == 0):
+                return None
+            planar = page.planarconfig == 2
+            h, w = page.imagelength, page.imagewidth
+            shape = ((page.samplesperpixel, h, w) if planar else
+                     (h, w, page.samplesperpixel))
+            dtype = np.dtype(page.dtype).newbyteorder(tif.byteorder)
+            offset = page.dataoffsets[0]
+    except Exception:
+        return None                                                            # Let imageio try (and report) anything tifffile can't parse
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                     shape=shape), planar
+
+
+def _copy_bands(data, planar, CH, rows):
+    """Copies channel CH (only the given row bands) out of a memmap."""
+    plane = data[CH] if planar else data[:, :, CH]
+    if rows is None:
+        rows = [(0, plane.shape[0])]
+    img = np.zeros(plane.shape, dtype=plane.dtype.newbyteorder('='))
+    nRows = np.zeros(plane.shape[0], dtype=bool)
+    for r0, r1 in rows:
+        img[r0:r1] = plane[r0:r1]
+        nRows[r0:r1] = True
+    # Interleaved samples are read along with the channel
+    rowBytes = plane.shape[1]*data.itemsize*(1 if planar else data.shape[2])
+    nBytes = int(nRows.sum())*rowBytes
+    del plane, data                                                            # Release the memmap
+    return img, nBytes, 'memmap'
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Metadata.py
+
+Metadata layer of PACC_PeakFinder: reading MetaD.IM.csv & MetaD.<NS>.csv and
+finding the MetaD.IM row of every image of a neurite set.
+
+read_metadata() parses a metadata CSV and normalizes its column names once;
+the parsed table is kept (in this process) until the file's size or
+modification time changes. A prep's MetaD.IM.csv is shared by all of its
+neurite sets and channels, so batch, multi-channel and watch runs read it
+once instead of once per job.
+
+image_index() is the ImagingMetadata of a MetaD.IM.csv, cached the same
+way. It keeps the colsMetaD columns as arrays with a hash index on
+image_name, and resolve() looks up all image files of a neurite set with one
+vectorized index lookup instead of scanning the whole table per image. It
+returns the (image file, metadata dict) tasks and one report table of the
+files that were left out (no row in MetaD.IM.csv) or whose image_name is on
+more than one row (the first row is used, as before). report_text() turns
+the report into one message for the console.
+
+Cached tables are shared by every caller and must not be modified.
+"""
+#LIBRARIES
+import os
+import pandas
+
+#MetaD.IM.csv column of each colsMetaD value (in colsMetaD order)
+imageColumns = [('date', 'acquisition_date'), ('strain', 'strain'),
+                ('tiv', 'tiv'), ('pattern_geom', 'pattern_geom'),
+                ('surface_proteins', 'surface_proteins')]
+
+#Columns of the missing/duplicate image report
+colsReport = ['image_name','file','problem']
+
+_parsed = {}                                                                   # Path -> [signature, dataframe, ImagingMetadata or None]
+
+
+def clean_columns(df):
+    """Normalizes metadata column names (e.g. 'Line Width' -> 'line_width')."""
+    df.columns = (df.columns.str.strip().str.lower()
+                  .str.replace(' ', '_', regex=False)
+                  .str.replace('(', '', regex=False)
+                  .str.replace(')', '', regex=False))
+    return df
+
+
+def _signature(path):
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _entry(path):
+    """Returns the cache entry of a metadata file, parsing it if needed."""
+    path = os.path.abspath(path)
+    sig = _signature(path)                                                     # Taken before reading: a file changed meanwhile is read again next time
+    entry = _parsed.get(path)
+    if entry is None or entry[0] != sig:
+        entry = [sig, clean_columns(pandas.read_csv(path)), None]
+        _parsed[path] = entry
+    return entry
+
+
+def read_metadata(path):
+    """Returns the parsed metadata CSV with normalized column names."""
+    return _entry(path)[1]
+
+
+def image_index(path):
+    """Returns the ImagingMetadata of a MetaD.IM.csv file."""
+    entry = _entry(path)
+    if entry[2] is None:
+        entry[2] = ImagingMetadata(entry[1])
+    return entry[2]
+
+
+def clear_cache():
+    """Forgets every parsed metadata file."""
+    _parsed.clear()
+
+
+def image_name(x):
+    """Returns the MetaD.IM.csv image_name of an image file.
+
+    e.g. 'CCP_127_NS_02.01_im00.C0.JN0.tif' -> 'CCP_127_NS_02.01_im00'
+    """
+    return x.split(".C")[0]
+
+
+class ImagingMetadata(object):
+    """The colsMetaD values of MetaD.IM.csv, indexed by image_name."""
+
+    def __init__(self, dfMDim):
+        names = dfMDim['image_name']
+        first = ~names.duplicated(keep='first').values
+        self.duplicates = set(names[~first])
+        self.index = pandas.Index(names.values[first])
+        self.keys = [k for k, c in imageColumns]
+        self.values = [dfMDim[c].values[first] for k, c in imageColumns]
+
+    def __len__(self):
+        return len(self.index)
+
+    def resolve(self, files):
+        """Finds the metadata of image files.
+
+        Returns (tasks, report): tasks is the list of (file, metadata dict)
+        of the files found in MetaD.IM.csv (in the order of files) and report
+        has one colsReport row per file that is 'missing' from it or whose
+        image is 'duplicate' there.
+        """
+        files = list(files)
+        names = [image_name(x) for x in files]
+        pos = self.index.get_indexer(names)
+        found = pos >= 0
+        rows = zip(*[v[pos[found]] for v in self.values])
+        tasks = [(x, dict(zip(self.keys, row))) for x, row in
+                 zip([x for x, ok in zip(files, found) if ok], rows)]
+        report = [(name, x, 'missing') if not ok else (name, x, 'duplicate')
+                  for x, name, ok in zip(files, names, found)
+                  if not ok or name in self.duplicates]
+        return tasks, pandas.DataFrame(report, columns=colsReport)
+
+
+def report_text(report, waiting=False):
+    """Returns the console message of a resolve() report ('' if empty).
+
+    With waiting the missing images are reported as still to be added to
+    MetaD.IM.csv (PACC_Watch.py) instead of left out of the analysis.
+    """
+    lines = []
+    missing = report['image_name'][report['problem'] == 'missing'].unique()
+    if len(missing) and waiting:
+        lines.append(str(len(missing))+" image file(s) are not in the "
+                     "metadata sheet (yet); waiting for MetaD.IM.csv:")
+    elif len(missing):
+        lines.append("Error. "+str(len(missing))+" image file(s) are not in "
+                     "the original metadata sheet & will not be included in "
+                     "analysis:")
+    lines += ["    "+str(name) for name in missing]
+    duplicate = report['image_name'][report['problem'] ==
+                                     'duplicate'].unique()
+    if len(duplicate):
+        lines.append("Warning. "+str(len(duplicate))+" image(s) are on more "
+                     "than one row of the original metadata sheet; the first "
+                     "row is used:")
+        lines += ["    "+str(name) for name in duplicate]
+    return '\n'.join(lines)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Output.py
+
+Output backends for PACC_PeakFinder. Both take the per-image results from
+analyze_image() one at a time through add() and finish with close(sheets),
+where sheets are the (name, dataframe) pairs that are only known at the end
+of a run (Exclusions, Pixel Indices, Parameters). flush() writes out the
+results added so far where the format allows it, so that close() has little
+left to do (PACC_Watch.py flushes after every poll while a neurite set is
+still being traced).
+
+ExcelOutput
+    The original output: every sheet in one xlsxwriter workbook. All tables
+    are held in memory until the end. A sheet holds at most Excel's
+    1,048,576 rows (header included); the rows of a longer table continue
+    on <sheet>_2, <sheet>_3, ... with a warning (use the Parquet output for
+    such neurite sets).
+
+ParquetOutput
+    Streams the Data, Peaks, IPDs and Analysis tables into one Parquet file
+    each (<fnBase>.<sheet>.parquet) while the images are analyzed. Rows are
+    buffered only until a row group is full, so memory stays flat regardless
+    of the size of the neurite set. A small summary workbook with the
+    Analysis, Exclusions, Pixel Indices and Parameters sheets is written at
+    the end unless excelSummary is False. Requires pyarrow.
+
+Tables named in compactTables (the per-pixel Data sheets) are kept as
+PACC_Records.CompactTables: float32 values with the metadata stored once per
+image. ExcelOutput writes them chunkRows rows at a time, so the full
+denormalized table never exists in memory.
+
+In the Parquet files the metadata columns (date, image_id, strain, ...) are
+stored as strings so that every row group has the same schema.
+
+TeeOutput passes every call on to several backends, e.g. a workbook and the
+SQLite results store (PACC_Store.StoreOutput).
+"""
+#LIBRARIES
+import pandas
+
+excelRows = 1048576                                                            # Rows of an Excel sheet, header included
+
+from PACC_Records import CompactTable, ResultTables, table_builder
+
+
+class ExcelOutput(object):
+    """Keeps every table in memory and writes the full workbook on close."""
+
+    def __init__(self, pathRes, fnBase, tables, metaCols, compactTables=(),
+                 chunkRows=65536, sheetRows=excelRows-1):
+        self.fnRes = pathRes+fnBase+'.xlsx'
+        self.tables = ResultTables(tables, metaCols, compactTables)
+        self.chunkRows = chunkRows
+        self.sheetRows = sheetRows                                             # Data rows per sheet
+
+    def add(self, res):
+        self.tables.add(res)
+
+    def flush(self):
+        pass                                                                   # A workbook can only be written once
+
+    def close(self, sheets):
+        #OUTPUT DATAFRAMES AS SHEETS IN EXCEL FILE
+        wb = pandas.ExcelWriter(self.fnRes, engine='xlsxwriter')
+        for name in self.tables.names:
+            builder = self.tables.builders[name]
+            if len(builder) > self.sheetRows:
+                print("Warning. "+name+" has "+str(len(builder))+" rows, more "
+                      "than an Excel sheet holds; the rows continue on "+name+
+                      "_2, ... (use --output parquet for long neurite sets)")
+            if isinstance(builder, CompactTable):
+                self._write_rows(wb, name, builder.frames(self.chunkRows))
+            else:
+                self._write_rows(wb, name, [(0, builder.build())])
+        for name, df in sheets:
+            df.to_excel(wb, sheet_name=name)
+        wb.close()
+
+    def _write_rows(self, wb, name, frames):
+        """Writes the (first row, dataframe) chunks of a table, starting a
+        new sheet every sheetRows rows (xlsxwriter silently drops rows past
+        the end of a sheet)."""
+        for start, df in frames:
+            while True:
+                iSheet, row = divmod(start, self.sheetRows)
+                n = min(len(df), self.sheetRows-row)
+                sheet = name if iSheet == 0 else name+'_'+str(iSheet+1)
+                df.iloc[:n].to_excel(wb, sheet_name=sheet, header=row == 0,
+                                     startrow=row+1 if row else 0)
+                start, df = start+n, df.iloc[n:]
+                if len(df) == 0:
+                    break
+
+
+class ParquetOutput(object):
+    """Streams the per-image tables to Parquet as row groups.
+
+    rowGroupSize is the number of rows buffered per table before they are
+    written. summaryTables are also kept in memory for the summary workbook.
+    """
+
+    def __init__(self, pathRes, fnBase, tables, metaCols, rowGroupSize=65536,
+                 excelSummary=True, summaryTables=('Analysis',),
+                 compactTables=()):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output requires pyarrow "
+                              "(pip install pyarrow)")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.pathRes = pathRes
+        self.fnBase = fnBase
+        self.metaCols = list(metaCols)
+        self.rowGroupSize = rowGroupSize
+        self.excelSummary = excelSummary
+        self.tables = list(tables)
+        self.compactTables = list(compactTables)
+        self.builders = dict((name, table_builder(name, cols, metaCols,
+                                                  compactTables))
+                             for name, cols in self.tables)
+        self.summary = ResultTables([(name, cols) for name, cols in self.tables
+                                     if name in summaryTables], metaCols)
+        self.writers = {}
+        self.paths = dict((name, pathRes+fnBase+'.'+name+'.parquet')
+                          for name, cols in self.tables)
+
+    def add(self, res):
+        # Metadata is converted to strings once per image, not once per row
+        meta = dict((c, None if pandas.isnull(v) else str(v))
+                    for c, v in res['meta'].items())
+        for name, cols in self.tables:
+            if name not in res:
+                continue                                                       # e.g. the other channel's tables
+            self.builders[name].add(meta, res[name])
+            if len(self.builders[name]) >= self.rowGroupSize:
+                self._flush(name)
+        self.summary.add(res)
+
+    def flush(self):
+        """Writes the buffered rows of every table as (small) row groups.
+
+        The files are readable once close() has written their footers.
+        """
+        for name, cols in self.tables:
+            if len(self.builders[name]):
+                self._flush(name)
+
+    def _flush(self, name):
+        """Writes the buffered rows of one table as a Parquet row group."""
+        builder = self.builders[name]
+        df = builder.build()
+        self.builders[name] = table_builder(name, builder.columns,
+                                            self.metaCols, self.compactTables)
+        for c in builder.metaCols:
+            df[c] = df[c].astype(object)
+        if name in self.writers:
+            writer = self.writers[name]
+            table = self._pa.Table.from_pandas(df, schema=writer.schema,
+                                               preserve_index=False)
+        else:
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            # Columns without any values yet are typed from the schema
+            schema = table.schema
+            for i, field in enumerate(schema):
+                if self._pa.types.is_null(field.type):
+                    schema = schema.set(i, self._pa.field(
+                        field.name, self._pa.string() if field.name in
+                        builder.metaCols else self._pa.float64()))
+            table = table.cast(schema)
+            writer = self._pq.ParquetWriter(self.paths[name], schema)
+            self.writers[name] = writer
+        writer.write_table(table)
+
+    def close(self, sheets):
+        for name, cols in self.tables:
+            if len(self.builders[name]) or name not in self.writers:
+                self._flush(name)                                              # Empty tables still get a file
+            self.writers.pop(name).close()
+
+        if self.excelSummary:
+            wb = pandas.ExcelWriter(self.pathRes+self.fnBase+'.xlsx',
+                                    engine='xlsxwriter')
+            for name, df in zip(self.summary.names, self.summary.build()):
+                df.to_excel(wb, sheet_name=name)
+            for name, df in sheets:
+                df.to_excel(wb, sheet_name=name)
+            wb.close()
+
+
+class TeeOutput(object):
+    """Sends the results to several output backends."""
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+
+    def add(self, res):
+        for output in self.outputs:
+            output.add(res)
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+    def close(self, sheets):
+        for output in self.outputs:
+            output.close(sheets)
@@ -1,132 +1,107 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 PACC_PeakFinder_v4.py
 
-v4 switchs order of identifying peaks. Previous version of the code was 
+v4 switchs order of identifying peaks. Previous version of the code was
 calculating the threshold off of the raw signal but this was the incorrect
 approach since the background subtracted signal was the one being used
 in find_peaks. Here:
     1. Calculate background
-    2. Calculate raw neurite signal 
+    2. Calculate raw neurite signal
     3. Calculate background subtracted raw neurite signal
     4. Use signal from step 3 to calculate threshold according to this algo:
             1. Q3 is calculated for all pixel raw intensities
             2. A subset of pixels with intensity [0,Q3) is generated
             3. The mean and standard deviation is calculated for this new subset
-            4. The threshold for peak intensity is then the mean+2*sigma. 
+            4. The threshold for peak intensity is then the mean+2*sigma.
                 => This value is very close to the std for the full population &
-                guarantees an SNR of at least 1. 
+                guarantees an SNR of at least 1.
     5. Feed these parameters into find_peaks
 
-Also made some changes to how the indices for the neurite versus background 
-were calculated. 
+Also made some changes to how the indices for the neurite versus background
+were calculated.
 
 15MAR2020 - Changing Prominence to be calculated based off total population std
+
+17OCT2026 - The per-image analysis now lives in analyze_image() so that the
+same code can be run from a process pool (see PACC_Batch.py). Importing this
+file has no side effects; analyze_neurite_set() runs a whole NS and
+write_results() saves it. Running this file analyzes one prep/NS/channel
+given on the command line (the settings below are the defaults):
+
+    python PACC_PeakFinder.py --ccps /path/to/CCPs/ --prep CCP_127
+                              --ns NS_02.01 --channel green [red]
+                              [--out-dir results/] [--output parquet]
+                              [--figures none] [--stitch]
+
+scipy.signal (find_peaks), matplotlib (figures) and xlsxwriter (Excel
+output) are only imported once they are needed.
 """
 #LIBRARIES
 import os
-import matplotlib.pyplot as plt
-import pandas 
+import pandas
 import glob
 import datetime
-import imageio
+import traceback
+import argparse
 import numpy as np
-from scipy.signal import find_peaks
-from matplotlib import colors
+
+from PACC_Cache import ResultCache, pixels_sha1, stat_signature
+from PACC_Figures import FIGURE_MODES, FigureRenderer
+from PACC_ImageIO import read_channel
+from PACC_Metadata import (clean_columns, image_index, read_metadata,
+                           report_text)
+from PACC_Output import ExcelOutput, ParquetOutput, TeeOutput
+from PACC_Profiles import batch_profiles, batch_thresholds
+from PACC_Telemetry import (Telemetry, clocks, elapsed,
+                            process_maxrss_mb)
+from PACC_Tiles import (TiledProfile, array_tiles, file_tiles,
+                        tiled_find_peaks, tiled_thresholds)
 
 # *** UPDATE NOTE TO STORE WITH ANALYSIS RUN ***
 # Specify notes about this analysis run
 rdmeNote = ["Green channel analysis"]
 # Specify color to analyze (green = 1, red = 0)
-CH = 1                                                                         # This numbering is defined by imageio.imread 
-# Specify color file (green = 0, red =1 e.g., JN0 = analyze green channel images)                                             
+CH = 1                                                                         # This numbering is defined by imageio.imread
+# Specify color file (green = 0, red =1 e.g., JN0 = analyze green channel images)
 chExt = 'JN0'
 
-
-# *** GET TIME OF ANALYSIS START ***
-toa = str(datetime.datetime.today()).split()                                   # Analysis runs are saved with unique timestamps
-today = toa[0]
-now = toa[1]
-timestamp = today.replace('-','')+'-'+now.replace(':','')[:6]
-
 # *** WHAT TO ANALYZE ***
 prepID = 'CCP_127'                                                             # Cell-culture prep from where the NS arises
-nsID = 'NS_02.01'                                                              # Neurite set (NS) to analyze  
+nsID = 'NS_02.01'                                                              # Neurite set (NS) to analyze
+
+# *** HOW MANY IMAGES TO PROFILE TOGETHER ***
+batchSize = 64                                                                 # Larger batches use more memory (images are padded to the longest)
+tiledLength = 16384                                                            # Longer images are analyzed alone, in tiles (see PACC_Tiles.py; None = never)
+
+# *** QC FIGURES ***
+figureMode = 'all'                                                             # 'all', 'preview' (low dpi), 'flagged' (only suspicious images) or 'none'
+figureProcesses = None                                                         # Processes drawing figures (None = all CPUs but the analysis process, 0 = draw in this process)
+
+# *** PEAK FINDING PARAMETERS ***
+# minHeight = ss_mean+heightSD*ss_std, prominence = population std and peak
+# widths are measured at relHeight of the prominence (see find_peaks)
+peakParams = {'heightSD': 2, 'width': 0, 'relHeight': 0.5}
+
+# *** HOW TO STORE RESULTS ***
+outputFormat = 'excel'                                                         # 'excel' = one workbook, 'parquet' = stream tables to Parquet files
+excelSummary = True                                                            # With parquet, also write Analysis/Exclusions/Pixel Indices/Parameters to Excel
+compactData = True                                                             # Keep the Data table as float32 with per-image metadata until it is written (False = float64, as before)
 
 #       ****       WHERE TO GET DATA & METADATA     ****
-dirCCPs = "/Users/nerdette/Google Drive/Research/WormSense/Data/CCPs/"  # Location where data is stored for all preps   
-dirPrep = dirCCPs+prepID+"/"                                                   # Location where all prep-specific data is stored      
-dirMetaD = dirPrep+"Metadata/"                                                 # Directory for all prep-specific metadata  
-dirNS = dirPrep+"Images/Cropped/"+nsID+"/"                                     # Directory for NS images to be analyzed (req'd for analysis)     
-fnMDim = prepID+'.MetaD.IM.csv'                                                # Path to imaging metadata (req'd for analysis)  
-fnMDns = prepID+".MetaD."+nsID+".csv"                                          # Name of NS metatadata file (req'd for analysis) 
-
-#       ****        WHERE TO STORE RESULTS         ****
-pathRes = dirPrep+"Analysis/"+timestamp+'/'
-os.mkdir(pathRes)                                                  # Output locataion for final excel workbook                              
-fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+timestamp+'.xlsx'               # Output Excel file 
-
-
-#      ***   OUTPUT TEXT FILE TO DESCRIBE ANALYSIS RUN
-os.chdir(pathRes)
-rdmeFile = open(prepID+"_AnalysisRDME."+timestamp+".txt","w+") 
-rdmeFile.writelines(rdmeNote) 
-rdmeFile.close() #to change file access modes 
-
-
-#       ***       IMPORT METADATA FOR ANALYSIS      ***
-dfMDim = pandas.read_csv(dirMetaD+fnMDim)                                      # Import original imaging metadata
-dfMDim.columns = dfMDim.columns.str.strip().str.lower().str.replace(' ', 
-                 '_').str.replace('(', '').str.replace(')', '')
-dfMDns = pandas.read_csv(dirMetaD+fnMDns)                                      # Import neurite set metadata
-dfMDns.columns = dfMDns.columns.str.strip().str.lower().str.replace(' ', 
-                 '_').str.replace('(', '').str.replace(')', '')
-
-#       ***     COUNT EXCLUSION INSTANCES AND TYPES     ***
-dfExclusions = dfMDns['exclusion_reason'].value_counts()                       # Poss entries are: None, Bipolar, Psuedo Bipolar, No neurites, other 
-
-#       ***         GET LIST OF IMAGES TO ANALYZE       ***                                                
-os.chdir(dirNS)
-ims = glob.glob('*.'+chExt+'.tif')                                             # chExt = JN0 for green, JN1 for red
-
-# *** ANALYSIS PARAMETERS ***
-f = os.path.basename(__file__)                                                 # Store filename of *.py analysis code
-muperpx = dfMDim.loc[0,'calibration_um/pix']                                   # Get um/pix conversion factor from metadata
-
-
-# *** CALCULATE PIXELS TO SAMPLE ***
-pxTot = dfMDns.loc[0,'line_width']
-pxBgndSize = (pxTot/4)
-pxNeuSize = int(round(1/muperpx))
-pxNeuStart = (pxTot-pxNeuSize)/2
-# Only preliminary data was acquired at lower resolution. All images used 
-# for official analysis should be taken at muperpx == .126. 
-# Analysis for .252 case is for backwards compatability. 
-if muperpx == .252:    
-    #calc indices for pixels to sample in image
-    inB1 = 0                                                                       #Getting pixel indices  
-    inB2 = pxBgndSize-1
-    inN1 = pxNeuStart
-    inN2 = pxNeuStart+pxNeuSize-1
-    inB3 = pxTot-pxBgndSize                                                   
-    inB4 = pxTot-1                                                                 #Pixel index is size-1 
-elif muperpx == .126:
-    #calc indices for pixels to sample in image
-    inB1 = 0                                                                       #Getting pixel indices  
-    inB2 = pxBgndSize-1
-    inN1 = pxNeuStart             
-    inN2 = pxNeuStart+pxNeuSize-1
-    inB3 = pxTot-pxBgndSize
-    inB4 = pxTot-1
-
-pxN = [inN1,inN2]                                                              #Pixel range for neurite   
-pxB = [inB1,inB2,inB3,inB4]      
-                                            #Pixel range for background 
-dfPixInd = pandas.DataFrame(np.array([['background_1',inB1, inB2],
-                                     ['neurite',inN1,inN2],
-                                     ['background_2',inB3,inB4]]),
-                            columns = ['region','index_start','index_end'])
+dirCCPs = "/Users/nerdette/Google Drive/Research/WormSense/Data/CCPs/"  # Location where data is stored for all preps
+
+# *** RESULT CACHE ***
+dirCache = dirCCPs+"PACC_Cache/"                                               # Per-image results are reused by later runs (None = no cache)
+cacheMaxGB = 5                                                                 # Least recently used results are deleted above this size
+
+# *** RESULTS STORE ***
+dbResults = None                                                               # SQLite file that also gets every run's Peaks/IPDs/Analysis (see PACC_Store.py)
+
+# Channel name -> (CH, chExt) pairs used when scheduling several analyses
+CHANNELS = {'green': (1, 'JN0'),
+            'red': (0, 'JN1')}
 
 #           *** SETUP DATAFRAMES TO SAVE AS SPREADSHEETS IN ***
 #           ***     EXCEL FILE AT THE END OF ANALYSIS       ***
@@ -160,288 +135,868 @@ colsAnalysis = ['date','image_id','prep_id','strain','ns_id',
                 'min_height','prominence']
 
 #Track pixels used for each region of analysis
-colsPixRange = ['region','starting_index','final_index']                       
-
-#***initialize dataframes***
-dfData = pandas.DataFrame()                                                       
-dfPeaks = pandas.DataFrame()
-dfIPDs = pandas.DataFrame()
-dfAnalysis = pandas.DataFrame()
-
-
-# *** MAIN PEAK FINDER ANALYSIS LOOP ***
-os.chdir(dirNS) 
-
-for x in ims:      
-    # fileIm is the name of the original, regional image as it's called in the
-    #   MetaD.IM.csv file
-    fileIm = x.split(".C")[0]
-    
-    # Import image and store it in a list of lists
-    img = imageio.imread(x)[:,:,CH]                                            #CH should be an integer to specify which color images to analyze (1 = GRN, 0 = RED)
-    
-    # Find index of fileIm in MetaD.IM.csv dataframe
-    # Returns '0' if the file doesn't exist
-    chk4file = dfMDim[dfMDim['image_name']==fileIm].index                      
-    
-    # Throw error if the image isn't found
-    if(chk4file.size == 0):
-        print("Error. Image file " +fileIm+ " is not in the original", 
-              " metadata sheet & will not be included in analysis.")
-    # If image does exist, proceed with metadata gathering & data analysis
+colsPixRange = ['region','starting_index','final_index']
+
+#Metadata copied from MetaD.IM.csv for each image
+colsMetaD =    ['date','strain','tiv','pattern_geom','surface_proteins']
+
+#Metadata repeated on every row of every table
+colsImage =    ['date','image_id','prep_id','strain','ns_id',
+                'tiv','pattern_geom','surface_proteins']
+
+#Sheets that are built up one image at a time
+tablesResults = [('Data', colsData), ('Peaks', colsPeaks),
+                 ('IPDs', colsIPDs), ('Analysis', colsAnalysis)]
+
+
+def find_peaks(x, **kwargs):
+    """scipy.signal.find_peaks, imported on first use (it is slow to load)."""
+    from scipy.signal import find_peaks as scipy_find_peaks
+    return scipy_find_peaks(x, **kwargs)
+
+
+def get_timestamp():
+    """Returns (today, now, timestamp) for labelling an analysis run."""
+    toa = str(datetime.datetime.today()).split()                               # Analysis runs are saved with unique timestamps
+    today = toa[0]
+    now = toa[1]
+    timestamp = today.replace('-','')+'-'+now.replace(':','')[:6]
+    return today, now, timestamp
+
+
+def metadata_paths(dirCCPs, prepID, nsID):
+    """Returns the paths of the MetaD.IM and MetaD.NS files of a neurite set."""
+    dirMetaD = dirCCPs+prepID+"/Metadata/"                                     # Directory for all prep-specific metadata
+    fnMDim = prepID+'.MetaD.IM.csv'                                            # Path to imaging metadata (req'd for analysis)
+    fnMDns = prepID+".MetaD."+nsID+".csv"                                      # Name of NS metatadata file (req'd for analysis)
+    return dirMetaD+fnMDim, dirMetaD+fnMDns
+
+
+def load_metadata(dirCCPs, prepID, nsID):
+    """Imports the imaging (MetaD.IM) and neurite set (MetaD.NS) metadata.
+
+    The tables are parsed once and shared until the files change (see
+    PACC_Metadata.py); don't modify them.
+    """
+    pathMDim, pathMDns = metadata_paths(dirCCPs, prepID, nsID)
+    return read_metadata(pathMDim), read_metadata(pathMDns)
+
+
+def get_pixel_indices(pxTot, muperpx):
+    """Returns the neurite/background row ranges for a straightened image.
+
+    pxN is [start, end] for the neurite rows and pxB is [start, end, start,
+    end] for the two background bands. dfPixInd is the 'Pixel Indices' sheet.
+    """
+    # *** CALCULATE PIXELS TO SAMPLE ***
+    pxBgndSize = (pxTot//4)
+    pxNeuSize = int(round(1/muperpx))
+    pxNeuStart = (pxTot-pxNeuSize)//2
+    # Only preliminary data was acquired at lower resolution. All images used
+    # for official analysis should be taken at muperpx == .126.
+    # Analysis for .252 case is for backwards compatability.
+    if muperpx == .252:
+        #calc indices for pixels to sample in image
+        inB1 = 0                                                               #Getting pixel indices
+        inB2 = pxBgndSize-1
+        inN1 = pxNeuStart
+        inN2 = pxNeuStart+pxNeuSize-1
+        inB3 = pxTot-pxBgndSize
+        inB4 = pxTot-1                                                         #Pixel index is size-1
+    elif muperpx == .126:
+        #calc indices for pixels to sample in image
+        inB1 = 0                                                               #Getting pixel indices
+        inB2 = pxBgndSize-1
+        inN1 = pxNeuStart
+        inN2 = pxNeuStart+pxNeuSize-1
+        inB3 = pxTot-pxBgndSize
+        inB4 = pxTot-1
     else:
-        # ADD IMPORTANT METADATA TO MEASUREMENTS
-        # Use index to get relavent metadata from MetaD.IM.csv dataframe
-        index = chk4file[0]
-        date = dfMDim.at[index,'acquisition_date']                             
-        strain = dfMDim.at[index,'strain']
-        tiv = dfMDim.at[index,'tiv']
-        pattern_geom = dfMDim.at[index,'pattern_geom']
-        surface_proteins = dfMDim.at[index,'surface_proteins']
-        
-        # ADD IMAGE DATA TO DATA FRAME
-        # Calculate image size                                  
-        imsize = np.shape(img)
-        #***setup horizontal axes to represent image columns**
-        d=np.arange(imsize[1])                                                 #Array of integers to represent pixels along image (aka image columns)
-        dist = d*muperpx                                                       #Generate array of physical distances along image based on um:pix conversion factor
-        normdist=dist/dist[-1]                                                 #Create a normalized axis to represent positions along image as 0->1 
-        #***break image up into background and neurite***
-        n = img[pxN[0]:pxN[1], 0:]                                             #Extract neurite rows
-        bg = np.concatenate((img[pxB[0]:pxB[1], 0:],                           #Extract background rows 
-                             img[pxB[2]:pxB[3], 0:]))   
+        raise ValueError("Unsupported calibration of "+str(muperpx)+" um/pix")
+
+    pxN = [inN1,inN2]                                                          #Pixel range for neurite
+    pxB = [inB1,inB2,inB3,inB4]                                                #Pixel range for background
+    dfPixInd = pandas.DataFrame(np.array([['background_1',inB1, inB2],
+                                         ['neurite',inN1,inN2],
+                                         ['background_2',inB3,inB4]]),
+                                columns = ['region','index_start','index_end'])
+    return pxN, pxB, dfPixInd
+
+
+def ns_parameters(dfMDim, dfMDns, prepID, nsID, CH, chExt, dirNS, pathRes,
+                  timestamp):
+    """Returns (nsParams, dfExclusions, dfPixInd) from the NS metadata."""
+    #       ***     COUNT EXCLUSION INSTANCES AND TYPES     ***
+    dfExclusions = dfMDns['exclusion_reason'].value_counts()                   # Poss entries are: None, Bipolar, Psuedo Bipolar, No neurites, other
+
+    # *** ANALYSIS PARAMETERS ***
+    muperpx = dfMDim.loc[0,'calibration_um/pix']                               # Get um/pix conversion factor from metadata
+    pxTot = dfMDns.loc[0,'line_width']
+    pxN, pxB, dfPixInd = get_pixel_indices(pxTot, muperpx)
+    nsParams = {'prepID': prepID, 'nsID': nsID, 'CH': CH, 'chExt': chExt,
+                'dirNS': dirNS, 'pathRes': pathRes, 'timestamp': timestamp,
+                'muperpx': muperpx, 'pxTot': pxTot, 'pxBgndSize': pxTot//4,
+                'pxN': pxN, 'pxB': pxB, 'peakParams': dict(peakParams),
+                'tiledLength': tiledLength}
+    return nsParams, dfExclusions, dfPixInd
+
+
+def prepare_neurite_set(dirCCPs, prepID, nsID, CH, chExt, pathRes, timestamp):
+    """Gathers everything needed to analyze the images of one neurite set.
+
+    Returns (nsParams, tasks, dfExclusions, dfPixInd) where tasks is a sorted
+    list of (image file, metadata dict) pairs for every image found in
+    MetaD.IM.csv. Images missing from the metadata (or on more than one of
+    its rows) are listed in one report; missing images are skipped.
+    """
+    dfMDim, dfMDns = load_metadata(dirCCPs, prepID, nsID)
+    dirNS = dirCCPs+prepID+"/Images/Cropped/"+nsID+"/"                         # Directory for NS images to be analyzed (req'd for analysis)
+    nsParams, dfExclusions, dfPixInd = ns_parameters(dfMDim, dfMDns, prepID,
+                                                     nsID, CH, chExt, dirNS,
+                                                     pathRes, timestamp)
+
+    #       ***         GET LIST OF IMAGES TO ANALYZE       ***
+    ims = sorted(glob.glob(dirNS+'*.'+chExt+'.tif'))                           # chExt = JN0 for green, JN1 for red
+    imaging = image_index(metadata_paths(dirCCPs, prepID, nsID)[0])
+    tasks, report = imaging.resolve(os.path.basename(path) for path in ims)
+    if len(report):
+        print(report_text(report))
+    return nsParams, tasks, dfExclusions, dfPixInd
+
+
+def profile_images(batch, nsParams, hashImages=False, timing=None):
+    """Reads a batch of images and calculates their profiles & thresholds.
+
+    batch is a list of (x, md) pairs where x is the image file name inside
+    nsParams['dirNS']. Returns (groups, reads, hashes, errors). groups is a
+    list of (inds, imgs, prof, th), one per image height, where inds are the
+    batch positions of the images, imgs the images and prof/th the outputs
+    of batch_profiles and batch_thresholds. Images longer than
+    nsParams['tiledLength'] columns get a group of their own with prof and
+    th None; they are profiled tile by tile (see tiled_result) instead of
+    padding the whole batch to their length. reads, hashes and errors map
+    batch positions to the read_channel stats, the (stat_signature,
+    pixels_sha1) of the file (only with hashImages; the sampled pixels are
+    hashed as they are read) and the traceback text of images that
+    could not be read. If a timing dict is given it gets a dict per batch
+    position with the (wall, CPU) seconds of the 'load', 'profile' and
+    'threshold' stages (see PACC_Telemetry.py) and the number of 'pixels'
+    read.
+    """
+    imgs = {}
+    reads = {}
+    hashes = {}
+    errors = {}
+    # Only the sampled rows are read (QC figures re-read the whole image)
+    pxN, pxB = nsParams['pxN'], nsParams['pxB']
+    rows = sampled_rows(nsParams)
+    nRows = sum(r1-r0 for r0, r1 in rows)
+    if timing is None:
+        timing = {}
+    for i, (x, md) in enumerate(batch):
+        start = clocks()
+        try:
+            if hashImages:
+                sig = stat_signature(nsParams['dirNS']+x)                      # Before reading: a file changed meanwhile is hashed again next time
+            # Import one color channel of the image (CH = 1 GRN, 0 RED)
+            imgs[i], nBytes, method = read_channel(nsParams['dirNS']+x,
+                                                   nsParams['CH'], rows)
+            reads[i] = {'bytes_read': nBytes, 'read_method': method}
+            if hashImages:
+                hashes[i] = (sig, pixels_sha1(imgs[i], rows))
+        except Exception:
+            errors[i] = traceback.format_exc()
+        timing[i] = {'load': elapsed(start)}
+
+    # Images can only be stacked with others of the same height
+    byHeight = {}
+    groups = []
+    tiled = nsParams.get('tiledLength')
+    for i in sorted(imgs):
+        if tiled is not None and np.shape(imgs[i])[1] > tiled:
+            groups.append(([i], [imgs[i]], None, None))
+            continue
+        byHeight.setdefault(np.shape(imgs[i])[0], []).append(i)
+    for h in sorted(byHeight):
+        inds = byHeight[h]
         #***calculate values for analysis***
-        rawf = np.mean(n, axis=0)                                              #Average raw neurite fluorescence
-        bgf = np.mean(bg, axis=0)                                              #Average raw background fluorescence
-        nf = rawf - bgf                                                        #Background subtracted neurite fluorescence
-        annf= nf/np.mean(nf,axis=0)                                            #Average normalized neurite fluorescencece 
-        mnnf = nf/np.amax(nf,axis=0)
-        #***set negative nf values to zero
-        for i in range(len(nf)):
-            if nf[i]<0: nf[i]=0
-        #***add image data dataframme***
-        alldata1 = pandas.DataFrame({'date':[date]*imsize[1], 
-                                     'image_id':[x]*imsize[1], 
-                                     'prep_id':[prepID]*imsize[1],
-                                     'strain':[strain]*imsize[1],
-                                     'ns_id':[nsID]*imsize[1],
-                                     'tiv':[tiv]*imsize[1],
-                                     'pattern_geom':[pattern_geom]*imsize[1],
-                                     'surface_proteins':[surface_proteins]*imsize[1],
-                                     'distance':dist,
-                                     'normalized_distance':normdist,
-                                     'raw_intensity':rawf, 
-                                     'background_intensity':bgf, 
-                                     'neurite_intensity':nf,
-                                     'avg_norm_neu_int':annf,
-                                     'max_norm_neu_int':mnnf}, columns=colsData)
-        dfData=dfData.append(alldata1)
-        
-        
-        # DETERMINE PEAK LOCATIONS
-        # Calculate minimum height and prominence values
-        # 1. Calculate Third Quartile for all image neurite pixels rawf values
-        descNF= alldata1['neurite_intensity'].describe()
-        qTh = descNF[['75%']][0]
-        # 2. Create a subset of pixels that are below the third quartile
-        dfSS_alldata1 = alldata1[alldata1['neurite_intensity'] < qTh] 
-        # 3. Calculate important stats for this subset
-        descSS = dfSS_alldata1['neurite_intensity'].describe()
-        mean = descSS[['mean']][0]    
-        median = descSS[['50%']][0]
-        stdSS = descSS[['std']][0]
-        n = descSS[['count']][0]
-        # 4. Use these statistics to calcualte cutoff values
-        minHeight = mean+2*stdSS
-        #prom = 2*std
-        # 5. Use pop std to calculate prominence cutoff values
-        descNI = alldata1['neurite_intensity'].describe()                          
-        prom = descNI[['std']][0]
-        
-        
-        #***find peaks***
-        peaks = find_peaks(nf, height=minHeight, prominence=prom,              #Relheight is used to calculate peak width, it is a % of peak prominence 
-                           width=0, rel_height=0.5)
-        pd = peaks[0]*muperpx                                                  #Convert pixel distances to physical distances 
-        pnd = pd/dist[-1]                                                      #Calculated normalized physical distances (0->1) 
-        pmi = [nf[i] for i in peaks[0]]                                        #Get intensity for each punctum location                                   
-        pmi_norm = [mnnf[i] for i in peaks[0]]                                 #Get max normalized intensity for each punctum location 
-        #***calculate punctum spacing***
-        ipd = np.diff(pd)                                                      #Here, .diff() returns physical distance between puncta                                                  
-        ipdd = [pd[i]+ipd[i]/2 for i in range(0,len(ipd))]                     #Inter-punctum interval:   
-        ipdnd = ipdd/dist[-1]
-        #***add peak data to dataframe***
-        alldata2 = pandas.DataFrame({'date':[date]*len(pd), 
-                                     'image_id':[x]*len(pd), 
-                                     'prep_id':[prepID]*len(pd),
-                                     'strain':[strain]*len(pd),
-                                     'ns_id':[nsID]*len(pd),
-                                     'tiv':[tiv]*len(pd),
-                                     'pattern_geom':[pattern_geom]*len(pd),
-                                     'surface_proteins':[surface_proteins]*len(pd),
-                                     'distance':pd,
-                                     'normalized_distance':pnd,
-                                     'punctum_max_intensity':pmi,
-                                     'norm_punctum_max_int':pmi_norm,
-                                     'punctum_width':peaks[1]['widths']*muperpx}, 
-                                     columns=colsPeaks)
-        dfPeaks=dfPeaks.append(alldata2)
-        #***add Inter-punctum data to dataframe***
-        alldata3 = pandas.DataFrame({'date':[date]*len(ipd), 
-                                     'image_id':[x]*len(ipd), 
-                                     'prep_id':[prepID]*len(ipd),
-                                     'strain':[strain]*len(ipd),
-                                     'ns_id':[nsID]*len(ipd),
-                                     'tiv':[tiv]*len(ipd),
-                                     'pattern_geom':[pattern_geom]*len(ipd),
-                                     'surface_proteins':[surface_proteins]*len(ipd),
-                                     'distance':ipdd, 
-                                     'normalized_distance':ipdnd, 
-                                     'inter-punctum_interval':ipd}, 
-                                     columns=colsIPDs)
-        dfIPDs=dfIPDs.append(alldata3)    
-        
-        #***add analysis to dataframe***
-        # calculated info about image, peaks, and IPDs
-        frame = pandas.DataFrame([[date, x, prepID, strain, nsID, tiv,         # 'Date','ImageID','Prep ID','Strain','NS ID','tiv' 
-                                   pattern_geom, surface_proteins,             # 'pattern_geom','surface_proteins', 
-                                   imsize[1], dist[-1], np.mean(nf),           # 'Image size','Max neurite length','Average neurite intensity'
-                                   len(pd), len(pd)/dist[-1],                  # 'Total peaks', 'Average Peaks per Micron'                                    
-                                   np.mean(pmi),                               # 'Average peak intensity'
-                                   np.mean(peaks[1]['widths']*muperpx),        # 'Average peak width'
-                                   np.mean(ipd), np.median(ipd),
-                                   qTh,mean,median,stdSS,n,minHeight,prom]],             # 'Average ipd','Median ipd'
-                                   columns=colsAnalysis)
-        dfAnalysis = dfAnalysis.append(frame)
-        
-        #   ***     Create image specific analysis file    ****
-        
-        # Set main figure properties
-        SMALL_SIZE = 4
-        MEDIUM_SIZE = 6
-        BIGGER_SIZE = 8
-        plt.style.use('dark_background')
-        plt.rc('font', size=MEDIUM_SIZE)          # controls default text sizes
-        plt.rc('axes', titlesize=MEDIUM_SIZE)     # fontsize of the axes title
-        plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
-        plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-        plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-        plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
-        plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
-        fig, axes = plt.subplots(3, 2, dpi=300,figsize=(6.5,4.5))
-        ((ax1, ax2),(ax3,ax4),(ax5,ax6)) = axes
-        fig.suptitle(x+'\nAnalysis '+timestamp+'\nProminence = '+str(round(prom,2))+' Min Height = '+str(round(minHeight)))
-        plt.subplots_adjust(top = 0.99, bottom=0.01, hspace=.5, wspace=0.4)
-    
-        # Plot #1 is the raw image
-        ax1 = plt.subplot(311)                                                  #subplot(nrows, ncols, index, **kwargs)
-        ax1.set_title('Raw Image')
-        # Shift the plot down so that it doesn't overlap with the title
-        box = ax1.get_position()
-        box.y0 = box.y0 - 0.1
-        box.y1 = box.y1 - 0.1
-        ax1.set_position(box)
-        ax1.set_ylim((0,pxTot)) 
-        ax1.set_yticks((pxBgndSize/2,pxTot/2,pxTot-(pxBgndSize/2)))
-        labels = ['Background','Neurite','Background']
-        ax1.yaxis.set_ticklabels(labels,position=(0,.05))
-        ax1.set_xlabel('Pixel Index')
-        ax1.hlines((inB2,inN1,inN2,inB3),0,imsize[1],color='w', linewidth =.2,linestyles= 'dashed')
-        ax1.imshow(img, vmin=0,vmax=180)
-        
-        # Plot #2 is the histogram of pixel intensities
-        ax3 = plt.subplot(323)
-        ax3.set_title('Distribution of Pixel Intensities')
-        ax3.set_xlabel('Pixel Intensity (AU)')
-        ax3.set_ylabel('Pixel Count')
-        n_bins = 25
-        N, bins, patches = ax3.hist(nf, bins=n_bins)
-        ax3.set_ylim((0,N.max()*1.1))
-        p1 = plt.vlines(qTh, 0, N.max()*1.1, color='w',linewidth=.25)
-        p2 = plt.vlines(minHeight, 0, N.max()*1.1, color='m',linewidth=.25)
-        p3 = plt.vlines(prom, 0, N.max()*1.1, color='b',linewidth=.25)
-        # N is the count in each bin, bins is the lower-limit of the bin
-        # We'll color code by height, but you could use any scalar
-        fracs = N / N.max()
-        # we need to normalize the data to 0..1 for the full range of the colormap
-        norm = colors.Normalize(fracs.min(), fracs.max())
-        # Now, we'll loop through our objects and set the color of each accordingly
-        for thisfrac, thispatch in zip(fracs, patches):
-            color = plt.cm.viridis(norm(thisfrac))
-            thispatch.set_facecolor(color)
-        plt.legend((p1,p2,p3), 
-                   ('Third Quartile', 'Minimum Height','Prominence'),  loc='upper right', bbox_to_anchor=(1,1))    
-        
-        # Plot #3 is the raw background and neurite signal
-        ax4 = plt.subplot(324)
-        ax4.set_title('Mean Pixel Intensity for Region of Interest')
-        ax4.set_xlabel('Distance (um)')
-        ax4.set_ylabel('Intensity (AU)')
-        ax4.set_xlim(0,max(dist))
-        ax4.set_ylim(0,max(rawf)*1.1)
-        plt.yticks([0,round((max(rawf)*1.1)/2,-1),round((max(rawf)*1.1),-1)])
-        p4 = plt.plot(dist, bgf, 'c-')
-        p5 = plt.plot(dist, rawf, 'g-')
-        plt.legend((p4[0], p5[0]), 
-                   ('Background', 'Neurite'),  loc='best', bbox_to_anchor=(1,1))
-        
-        #Plot #4 is the corrected neurite signal with identified peaks
-        ax5 = plt.subplot(313)
-        ax5.set_title('Identified Peaks')
-        plt.xlabel('Distance (um)')
-        plt.ylabel('Intensity (AU)')
-        ax5.set_ylim(0,max(nf)*1.1)
-        ax5.set_xlim(0,max(dist))
-        plt.yticks([0,round((max(nf)*1.1)/2,-1),round((max(nf)*1.1),-1)])
-        p6 = plt.plot(dist, np.array([minHeight for i in xrange(len(dist))]), 'm-')
-        p7 = plt.plot(dist, nf, 'b-')
-        p8 = plt.plot(pd, pmi, 'mo',markersize=4)
-        plt.legend((p6[0],p7[0], p8[0]), ('Minimum Height', 
-                    'Corrected Neurite Signal', 'Identified Peak'), 
-                    loc='upper right', bbox_to_anchor=(1,1))
-        
-        plt.savefig(pathRes+x[:-4]+'_pf.png',  bbox_inches='tight', 
-                    dpi = 300,  
-                    format = "png")
-               
-        plt.close()
-  
-    #END ANALYSIS#    
-
-#***store user-specified and analysis parameters***
-dfParameters = pandas.DataFrame(data={'1. Date of analysis':today, 
-                                       '2. Time of analysis':now, 
-                                       '3. Microns per pixel':muperpx, 
-                                       '4. Script name':f}, 
-                                        index=[0])
-                              
-#OUTPUT DATAFRAMES AS SHEETS IN EXCEL FILE
-wb = pandas.ExcelWriter(pathRes+fnRes, engine='xlsxwriter')
-dfData.to_excel(wb, sheet_name='Data')
-dfPeaks.to_excel(wb, sheet_name='Peaks')
-dfIPDs.to_excel(wb, sheet_name='IPDs')
-dfAnalysis.to_excel(wb, sheet_name='Analysis')
-dfExclusions.to_excel(wb, sheet_name='Exclusions')
-dfPixInd.to_excel(wb,sheet_name='Pixel Indices')
-dfParameters.to_excel(wb, sheet_name='Parameters')
-wb.save()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        start = clocks()
+        prof = batch_profiles([imgs[i] for i in inds], pxN, pxB)
+        tProf = elapsed(start)
+        start = clocks()
+        th = batch_thresholds(prof['nf'], nsParams['peakParams']['heightSD'])
+        tTh = elapsed(start)
+        # Batch times are shared equally by the images of the batch
+        for j, i in enumerate(inds):
+            timing[i]['profile'] = [t/len(inds) for t in tProf]
+            timing[i]['threshold'] = [t/len(inds) for t in tTh]
+            timing[i]['pixels'] = int(prof['widths'][j])*nRows
+        groups.append((inds, [imgs[i] for i in inds], prof, th))
+    return groups, reads, hashes, errors
+
+
+def analyze_images(batch, nsParams, hashImages=False):
+    """Finds the puncta in a batch of straightened neurite images.
+
+    batch is a list of (x, md) pairs where x is the image file name inside
+    nsParams['dirNS'] and md holds the colsMetaD values for it. The images
+    are profiled together (see profile_images); only find_peaks is done one
+    image at a time. Returns a list of (x, result, error) in batch order.
+    result is the dict described in analyze_image, or None if the image could
+    not be analyzed, in which case error holds the traceback text. With
+    hashImages each result also gets the image file's (stat_signature,
+    pixels_sha1) as 'hash' for the result cache. Every result gets its stage
+    times as 'timing' (see PACC_Telemetry.py).
+    """
+    out = [None]*len(batch)
+    timing = {}
+    groups, reads, hashes, errors = profile_images(batch, nsParams, hashImages,
+                                                   timing)
+    for i in errors:
+        out[i] = (batch[i][0], None, errors[i])
+    for inds, imgs, prof, th in groups:
+        for j, i in enumerate(inds):
+            x, md = batch[i]
+            start = clocks()
+            try:
+                if prof is None:
+                    res = tiled_result(x, md, array_tiles(imgs[j]), nsParams,
+                                       timing[i])
+                else:
+                    res = image_result(x, md, imgs[j], prof, th, j, nsParams)
+                    timing[i]['find_peaks'] = elapsed(start)
+                res['io'] = reads[i]
+                if hashImages:
+                    res['hash'] = hashes[i]
+                timing[i]['process_maxrss_mb'] = process_maxrss_mb()
+                res['timing'] = timing[i]
+                out[i] = (x, res, None)
+            except Exception:
+                out[i] = (x, None, traceback.format_exc())
+    return out
+
+
+def analyze_image(x, md, nsParams):
+    """Finds the puncta in one straightened neurite image.
+
+    x is the image file name inside nsParams['dirNS'] and md holds the
+    colsMetaD values for it. Returns a dict with the image metadata ('meta',
+    the colsImage values), this image's columns for the Data, Peaks, IPDs and
+    Analysis sheets, ready for PACC_Records.ResultTables, and how the image
+    was read ('io', see PACC_ImageIO.read_channel). QC figures are drawn
+    separately from these results (see PACC_Figures.py).
+    """
+    x, res, err = analyze_images([(x, md)], nsParams)[0]
+    if err is not None:
+        raise RuntimeError("Image "+x+" could not be analyzed:\n"+err)
+    return res
+
+
+def image_result(x, md, img, prof, th, j, nsParams):
+    """Finds the peaks of image j of a profiled batch & builds its result.
+
+    prof and th are the outputs of batch_profiles and batch_thresholds.
+    """
+    muperpx = nsParams['muperpx']
+
+    # ADD IMAGE DATA TO DATA FRAME
+    # Calculate image size
+    imsize = np.shape(img)
+    w = imsize[1]
+    #***setup horizontal axes to represent image columns**
+    d=np.arange(imsize[1])                                                     #Array of integers to represent pixels along image (aka image columns)
+    dist = d*muperpx                                                           #Generate array of physical distances along image based on um:pix conversion factor
+    normdist=dist/dist[-1]                                                     #Create a normalized axis to represent positions along image as 0->1
+    #***get this image's profiles out of the batch (copies, so the batch
+    #   arrays can be freed)***
+    rawf = prof['rawf'][j, :w].copy()                                          #Average raw neurite fluorescence
+    bgf = prof['bgf'][j, :w].copy()                                            #Average raw background fluorescence
+    nf = prof['nf'][j, :w].copy()                                              #Background subtracted neurite fluorescence, negatives set to zero
+    annf = prof['annf'][j, :w].copy()                                          #Average normalized neurite fluorescencece
+    mnnf = prof['mnnf'][j, :w].copy()
+    #***add image data to the Data table***
+    data = {'distance':dist,
+            'normalized_distance':normdist,
+            'raw_intensity':rawf,
+            'background_intensity':bgf,
+            'neurite_intensity':nf,
+            'avg_norm_neu_int':annf,
+            'max_norm_neu_int':mnnf}
+
+    # DETERMINE PEAK LOCATIONS
+    # Minimum height and prominence values from batch_thresholds:
+    #   minHeight = mean+heightSD*std of the pixels below Q3, prom = pop std
+    thj = dict((k, th[k][j]) for k in ('qTh', 'mean', 'median', 'stdSS', 'n',
+                                       'minHeight', 'prom'))
+
+    #***find peaks***
+    peaks = find_peaks(nf, height=thj['minHeight'], prominence=thj['prom'],    #Relheight is used to calculate peak width, it is a % of peak prominence
+                       width=nsParams['peakParams']['width'],
+                       rel_height=nsParams['peakParams']['relHeight'])
+    return peak_result(x, md, nsParams, data, peaks[0], peaks[1]['widths'],
+                       thj, np.mean(nf))
+
+
+def peak_result(x, md, nsParams, data, peaks, widths, th, nfMean):
+    """Builds the Peaks, IPDs & Analysis tables of an image from its peaks.
+
+    data holds the image's Data columns, peaks & widths (in pixels) are the
+    find_peaks results and th the image's thresholds (the batch_thresholds
+    keys, one value each). nfMean is the mean of neurite_intensity.
+    """
+    muperpx = nsParams['muperpx']
+    dist = data['distance']
+    nf = data['neurite_intensity']
+    mnnf = data['max_norm_neu_int']
+    length = dist[-1]
+    pd = peaks*muperpx                                                         #Convert pixel distances to physical distances
+    pnd = pd/length                                                            #Calculated normalized physical distances (0->1)
+    pmi = np.asarray(nf[peaks])                                                #Get intensity for each punctum location
+    pmi_norm = np.asarray(mnnf[peaks])                                         #Get max normalized intensity for each punctum location
+    #***calculate punctum spacing***
+    ipd = np.diff(pd)                                                          #Here, .diff() returns physical distance between puncta
+    ipdd = pd[:-1]+ipd/2                                                       #Inter-punctum interval:
+    ipdnd = ipdd/length
+    #***add peak data to the Peaks table***
+    peaksData = {'distance':pd,
+                 'normalized_distance':pnd,
+                 'punctum_max_intensity':pmi,
+                 'norm_punctum_max_int':pmi_norm,
+                 'punctum_width':widths*muperpx}
+    #***add Inter-punctum data to the IPDs table***
+    ipdsData = {'distance':ipdd,
+                'normalized_distance':ipdnd,
+                'inter-punctum_interval':ipd}
+
+    #***add analysis to the Analysis table***
+    # calculated info about image, peaks, and IPDs
+    analysis = {'image_size':len(dist),
+                'max_neurite_length':length,
+                'average_neurite_intensity':nfMean,
+                'total_peaks':len(pd),
+                'average_peaks_per_micron':len(pd)/length,
+                'average_peak_intensity':np.mean(pmi),
+                'average_peak_width':np.mean(widths*muperpx),
+                'average_ipd':np.mean(ipd),
+                'median_ipd':np.median(ipd),
+                'qTh':th['qTh'],
+                'ss_mean':th['mean'],
+                'ss_median':th['median'],
+                'ss_std':th['stdSS'],
+                'ss_n':th['n'],
+                'min_height':th['minHeight'],
+                'prominence':th['prom']}
+
+    return {'meta': image_meta(x, md, nsParams), 'Data': data,
+            'Peaks': peaksData, 'IPDs': ipdsData, 'Analysis': analysis}
+
+
+def tiled_result(x, md, tiles, nsParams, timing=None):
+    """Analyzes one long neurite tile by tile (see PACC_Tiles.py).
+
+    tiles is an iterable of the neurite's column tiles in order. Returns the
+    same result as image_result; its Data columns are copied out of the
+    temporary profile file, which is deleted before returning. If a timing
+    dict is given it gets the (wall, CPU) seconds of the 'profile',
+    'threshold' and 'find_peaks' stages.
+    """
+    if timing is None:
+        timing = {}
+    start = clocks()
+    with TiledProfile(tiles, nsParams['pxN'], nsParams['pxB'],
+                      nsParams['muperpx']) as profile:
+        timing['profile'] = elapsed(start)
+        start = clocks()
+        th = tiled_thresholds(profile, nsParams['peakParams']['heightSD'])
+        timing['threshold'] = elapsed(start)
+        start = clocks()
+        peaks, widths = tiled_find_peaks(profile.data['neurite_intensity'],
+                                         th['minHeight'], th['prom'],
+                                         nsParams['peakParams']['width'],
+                                         nsParams['peakParams']['relHeight'])
+        data = dict((name, np.array(v)) for name, v in profile.data.items())
+        res = peak_result(x, md, nsParams, data, peaks, widths, th,
+                          profile.nf.mean)
+        timing['find_peaks'] = elapsed(start)
+        width = profile.width
+    timing['pixels'] = width*(nsParams['pxN'][1]-nsParams['pxN'][0]+
+                              nsParams['pxB'][1]-nsParams['pxB'][0]+
+                              nsParams['pxB'][3]-nsParams['pxB'][2])
+    return res
+
+
+def analyze_stitched(x, md, paths, nsParams):
+    """Analyzes a neurite stitched from several straightened images.
+
+    paths are the image files in order along the neurite (all with the
+    line_width of the NS); they are read one at a time and the neurite is
+    analyzed in tiles (see PACC_Tiles.py). x is the image_id of the result,
+    which is the same dict as analyze_image's. Memory grows with the longest
+    file and the Data table of the result, which is held in memory, is as
+    long as the whole neurite.
+    """
+    rows = sampled_rows(nsParams)
+    io = {}
+    timing = {}                                                                # The files are read during the 'profile' stage
+    res = tiled_result(x, md, file_tiles(paths, nsParams['CH'], rows, io=io),
+                       nsParams, timing)
+    timing['process_maxrss_mb'] = process_maxrss_mb()
+    res['io'] = io
+    res['timing'] = timing
+    return res
+
+
+def image_meta(x, md, nsParams):
+    """Returns the colsImage values that go on every row of an image."""
+    return {'date':md['date'],
+            'image_id':x,
+            'prep_id':nsParams['prepID'],
+            'strain':md['strain'],
+            'ns_id':nsParams['nsID'],
+            'tiv':md['tiv'],
+            'pattern_geom':md['pattern_geom'],
+            'surface_proteins':md['surface_proteins']}
+
+
+def sampled_rows(nsParams):
+    """Returns the (start, end) row bands the analysis reads (background,
+    neurite, background)."""
+    pxN, pxB = nsParams['pxN'], nsParams['pxB']
+    return [(pxB[0], pxB[1]), (pxN[0], pxN[1]), (pxB[2], pxB[3])]
+
+
+def cache_view(nsParams):
+    """Returns the channel & row bands of the hashed pixels of an image."""
+    return (int(nsParams['CH']),
+            tuple((int(r0), int(r1)) for r0, r1 in sampled_rows(nsParams)))
+
+
+def cache_params(nsParams):
+    """Returns the analysis settings that are part of an image's cache key."""
+    return (('CH', int(nsParams['CH'])),
+            ('muperpx', float(nsParams['muperpx'])),
+            ('pxTot', int(nsParams['pxTot'])),
+            ('pxN', tuple(int(i) for i in nsParams['pxN'])),
+            ('pxB', tuple(int(i) for i in nsParams['pxB'])),
+            ('peakParams', tuple(sorted(nsParams['peakParams'].items()))),
+            ('tiledLength', None if nsParams.get('tiledLength') is None else
+             int(nsParams['tiledLength'])))
+
+
+def plan_cached(batch, nsParams, cache):
+    """Returns the cache key of each image in batch (None = analyze it)."""
+    params = cache_params(nsParams)
+    view = cache_view(nsParams)
+    keys = []
+    for x, md in batch:
+        contentHash = cache.known_hash(nsParams['dirNS']+x, view)
+        key = None
+        if contentHash is not None:
+            key = cache.key(contentHash, params)
+            if not cache.has(key):
+                key = None
+        keys.append(key)
+    return keys
+
+
+def merge_cached(batch, keys, analyzed, nsParams, cache):
+    """Combines cached and newly analyzed results in batch order.
+
+    keys is from plan_cached and analyzed is the analyze_images(...,
+    hashImages=True) output for the images whose key is None. New results
+    are added to the cache. Cached results get 'read_method' 'cache'. Every
+    result that is in the cache gets its key as 'cache_key' (the renderer
+    caches its figure under it, see PACC_Figures.FigureRenderer).
+    """
+    params = cache_params(nsParams)
+    view = cache_view(nsParams)
+    out = []
+    analyzed = iter(analyzed)
+    for (x, md), key in zip(batch, keys):
+        res = cache.get(key) if key is not None else None
+        if res is None:
+            if key is None:
+                x, res, err = next(analyzed)
+            else:
+                x, res, err = analyze_images([(x, md)], nsParams, True)[0]     # Entry was evicted since plan_cached
+            if err is None:
+                sig, contentHash = res['hash']
+                newKey = cache.key(contentHash, params)
+                cache.remember_hash(nsParams['dirNS']+x, view, contentHash,
+                                    sig, newKey)
+                if not cache.has(newKey):                                      # Same pixels as a cached image (e.g. a touched file)
+                    cache.put(newKey, dict((name, res[name]) for name, cols in
+                                           tablesResults))
+                res['cache_key'] = newKey
+            out.append((x, res, err))
+        else:
+            res['meta'] = image_meta(x, md, nsParams)
+            res['io'] = {'bytes_read': 0, 'read_method': 'cache'}
+            res['cache_key'] = key
+            out.append((x, res, None))
+    return out
+
+
+def analyze_batch(batch, nsParams, cache=None):
+    """analyze_images, reusing cached results when a ResultCache is given."""
+    if cache is None:
+        return analyze_images(batch, nsParams)
+    keys = plan_cached(batch, nsParams, cache)
+    misses = [task for task, key in zip(batch, keys) if key is None]
+    return merge_cached(batch, keys, analyze_images(misses, nsParams, True),
+                        nsParams, cache)
+
+
+def compact_tables(tables, compact=None):
+    """Returns the names of the Data tables ('Data', 'Data.<channel>') that
+    are kept compact (see PACC_Records.CompactTable)."""
+    if compact is None:
+        compact = compactData
+    return [name for name, cols in tables
+            if compact and name.split('.')[0] == 'Data']
+
+
+def open_output(pathRes, fnBase, outputFormat='excel', excelSummary=True,
+                tables=tablesResults, summaryTables=('Analysis',),
+                compactData=None):
+    """Returns the output backend (see PACC_Output.py) for a neurite set.
+
+    outputFormat is 'excel' for the full workbook or 'parquet' to stream the
+    per-image tables to Parquet with an optional Excel summary (holding
+    summaryTables and the end-of-run sheets). compactData (default: the
+    module setting) keeps the Data tables compact until they are written.
+    """
+    compact = compact_tables(tables, compactData)
+    if outputFormat == 'excel':
+        return ExcelOutput(pathRes, fnBase, tables, colsImage, compact)
+    elif outputFormat == 'parquet':
+        return ParquetOutput(pathRes, fnBase, tables, colsImage,
+                             excelSummary=excelSummary,
+                             summaryTables=summaryTables,
+                             compactTables=compact)
+    raise ValueError("Unknown output format '"+str(outputFormat)+"'")
+
+
+def write_readme(pathRes, prepID, timestamp, rdmeNote):
+    """Outputs the text file that describes the analysis run."""
+    rdmeFile = open(pathRes+prepID+"_AnalysisRDME."+timestamp+".txt","w+")
+    rdmeFile.writelines(rdmeNote)
+    rdmeFile.close() #to change file access modes
+
+
+def write_results(output, dfExclusions, dfPixInd, today, now, muperpx,
+                  telemetry=None):
+    """Adds the end-of-run sheets to the output and closes it.
+
+    With a Telemetry the stage & counter table is added as a Telemetry sheet.
+    """
+    #***store user-specified and analysis parameters***
+    f = os.path.basename(__file__)                                             # Store filename of *.py analysis code
+    dfParameters = pandas.DataFrame(data={'1. Date of analysis':today,
+                                           '2. Time of analysis':now,
+                                           '3. Microns per pixel':muperpx,
+                                           '4. Script name':f},
+                                            index=[0])
+
+    #OUTPUT DATAFRAMES
+    sheets = [('Exclusions', dfExclusions),
+              ('Pixel Indices', dfPixInd),
+              ('Parameters', dfParameters)]
+    if telemetry is not None:
+        sheets.append(('Telemetry', telemetry.sheet()))
+    output.close(sheets)
+
+
+def analyzed_batches(tasks, nsParams, channel, cache=None, telemetry=None,
+                     batchSize=batchSize):
+    """Source of analyzed batches for run_analysis: the tasks of one channel
+    (see prepare_neurite_set) analyzed batchSize images at a time in this
+    process, reusing cached results when a ResultCache is given."""
+    if telemetry is None:
+        telemetry = Telemetry(profile=[])
+    for iB in range(0, len(tasks), batchSize):
+        with telemetry.stage('analyze'):
+            batchRes = analyze_batch(tasks[iB:iB+batchSize], nsParams, cache)
+        yield channel_batch(batchRes, channel)
+
+
+def stitched_batches(tasks, nsParams, channel, telemetry=None):
+    """Source of analyzed batches for run_analysis: all tasks of one channel
+    analyzed as one neurite stitched in task order (see analyze_stitched).
+    The result is named <prep>_<NS>.<chExt>.stitched and gets the metadata
+    of the first image."""
+    if telemetry is None:
+        telemetry = Telemetry(profile=[])
+    if not tasks:
+        return
+    x = (nsParams['prepID']+'_'+nsParams['nsID']+'.'+nsParams['chExt']+
+         '.stitched')
+    with telemetry.stage('analyze'):
+        try:
+            res, err = analyze_stitched(x, tasks[0][1],
+                                        [nsParams['dirNS']+f for f, md in
+                                         tasks], nsParams), None
+        except Exception:
+            res, err = None, traceback.format_exc()
+    yield channel_batch([(x, res, err)], channel)
+
+
+def channel_batch(batchRes, channel):
+    """Turns the (x, res, err) list of analyze_batch into a run_analysis
+    batch."""
+    return [(x, {channel: (x, res, err)}, None) for x, res, err in batchRes]
+
+
+def run_analysis(batches, nsParamsByCh, output, renderer, telemetry,
+                 rename=None, flush=False, verbose=False, done=None):
+    """The analysis engine: adds analyzed images to the output & figures.
+
+    batches is the file source, an iterable of analyzed batches (e.g.
+    analyzed_batches, PACC_Channels.analyzed_pairs or the watch and batch
+    schedulers). A batch is a list of (key, results, coloc) where results
+    maps each channel to the (x, res, err) of its image and coloc is None or
+    a PACC_Channels.colocalize result. nsParamsByCh maps each channel to its
+    nsParams. Every result is recorded in telemetry, added to output (as
+    rename(res, channel) if given, e.g. PACC_Channels.channel_result) and
+    submitted to renderer; images that could not be analyzed or stored are
+    reported and counted as 'failed_images'. With flush the output is flushed
+    after every batch, with verbose every image is reported. done, if given,
+    is called with the key of every item once it has been handled.
+    """
+    for batch in batches:
+        for key, results, coloc in batch:
+            for channel, (x, res, err) in results.items():
+                if err is not None:
+                    print("Error. Image "+x+" could not be analyzed:\n"+err)
+                    telemetry.count('failed_images')
+                    continue
+                try:
+                    telemetry.add_image(res)
+                    with telemetry.stage('output'):
+                        output.add(res if rename is None else
+                                   rename(res, channel))                       # Parquet output is written as images are analyzed
+                    with telemetry.stage('figures'):
+                        renderer.submit(res, nsParamsByCh[channel])            # Figures are drawn while the analysis continues
+                except Exception as e:
+                    print("Error. Results for image "+x+" could not be"
+                          " stored: "+repr(e))
+                    telemetry.count('failed_images')
+                    continue
+                if verbose:
+                    a = res['Analysis']
+                    print("Analyzed "+x+": "+str(a['total_peaks'])+" puncta, "+
+                          str(round(a['average_peaks_per_micron'], 3))+"/um")
+            if coloc is not None:
+                with telemetry.stage('output'):
+                    output.add(coloc)
+                telemetry.count('colocalized_puncta',
+                                coloc['Colocalization.Analysis']
+                                ['colocalized_puncta'])
+            if done is not None:
+                done(key)
+        if flush:
+            with telemetry.stage('output'):
+                output.flush()
+
+
+def analyze_neurite_set(dirCCPs, prepID, nsID, channel='green', pathRes=None,
+                        outputFormat='excel', excelSummary=True,
+                        figureMode='all', figureProcesses=None, cache=None,
+                        rdmeNote=None, batchSize=batchSize, store=None,
+                        compactData=None, stitch=False):
+    """Analyzes one neurite set & writes its results.
+
+    pathRes defaults to dirCCPs/<prep>/Analysis/<timestamp>/. outputFormat,
+    excelSummary and compactData are passed to open_output, figureMode and
+    figureProcesses to PACC_Figures.FigureRenderer. With a ResultCache only
+    new or changed images are analyzed. With a PACC_Store.ResultStore the run
+    is also added to the results store. With stitch the images of the NS are
+    analyzed as one neurite stitched in file name order (see
+    stitched_batches); the cache is not used and no QC figure is drawn.
+    Returns a dict with the pathRes,
+    fnRes (output file name without extension), the number of 'images' and
+    'failed_images', the 'flagged' images and the run's 'telemetry'.
+    """
+    # *** GET TIME OF ANALYSIS START ***
+    today, now, timestamp = get_timestamp()
+    CH, chExt = CHANNELS[channel]
+    telemetry = Telemetry()                                                    # Set PACC_PROFILE=cprofile,tracemalloc to profile the run
+    telemetry.start()
+
+    #       ****        WHERE TO STORE RESULTS         ****
+    if pathRes is None:
+        dirPrep = dirCCPs+prepID+"/"                                           # Location where all prep-specific data is stored
+        pathRes = dirPrep+"Analysis/"+timestamp+'/'
+    pathRes = os.path.join(pathRes, '')
+    if not os.path.isdir(pathRes):
+        os.makedirs(pathRes)                                                   # Output locataion for final excel workbook
+    fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+timestamp                   # Output file name (without extension)
+
+    #      ***   OUTPUT TEXT FILE TO DESCRIBE ANALYSIS RUN
+    if rdmeNote is None:
+        rdmeNote = [channel.capitalize()+" channel analysis"]
+    write_readme(pathRes, prepID, timestamp, rdmeNote)
+
+    #       ***       IMPORT METADATA FOR ANALYSIS      ***
+    with telemetry.stage('prepare'):
+        nsParams, tasks, dfExclusions, dfPixInd = prepare_neurite_set(
+                dirCCPs, prepID, nsID, CH, chExt, pathRes, timestamp)
+
+    # *** MAIN PEAK FINDER ANALYSIS LOOP ***
+    output = open_output(pathRes, fnRes, outputFormat, excelSummary,
+                         compactData=compactData)
+    if store is not None:
+        output = TeeOutput([output, store.open_run(prepID, nsID, [channel],
+                                                   timestamp, pathRes)])
+    if stitch:
+        batches = stitched_batches(tasks, nsParams, channel, telemetry)
+        figureMode = 'none'                                                    # Figures read one whole image file
+    else:
+        batches = analyzed_batches(tasks, nsParams, channel, cache, telemetry,
+                                   batchSize)
+    renderer = FigureRenderer(figureMode, figureProcesses, cache=cache)
+    try:
+        run_analysis(batches, {channel: nsParams}, output, renderer,
+                     telemetry)
+        print("Read "+str(telemetry.counters['bytes_read'])+" bytes of image "
+              "data for "+str(telemetry.counters['images'])+" images")
+    finally:
+        with telemetry.stage('figures'):
+            renderer.close()
+    for x, reasons in renderer.flagged:
+        print("Flagged "+x+": "+', '.join(reasons))
+
+    with telemetry.stage('write'):
+        write_results(output, dfExclusions, dfPixInd, today, now,
+                      nsParams['muperpx'], telemetry)
+    telemetry.stop(pathRes, prepID, timestamp)
+    telemetry.write(pathRes, prepID, timestamp)
+    return {'pathRes': pathRes, 'fnRes': fnRes,
+            'images': telemetry.counters['images'],
+            'failed_images': telemetry.counters['failed_images'],
+            'flagged': renderer.flagged, 'telemetry': telemetry}
+
+
+def add_run_arguments(parser, output=None, note=None):
+    """Adds the command-line options shared by the PACC scripts.
+
+    The defaults are this module's settings; output and note override the
+    default output format and run note of a script.
+    """
+    parser.add_argument('--ccps', default=dirCCPs,
+                        help='directory holding all CCP preps')
+    parser.add_argument('--output', choices=['excel', 'parquet'],
+                        default=output or outputFormat,
+                        help='excel = one workbook per run, parquet = stream '
+                             'the per-image tables to Parquet files')
+    parser.add_argument('--no-excel-summary', action='store_true',
+                        default=not excelSummary,
+                        help='with --output parquet, skip the summary workbook')
+    parser.add_argument('--full-data', action='store_true',
+                        default=not compactData,
+                        help='keep the Data table as float64 with metadata on '
+                             'every row until it is written (more memory)')
+    parser.add_argument('--figures', choices=sorted(FIGURE_MODES),
+                        default=figureMode,
+                        help='QC figures: all, preview (low dpi), flagged '
+                             '(only suspicious images) or none')
+    parser.add_argument('--figure-processes', type=int,
+                        default=figureProcesses,
+                        help='processes drawing figures (default: the CPUs '
+                             'not used by the analysis, at least 1; 0 = draw '
+                             'in the analyzing process)')
+    parser.add_argument('--cache', default=None,
+                        help='result cache directory (default: <ccps>/'
+                             'PACC_Cache/)')
+    parser.add_argument('--no-cache', action='store_true',
+                        default=dirCache is None,
+                        help='analyze every image again')
+    parser.add_argument('--cache-max-gb', type=float, default=cacheMaxGB,
+                        help='size above which old cached results are deleted')
+    parser.add_argument('--db', default=dbResults,
+                        help='SQLite results store that also gets every run '
+                             '(see PACC_Store.py)')
+    parser.add_argument('--note', default=note,
+                        help='note stored with the analysis run')
+
+
+def add_neurite_set_arguments(parser, channels):
+    """Adds the options choosing one neurite set & its channels (channels is
+    the default list)."""
+    from PACC_Channels import colocDistance
+    parser.add_argument('--prep', default=prepID,
+                        help='cell-culture prep, e.g. CCP_127')
+    parser.add_argument('--ns', default=nsID,
+                        help='neurite set, e.g. NS_02.01')
+    parser.add_argument('--channel', choices=sorted(CHANNELS), nargs='+',
+                        default=channels,
+                        help='channel(s) to analyze; with green & red both are '
+                             'analyzed in one pass & their puncta matched '
+                             '(see PACC_Channels.py)')
+    parser.add_argument('--coloc-distance', type=float, default=colocDistance,
+                        help='max distance (um) of colocalized puncta')
+    parser.add_argument('--out-dir', default=None,
+                        help='results directory (default: <ccps>/<prep>/'
+                             'Analysis/<timestamp>/)')
+
+
+def open_resources(args):
+    """Returns (dirCCPs, cache, store) for options from add_run_arguments."""
+    dirCCPs = os.path.join(args.ccps, '')
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache or dirCCPs+'PACC_Cache/',
+                            int(args.cache_max_gb*2**30))
+    store = None
+    if args.db:
+        from PACC_Store import ResultStore
+        store = ResultStore(args.db)
+    return dirCCPs, cache, store
+
+
+def close_resources(cache, store):
+    """Closes the cache & results store from open_resources."""
+    if store is not None:
+        store.close()
+    if cache is not None:
+        cache.close()
+        print("Reused "+str(cache.hits)+" cached image results")
+
+
+if __name__ == '__main__':
+    channelDefault = [c for c in sorted(CHANNELS) if CHANNELS[c] == (CH, chExt)]
+    parser = argparse.ArgumentParser(description='PACC peak finding for one '
+                                     'neurite set.')
+    add_run_arguments(parser)
+    add_neurite_set_arguments(parser, channelDefault or ['green'])
+    parser.add_argument('--batch-size', type=int, default=batchSize,
+                        help='images profiled together')
+    parser.add_argument('--stitch', action='store_true',
+                        help='analyze the images of the NS as one neurite '
+                             'stitched in file name order, in tiles (one '
+                             'channel; no cache or QC figures)')
+    args = parser.parse_args()
+    channels = list(dict.fromkeys(args.channel))                               # Drop repeats, keep order
+    if args.stitch and len(channels) > 1:
+        parser.error('--stitch analyzes one channel at a time')
+
+    dirCCPs, cache, store = open_resources(args)
+    try:
+        if len(channels) == 1:
+            run = analyze_neurite_set(
+                dirCCPs, args.prep, args.ns, channels[0], args.out_dir,
+                args.output, not args.no_excel_summary, args.figures,
+                args.figure_processes, cache,
+                [args.note] if args.note else
+                (rdmeNote if channels == channelDefault else None),
+                args.batch_size, store, not args.full_data, args.stitch)
+        else:
+            from PACC_Channels import analyze_channels
+            run = analyze_channels(
+                dirCCPs, args.prep, args.ns, channels, args.out_dir,
+                args.output, not args.no_excel_summary, args.figures,
+                args.figure_processes, cache,
+                [args.note] if args.note else None, args.batch_size,
+                args.coloc_distance, store, not args.full_data)
+    finally:
+        close_resources(cache, store)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Profiles.py
+
+Vectorized profile engine for PACC_PeakFinder. All straightened images of a
+neurite set have the same number of rows (line_width), only their lengths
+differ. A batch of images is therefore stacked into one zero-padded 3D array
+(image, row, column) and every step up to the peak thresholds is a single
+NumPy reduction over the whole batch:
+
+    1. Average raw neurite and background fluorescence per column
+    2. Background subtraction, normalization & clamping negatives to zero
+    3. Q3 of the corrected signal, the mean/median/std/count of the pixels
+       below Q3, the population std, minimum height and prominence
+
+Columns past the end of an image are NaN in every profile so that they drop
+out of the statistics. The statistics match pandas' describe(): percentiles
+use linear interpolation and standard deviations use ddof=1.
+
+Only scipy's find_peaks is still run per profile (see PACC_PeakFinder).
+"""
+#LIBRARIES
+import numpy as np
+
+
+def stack_images(imgs):
+    """Stacks 2D images of equal height into a zero-padded 3D float array.
+
+    Returns (stack, widths) where widths holds the length of each image.
+    """
+    widths = np.array([np.shape(img)[1] for img in imgs], dtype=np.intp)
+    heights = set(np.shape(img)[0] for img in imgs)
+    if len(heights) > 1:
+        raise ValueError("Images in a batch must have the same number of "
+                         "rows, got "+str(sorted(heights)))
+    stack = np.zeros((len(imgs), heights.pop(), widths.max()))
+    for i, img in enumerate(imgs):
+        stack[i, :, :widths[i]] = img
+    return stack, widths
+
+
+def batch_profiles(imgs, pxN, pxB):
+    """Calculates the intensity profiles for a batch of images.
+
+    pxN and pxB are the neurite and background row ranges from
+    PACC_PeakFinder.get_pixel_indices. Returns a dict of (image, column)
+    arrays, NaN past the end of each image: rawf (raw neurite), bgf
+    (background), nf (background subtracted, negatives set to zero), annf
+    (normalized to the mean) and mnnf (normalized to the max). annf and mnnf
+    are calculated before negatives are set to zero. 'widths' holds the
+    length of each image.
+    """
+    stack, widths = stack_images(imgs)
+    pad = np.arange(stack.shape[2])[np.newaxis, :] >= widths[:, np.newaxis]
+
+    #***break images up into background and neurite***
+    n = stack[:, pxN[0]:pxN[1], :]                                             #Extract neurite rows
+    bg = np.concatenate((stack[:, pxB[0]:pxB[1], :],                           #Extract background rows
+                         stack[:, pxB[2]:pxB[3], :]), axis=1)
+    #***calculate values for analysis***
+    rawf = np.mean(n, axis=1)                                                  #Average raw neurite fluorescence
+    bgf = np.mean(bg, axis=1)                                                  #Average raw background fluorescence
+    rawf[pad] = np.nan
+    bgf[pad] = np.nan
+    nf = rawf - bgf                                                            #Background subtracted neurite fluorescence
+    with np.errstate(divide='ignore', invalid='ignore'):
+        annf = nf/np.nanmean(nf, axis=1)[:, np.newaxis]                        #Average normalized neurite fluorescence
+        mnnf = nf/np.nanmax(nf, axis=1)[:, np.newaxis]                         #Max normalized neurite fluorescence
+    #***set negative nf values to zero (NaN padding is kept)
+    nf = np.where(nf < 0, 0., nf)
+    return {'rawf': rawf, 'bgf': bgf, 'nf': nf, 'annf': annf, 'mnnf': mnnf,
+            'widths': widths}
+
+
+def batch_thresholds(nf, heightSD=2):
+    """Calculates the peak finding thresholds for each row of nf.
+
+    nf is the NaN padded, background subtracted signal from batch_profiles.
+    Returns a dict of per-image arrays: qTh (third quartile), mean, median,
+    stdSS and n (stats of the pixels below Q3), minHeight (mean+heightSD*
+    stdSS) and prom (std of all pixels).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 1. Calculate Third Quartile for all image neurite pixels
+        qTh = np.nanpercentile(nf, 75, axis=1)
+        # 2. Create a subset of pixels that are below the third quartile
+        inSS = nf < qTh[:, np.newaxis]                                         # NaN padding is never in the subset
+        ss = np.where(inSS, nf, np.nan)
+        # 3. Calculate important stats for this subset
+        n = inSS.sum(axis=1).astype(float)
+        mean = np.where(inSS, nf, 0.).sum(axis=1)/n
+        dev = np.where(inSS, nf-mean[:, np.newaxis], 0.)
+        stdSS = np.sqrt((dev*dev).sum(axis=1)/(n-1))
+        stdSS[n < 2] = np.nan
+        median = np.full(len(n), np.nan)
+        hasSS = n > 0
+        if hasSS.any():
+            median[hasSS] = np.nanmedian(ss[hasSS], axis=1)
+        # 4. Use these statistics to calculate cutoff values
+        minHeight = mean+heightSD*stdSS
+        # 5. Use pop std to calculate prominence cutoff values
+        prom = np.nanstd(nf, axis=1, ddof=1)
+    return {'qTh': qTh, 'mean': mean, 'median': median, 'stdSS': stdSS,
+            'n': n, 'minHeight': minHeight, 'prom': prom}
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Records.py
+
+Accumulates the per-image results of PACC_PeakFinder into the output tables.
+
+Growing a dataframe with DataFrame.append copies the whole table for every
+image, which is quadratic in the number of images (and append no longer
+exists in recent pandas). Here each image only adds its NumPy arrays to a
+list of column chunks; the per-image metadata is stored once together with
+the number of rows it applies to. Every table is then built with a single
+concatenate per column when the neurite set is done.
+
+The tables keep the row index of the old append-based output, i.e. the row
+number within the image (the pixel column for the Data sheet).
+
+The per-pixel Data table is by far the largest, so it is kept in a compact,
+normalized form instead (CompactTable): every metadata value is stored once
+in a per-image lookup table, dictionary encoded, and the profile columns are
+contiguous float32 arrays with the offset of each image's first row. The
+denormalized table (metadata on every row) is only built when it is
+exported, and frames() builds it a slice of rows at a time.
+"""
+#LIBRARIES
+import numpy as np
+import pandas
+
+
+class RecordBuilder(object):
+    """Collects the rows of one output table, one image at a time.
+
+    columns is the table schema (e.g. colsPeaks). Columns listed in metaCols
+    hold one value per image; all other columns get one array per image.
+    """
+
+    def __init__(self, columns, metaCols):
+        self.columns = list(columns)
+        self.metaCols = [c for c in self.columns if c in metaCols]
+        self.valueCols = [c for c in self.columns if c not in metaCols]
+        self._meta = []                                                        # One tuple of metadata values per image
+        self._counts = []                                                      # Number of rows each image added
+        self._chunks = dict((c, []) for c in self.valueCols)
+        self.nRows = 0
+
+    def add(self, meta, values):
+        """Adds one image's rows.
+
+        meta maps every metadata column to its value and values maps every
+        other column to an array (or a scalar for one-row tables).
+        """
+        arrays = [np.atleast_1d(np.asarray(values[c])) for c in self.valueCols]
+        n = len(arrays[0]) if arrays else 1
+        for c, a in zip(self.valueCols, arrays):
+            if len(a) != n:
+                raise ValueError("Column "+c+" has "+str(len(a))+" rows, "
+                                 "expected "+str(n))
+            self._chunks[c].append(a)
+        self._meta.append(tuple(meta[c] for c in self.metaCols))
+        self._counts.append(n)
+        self.nRows += n
+
+    def __len__(self):
+        return self.nRows
+
+    def build(self):
+        """Returns the table as a dataframe with the columns in schema order."""
+        counts = np.array(self._counts, dtype=np.intp)
+        data = {}
+        for j, c in enumerate(self.metaCols):
+            vals = np.empty(len(self._meta), dtype=object)
+            vals[:] = [m[j] for m in self._meta]
+            data[c] = np.repeat(vals, counts)
+        for c in self.valueCols:
+            if self._chunks[c]:
+                data[c] = np.concatenate(self._chunks[c])
+            else:
+                data[c] = np.empty(0)
+        # Row number within each image, as produced by DataFrame.append
+        starts = np.cumsum(counts)-counts
+        index = np.arange(self.nRows)-np.repeat(starts, counts)
+        return pandas.DataFrame(data, columns=self.columns,
+                                index=index).infer_objects()
+
+
+class CompactTable(object):
+    """Collects the rows of a large table in a compact, normalized form.
+
+    Has the add/len/build interface of RecordBuilder. Each image gets an
+    integer image key (its order of addition); the metadata columns are
+    dictionary encoded once per image (image_table()) and every other column
+    is one contiguous array of dtype that grows as images are added, with
+    image key k owning rows offsets[k]:offsets[k+1].
+    """
+
+    def __init__(self, columns, metaCols, dtype=np.float32, capacity=4096):
+        self.columns = list(columns)
+        self.metaCols = [c for c in self.columns if c in metaCols]
+        self.valueCols = [c for c in self.columns if c not in metaCols]
+        self.dtype = np.dtype(dtype)
+        self._values = dict((c, np.empty(capacity, dtype=self.dtype))
+                            for c in self.valueCols)
+        self._categories = dict((c, []) for c in self.metaCols)               # Distinct values of each metadata column
+        self._lookup = dict((c, {}) for c in self.metaCols)                   # value -> code
+        self._codes = dict((c, []) for c in self.metaCols)                    # One code per image
+        self._offsets = [0]
+        self.nRows = 0
+
+    def _encode(self, c, v):
+        key = None if pandas.isnull(v) else v                                 # All missing values share one code
+        code = self._lookup[c].get(key)
+        if code is None:
+            code = len(self._categories[c])
+            self._lookup[c][key] = code
+            self._categories[c].append(v)
+        return code
+
+    def add(self, meta, values):
+        """Adds one image's rows (same arguments as RecordBuilder.add)."""
+        arrays = [np.atleast_1d(np.asarray(values[c])) for c in self.valueCols]
+        n = len(arrays[0]) if arrays else 1
+        for c, a in zip(self.valueCols, arrays):
+            if len(a) != n:
+                raise ValueError("Column "+c+" has "+str(len(a))+" rows, "
+                                 "expected "+str(n))
+        end = self.nRows+n
+        for c, a in zip(self.valueCols, arrays):
+            buf = self._values[c]
+            if end > len(buf):                                                 # Double the capacity (amortized O(1) per row)
+                grown = np.empty(max(end, 2*len(buf)), dtype=self.dtype)
+                grown[:self.nRows] = buf[:self.nRows]
+                self._values[c] = buf = grown
+            buf[self.nRows:end] = a
+        for c in self.metaCols:
+            self._codes[c].append(self._encode(c, meta[c]))
+        self._offsets.append(end)
+        self.nRows = end
+
+    def __len__(self):
+        return self.nRows
+
+    @property
+    def nImages(self):
+        return len(self._offsets)-1
+
+    @property
+    def offsets(self):
+        """Start row of every image key, plus the total number of rows."""
+        return np.array(self._offsets, dtype=np.int64)
+
+    def values(self, c):
+        """Returns the (read-only view of the) stored array of a column."""
+        v = self._values[c][:self.nRows]
+        v.flags.writeable = False
+        return v
+
+    def nbytes(self):
+        """Approximate memory held by the stored rows (excluding spare
+        capacity and the metadata values themselves)."""
+        return (self.nRows*self.dtype.itemsize*len(self.valueCols)+
+                self.nImages*(8+4*len(self.metaCols)))
+
+    def _meta_column(self, c, keys, categorical):
+        codes = np.asarray(self._codes[c], dtype=np.int32)[keys]
+        cats = np.empty(len(self._categories[c]), dtype=object)
+        cats[:] = self._categories[c]
+        if categorical:
+            valid = np.array([not pandas.isnull(v) for v in cats], dtype=bool)
+            # Missing values become code -1, the rest are renumbered
+            remap = np.where(valid, np.cumsum(valid)-1, -1)
+            categories = pandas.Index(cats[valid].tolist())
+            return pandas.Categorical.from_codes(remap[codes], categories)
+        return cats[codes]
+
+    def image_table(self, categorical=False):
+        """Returns the per-image lookup table: one row per image key with its
+        metadata columns, first row & number of rows."""
+        keys = np.arange(self.nImages)
+        offsets = self.offsets
+        data = dict((c, self._meta_column(c, keys, categorical)) for c in
+                    self.metaCols)
+        data['row_offset'] = offsets[:-1]
+        data['rows'] = np.diff(offsets)
+        df = pandas.DataFrame(data, columns=self.metaCols+['row_offset',
+                                                           'rows'])
+        df.index.name = 'image_key'
+        return df if categorical else df.infer_objects()
+
+    def frame(self, start=0, stop=None, categorical=False):
+        """Returns rows start:stop as a denormalized dataframe (the same
+        table RecordBuilder.build returns, with dtype value columns).
+
+        With categorical the metadata columns are pandas categoricals that
+        share the stored codes instead of one object per row.
+        """
+        stop = self.nRows if stop is None else min(stop, self.nRows)
+        rows = np.arange(start, max(start, stop))
+        offsets = self.offsets
+        keys = np.searchsorted(offsets, rows, side='right')-1
+        data = dict((c, self._meta_column(c, keys, categorical)) for c in
+                    self.metaCols)
+        for c in self.valueCols:
+            data[c] = self._values[c][start:start+len(rows)]
+        df = pandas.DataFrame(data, columns=self.columns,
+                              index=rows-offsets[keys])                        # Row number within each image
+        return df if categorical else df.infer_objects()
+
+    def frames(self, chunkRows=65536, categorical=False):
+        """Yields (first row, dataframe) slices of the denormalized table;
+        an empty table yields one empty dataframe."""
+        for start in range(0, max(self.nRows, 1), chunkRows):
+            yield start, self.frame(start, start+chunkRows, categorical)
+
+    def build(self, categorical=False):
+        """Returns the whole denormalized table."""
+        return self.frame(categorical=categorical)
+
+
+def table_builder(name, columns, metaCols, compactTables=()):
+    """Returns a CompactTable for the tables in compactTables, else a
+    RecordBuilder."""
+    if name in compactTables:
+        return CompactTable(columns, metaCols)
+    return RecordBuilder(columns, metaCols)
+
+
+class ResultTables(object):
+    """One RecordBuilder for each of the Data, Peaks, IPDs & Analysis sheets.
+
+    tables is a list of (sheet name, columns) pairs and metaCols the columns
+    that are copied from the image metadata onto every row. The tables named
+    in compactTables are kept as CompactTables.
+    """
+
+    def __init__(self, tables, metaCols, compactTables=()):
+        self.names = [name for name, cols in tables]
+        self.builders = dict((name, table_builder(name, cols, metaCols,
+                                                  compactTables))
+                             for name, cols in tables)
+        self.nImages = 0
+
+    def add(self, res):
+        """Adds a result dict from PACC_PeakFinder.analyze_image.
+
+        Tables missing from res (e.g. the other channel's tables in a
+        multi-channel run) get no rows.
+        """
+        for name in self.names:
+            if name in res:
+                self.builders[name].add(res['meta'], res[name])
+        self.nImages += 1
+
+    def build(self):
+        """Returns the tables as a list of dataframes in sheet order."""
+        return [self.builders[name].build() for name in self.names]
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Store.py
+
+Optional SQLite store of PACC_PeakFinder results for queries across preps.
+Every analysis still writes its own workbook/Parquet files; with a store the
+Peaks, IPDs and Analysis tables of each run are also added to one database
+file (the per-pixel Data table is left out):
+
+    runs        one row per analyzed NS & channel: run_id, prep_id, ns_id,
+                channel, timestamp, results path & the Parameters sheet
+                (date & time of analysis, microns per pixel, script name)
+    peaks       run_id, channel + colsPeaks
+    ipds        run_id, channel + colsIPDs
+    analysis    run_id, channel + colsAnalysis
+
+The rows of an NS (all of its channels) are inserted in one transaction when
+the run is closed, so a failed NS leaves nothing behind. peaks, ipds and analysis are indexed on
+run_id, prep_id, ns_id, strain and image_id.
+
+Running the same NS again adds a new run. Queries use only the latest run of
+every (prep, NS, channel) unless latest=False.
+
+Query API (all return dataframes):
+    store.runs()
+    store.table('analysis', strain='N2', prep_id=['CCP_127', 'CCP_128'])
+    store.puncta_per_micron(by=('strain', 'surface_proteins'))
+    store.query('SELECT ...', params)
+
+Existing workbooks can be added with import_workbook(), e.g.
+
+    python PACC_Store.py --db PACC_Results.sqlite \
+        --import "CCPs/*/Analysis/*/PACC_PFAnalysis.*.xlsx" --summary
+"""
+#LIBRARIES
+import os
+import glob
+import sqlite3
+import argparse
+import pandas
+
+import PACC_PeakFinder as pf
+from PACC_Records import ResultTables
+
+#Results table -> (sheet, columns) stored for every run
+STORE_TABLES = [('peaks', 'Peaks', pf.colsPeaks),
+                ('ipds', 'IPDs', pf.colsIPDs),
+                ('analysis', 'Analysis', pf.colsAnalysis)]
+
+#Columns of the runs table (the Parameters sheet columns come last)
+colsRuns = ['run_id','prep_id','ns_id','channel','timestamp','path',
+            'date_of_analysis','time_of_analysis','microns_per_pixel',
+            'script_name']
+
+#Parameters sheet column -> runs column
+PARAMETERS = {'1. Date of analysis': 'date_of_analysis',
+              '2. Time of analysis': 'time_of_analysis',
+              '3. Microns per pixel': 'microns_per_pixel',
+              '4. Script name': 'script_name'}
+
+#Columns that can be filtered on (indexed)
+INDEXED = ['run_id','prep_id','ns_id','strain','image_id']
+
+
+def _q(name):
+    """Quotes an SQL identifier (some columns contain '-')."""
+    return '"'+name.replace('"', '""')+'"'
+
+
+def _sql_type(col):
+    if col in pf.colsImage:
+        return '' if col == 'tiv' else 'TEXT'
+    return 'REAL'
+
+
+def _rows(df, cols):
+    """Returns the rows of df[cols] as lists of plain Python values."""
+    df = df[cols].astype(object)
+    return df.where(df.notnull(), None).values.tolist()
+
+
+class ResultStore(object):
+    """A SQLite database of analysis runs (see the module docstring)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self._create()
+
+    def _create(self):
+        with self.con:
+            self.con.execute(
+                "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, prep_id TEXT, ns_id TEXT, channel TEXT, "
+                "timestamp TEXT, path TEXT, date_of_analysis TEXT, "
+                "time_of_analysis TEXT, microns_per_pixel REAL, "
+                "script_name TEXT)")
+            for table, sheet, cols in STORE_TABLES:
+                self.con.execute(
+                    "CREATE TABLE IF NOT EXISTS "+table+" (run_id INTEGER "
+                    "REFERENCES runs(run_id), channel TEXT, "+
+                    ', '.join(_q(c)+' '+_sql_type(c) for c in cols)+")")
+                for c in INDEXED:
+                    self.con.execute("CREATE INDEX IF NOT EXISTS ix_"+table+
+                                     "_"+c+" ON "+table+" ("+c+")")
+            self.con.execute("CREATE INDEX IF NOT EXISTS ix_runs_ns ON runs "
+                             "(prep_id, ns_id, channel)")
+
+    def close(self):
+        self.con.close()
+
+    # *** WRITING ***
+    def open_run(self, prepID, nsID, channels, timestamp, pathRes):
+        """Returns an output backend that stores one run on close()."""
+        return StoreOutput(self, prepID, nsID, channels, timestamp, pathRes)
+
+    def insert_runs(self, runs):
+        """Inserts (run, tables) pairs in one transaction; returns the run_ids.
+
+        run maps colsRuns (without run_id) to values and tables maps 'peaks',
+        'ipds' & 'analysis' to dataframes of that run's channel.
+        """
+        with self.con:
+            return [self._insert(run, tables) for run, tables in runs]
+
+    def _insert(self, run, tables):
+        cols = colsRuns[1:]
+        cur = self.con.execute(
+            "INSERT INTO runs ("+', '.join(cols)+") VALUES ("+
+            ', '.join('?'*len(cols))+")",
+            [None if pandas.isnull(run.get(c)) else run.get(c) for c in cols])
+        runID = cur.lastrowid
+        for table, sheet, tableCols in STORE_TABLES:
+            df = tables.get(table)
+            if df is None or not len(df):
+                continue
+            df = df.assign(run_id=runID, channel=run['channel'])
+            allCols = ['run_id', 'channel']+tableCols
+            self.con.executemany(
+                "INSERT INTO "+table+" ("+', '.join(_q(c) for c in allCols)+
+                ") VALUES ("+', '.join('?'*len(allCols))+")",
+                _rows(df, allCols))
+        return runID
+
+    # *** QUERIES ***
+    def query(self, sql, params=()):
+        """Runs a SELECT and returns the result as a dataframe."""
+        return pandas.read_sql_query(sql, self.con, params=params)
+
+    def runs(self):
+        return self.query("SELECT * FROM runs ORDER BY run_id")
+
+    def _latest(self):
+        # Latest run of every (prep, NS, channel)
+        return ("run_id IN (SELECT MAX(run_id) FROM runs "
+                "GROUP BY prep_id, ns_id, channel)")
+
+    def _where(self, latest, filters):
+        clauses, params = [], []
+        if latest:
+            clauses.append(self._latest())
+        for col, val in sorted(filters.items()):
+            if col not in pf.colsImage+['run_id', 'channel']:
+                raise ValueError("Cannot filter on '"+col+"'")
+            vals = val if isinstance(val, (list, tuple, set)) else [val]
+            clauses.append(_q(col)+" IN ("+', '.join('?'*len(vals))+")")
+            params.extend(vals)
+        return (" WHERE "+" AND ".join(clauses) if clauses else ""), params
+
+    def table(self, name, latest=True, **filters):
+        """Returns the rows of peaks, ipds or analysis matching filters.
+
+        filters map metadata columns (prep_id, strain, ...) to a value or a
+        list of values.
+        """
+        if name not in [t for t, sheet, cols in STORE_TABLES]:
+            raise ValueError("Unknown table '"+str(name)+"'")
+        where, params = self._where(latest, filters)
+        return self.query("SELECT * FROM "+name+where, params)
+
+    def puncta_per_micron(self, by=('strain', 'surface_proteins'),
+                          latest=True, **filters):
+        """Aggregates the analysis table by metadata columns.
+
+        Returns one row per group with the number of images, the total peaks
+        and neurite length, the pooled puncta per micron (total peaks / total
+        length), the mean & std of the per image puncta per micron and the
+        mean IPD.
+        """
+        by = list(by)
+        for col in by:
+            if col not in pf.colsImage+['channel']:
+                raise ValueError("Cannot group by '"+col+"'")
+        where, params = self._where(latest, filters)
+        groups = ', '.join(_q(c) for c in by)
+        df = self.query(
+            "SELECT "+groups+", COUNT(*) AS images, "
+            "SUM(total_peaks) AS total_peaks, "
+            "SUM(max_neurite_length) AS total_length, "
+            "SUM(total_peaks)/SUM(max_neurite_length) AS puncta_per_micron, "
+            "AVG(average_peaks_per_micron) AS mean_peaks_per_micron, "
+            "AVG(average_peaks_per_micron*average_peaks_per_micron) AS _sq, "
+            "AVG(average_ipd) AS mean_ipd "
+            "FROM analysis"+where+" GROUP BY "+groups+" ORDER BY "+groups,
+            params)
+        # Sample std from the mean of squares (SQLite has no STDEV)
+        n = df['images']
+        var = (df['_sq']-df['mean_peaks_per_micron']**2)*n/(n-1)
+        df.insert(df.columns.get_loc('_sq'), 'std_peaks_per_micron',
+                  var.clip(lower=0)**0.5)
+        return df.drop(columns=['_sq'])
+
+
+def _parameters(run, dfParameters):
+    """Copies the Parameters sheet values into a runs row."""
+    for col, runCol in PARAMETERS.items():
+        if col in dfParameters and len(dfParameters):
+            val = dfParameters[col].iloc[0]
+            run[runCol] = (float(val) if runCol == 'microns_per_pixel' else
+                           str(val))
+    return run
+
+
+class StoreOutput(object):
+    """Output backend that adds one NS to a ResultStore.
+
+    Takes the same add(res)/close(sheets) calls as PACC_Output's backends
+    (use it next to one of them with PACC_Output.TeeOutput). Tables named
+    '<sheet>.<channel>' (multi-channel runs) are stored as that channel's
+    run. run_ids holds the run_id of every channel after close().
+    """
+
+    def __init__(self, store, prepID, nsID, channels, timestamp, pathRes):
+        self.store = store
+        self.channels = list(channels)
+        self.run = {'prep_id': prepID, 'ns_id': nsID, 'timestamp': timestamp,
+                    'path': pathRes}
+        self.tables = []
+        for channel in self.channels:
+            names = [(sheet if len(self.channels) == 1 else
+                      sheet+'.'+channel, cols)
+                     for table, sheet, cols in STORE_TABLES]
+            self.tables.append((channel, ResultTables(names, pf.colsImage)))
+        self.run_ids = []
+
+    def add(self, res):
+        for channel, tables in self.tables:
+            tables.add(res)                                                    # Other channels' tables are skipped
+
+    def flush(self):
+        pass                                                                   # Runs are added in one transaction on close
+
+    def close(self, sheets):
+        run = dict(self.run)
+        for name, df in sheets:
+            if name == 'Parameters':
+                _parameters(run, df)
+        runs = []
+        for channel, tables in self.tables:
+            runs.append((dict(run, channel=channel),
+                         dict((table, df) for (table, sheet, cols), df in
+                              zip(STORE_TABLES, tables.build()))))
+        self.run_ids = self.store.insert_runs(runs)
+
+
+def import_workbook(store, fnXlsx):
+    """Adds an existing PACC_PFAnalysis workbook to the store.
+
+    Multi-channel workbooks ('Peaks.green', ...) add one run per channel;
+    other workbooks are stored under the channel of their file name
+    (.JN0./.JN1.) or as 'unknown'. Returns the run_ids.
+    """
+    sheets = pandas.read_excel(fnXlsx, sheet_name=None, index_col=0)
+    parts = os.path.basename(fnXlsx).split('.')
+    channels = [c for c in sorted(pf.CHANNELS) if 'Peaks.'+c in sheets]
+    if not channels:
+        chExts = dict((ext, c) for c, (CH, ext) in pf.CHANNELS.items())
+        channels = [next((chExts[p] for p in parts if p in chExts),
+                         'unknown')]
+    runs = []
+    for channel in channels:
+        tables = {}
+        for table, sheet, cols in STORE_TABLES:
+            name = sheet+'.'+channel if sheet+'.'+channel in sheets else sheet
+            if name in sheets:
+                df = sheets[name].reindex(columns=cols)
+                df['date'] = df['date'].astype(str)                            # Excel dates come back as Timestamps
+                tables[table] = df
+        dfAnalysis = tables.get('analysis', pandas.DataFrame())
+        run = {'prep_id': dfAnalysis['prep_id'].iloc[0] if len(dfAnalysis)
+               else None,
+               'ns_id': dfAnalysis['ns_id'].iloc[0] if len(dfAnalysis)
+               else None,
+               'channel': channel, 'timestamp': parts[-2],
+               'path': os.path.dirname(os.path.abspath(fnXlsx))+'/'}
+        _parameters(run, sheets.get('Parameters', pandas.DataFrame()))
+        runs.append((run, tables))
+    return store.insert_runs(runs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PACC results store.')
+    parser.add_argument('--db', required=True, help='SQLite database file')
+    parser.add_argument('--import', dest='imports', nargs='*', default=[],
+                        help='workbooks (or glob patterns) to add')
+    parser.add_argument('--summary', action='store_true',
+                        help='print puncta per micron by strain & surface '
+                             'protein')
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    for pattern in args.imports:
+        for fn in sorted(glob.glob(pattern)):
+            runIDs = import_workbook(store, fn)
+            print("Imported "+fn+" as run(s) "+
+                  ', '.join(str(r) for r in runIDs))
+    if args.summary:
+        print(store.puncta_per_micron().to_string(index=False))
+    store.close()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Sweep.py
+
+Parameter sweep of the peak criteria of PACC_PeakFinder. A normal run finds
+the puncta of an image with
+
+    find_peaks(nf, height=mean+heightSD*stdSS, prominence=prom,
+               width=width, rel_height=relHeight)
+
+so tuning heightSD, the prominence cutoff or rel_height used to mean one full
+run (image reads, figures and workbooks) per setting. Every one of these
+criteria only removes local maxima of nf, and the prominence and width of a
+maximum do not depend on which other maxima are kept. The sweep therefore
+reads and profiles each image once, finds all of its local maxima with their
+prominences once (and their widths once per rel_height), and evaluates the
+whole grid by filtering those candidates:
+
+    heightSD     minimum height = ss_mean + heightSD*ss_std
+    promFactor   minimum prominence = promFactor*(population std of nf)
+    relHeight    rel_height of the width measurement (peaks narrower than
+                 --width pixels are removed)
+
+heightSD=2, promFactor=1, relHeight=0.5 gives the same peaks as the
+analysis run with the default peakParams.
+
+The result is a tidy table with one row per image and parameter combination
+(peak count, puncta per micron, peak width/intensity and IPD stats) and a
+summary with one row per combination. Both are saved as CSV files in
+dirCCPs/<prep>/Analysis/<timestamp>/. No figures are drawn.
+
+Usage:
+    python PACC_Sweep.py --ccps /path/to/CCPs/ --prep CCP_127 --ns NS_02.01
+                         [--channel green] [--height-sd 1 1.5 2 2.5 3]
+                         [--prom-factor 0.5 1 1.5] [--rel-height 0.25 0.5]
+"""
+#LIBRARIES
+import os
+import argparse
+import traceback
+import multiprocessing
+import numpy as np
+import pandas
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+
+import PACC_PeakFinder as pf
+
+#Default grid; it includes the criteria of a normal analysis run
+heightSDs = [1, 1.5, 2, 2.5, 3]
+promFactors = [0.5, 0.75, 1, 1.25, 1.5]
+relHeights = [0.25, 0.5, 0.75]
+
+#Columns of the per image sweep table
+colsSweepParams = ['height_sd','prominence_factor','rel_height']
+colsSweepImage = ['image_size','max_neurite_length','ss_mean','ss_std',
+                  'pop_std']
+colsSweepPeaks = ['min_height','prominence','total_peaks',
+                  'average_peaks_per_micron','average_peak_intensity',
+                  'average_peak_width','average_ipd','median_ipd']
+colsSweep = (pf.colsImage+colsSweepParams+colsSweepImage+colsSweepPeaks)
+
+#Columns of the per combination summary
+colsSweepSummary = colsSweepParams+['images','total_peaks',
+                                    'puncta_per_micron',
+                                    'mean_peaks_per_micron',
+                                    'std_peaks_per_micron',
+                                    'average_ipd','median_ipd']
+
+
+def sweep_grid(heightSDs, promFactors, relHeights):
+    """Returns the (heightSD, promFactor, relHeight) combinations as arrays.
+
+    The combinations are ordered by relHeight, then heightSD, then
+    promFactor.
+    """
+    combos = [(k, f, r) for r in relHeights for k in heightSDs
+              for f in promFactors]
+    return dict(zip(colsSweepParams,
+                    [np.array(c, dtype=float) for c in zip(*combos)]))
+
+
+def peak_candidates(nf, relHeights):
+    """Finds every local maximum of nf with its prominence and widths.
+
+    Returns a dict with the peak positions ('peaks'), their 'heights' and
+    'prominences', and 'widths' mapping each relHeight to the widths (in
+    pixels) of every candidate.
+    """
+    peaks = find_peaks(nf)[0]
+    prominences, left, right = peak_prominences(nf, peaks)
+    widths = {}
+    for r in relHeights:
+        widths[r] = peak_widths(nf, peaks, rel_height=r,
+                                prominence_data=(prominences, left, right))[0]
+    return {'peaks': peaks, 'heights': nf[peaks], 'prominences': prominences,
+            'widths': widths}
+
+
+def sweep_image(nf, mean, stdSS, popStd, grid, muperpx, width=0):
+    """Evaluates every combination of the grid on one corrected profile.
+
+    nf is the background subtracted signal of the image and mean, stdSS and
+    popStd its thresholds from batch_thresholds (mean, stdSS, prom). Returns
+    a dict of per combination arrays (colsSweepPeaks).
+    """
+    nCombos = len(grid['height_sd'])
+    length = (len(nf)-1)*muperpx                                               # max_neurite_length
+    cand = peak_candidates(nf, np.unique(grid['rel_height']))
+    minHeight = mean+grid['height_sd']*stdSS
+    prom = grid['prominence_factor']*popStd
+    out = dict((c, np.full(nCombos, np.nan)) for c in colsSweepPeaks)
+    out['total_peaks'] = np.zeros(nCombos, dtype=int)
+    out['min_height'] = minHeight
+    out['prominence'] = prom
+    # Inclusive comparisons, as in find_peaks (NaN cutoffs keep nothing)
+    with np.errstate(invalid='ignore'):
+        keep = ((cand['heights'][np.newaxis, :] >= minHeight[:, np.newaxis]) &
+                (cand['prominences'][np.newaxis, :] >= prom[:, np.newaxis]))
+    for i in range(nCombos):
+        w = cand['widths'][grid['rel_height'][i]]
+        sel = keep[i] & (w >= width)
+        pd = cand['peaks'][sel]*muperpx
+        ipd = np.diff(pd)
+        out['total_peaks'][i] = len(pd)
+        if len(pd):
+            out['average_peak_intensity'][i] = np.mean(cand['heights'][sel])
+            out['average_peak_width'][i] = np.mean(w[sel]*muperpx)
+        if len(ipd):
+            out['average_ipd'][i] = np.mean(ipd)
+            out['median_ipd'][i] = np.median(ipd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['average_peaks_per_micron'] = out['total_peaks']/length
+    return out
+
+
+def sweep_images(batch, nsParams, grid):
+    """Sweeps the grid over a batch of (image file, metadata) pairs.
+
+    Images are read and profiled together as in PACC_PeakFinder. Returns
+    (columns, errors): columns is a dict of colsSweep arrays with one row per
+    image and combination, errors a list of (image file, traceback text).
+    """
+    nCombos = len(grid['height_sd'])
+    width = nsParams['peakParams']['width']
+    groups, reads, hashes, errors = pf.profile_images(batch, nsParams)
+    errors = [(batch[i][0], errors[i]) for i in sorted(errors)]
+    chunks = dict((c, []) for c in colsSweep)
+    for inds, imgs, prof, th in groups:
+        for j, i in enumerate(inds):
+            x, md = batch[i]
+            try:
+                if prof is None:                                               # Long image left for tiling; the sweep needs its whole profile
+                    prof = pf.batch_profiles(imgs, nsParams['pxN'],
+                                             nsParams['pxB'])
+                    th = pf.batch_thresholds(prof['nf'], nsParams['peakParams']
+                                             ['heightSD'])
+                w = prof['widths'][j]
+                res = sweep_image(prof['nf'][j, :w], th['mean'][j],
+                                  th['stdSS'][j], th['prom'][j], grid,
+                                  nsParams['muperpx'], width)
+                res['image_size'] = w
+                res['max_neurite_length'] = (w-1)*nsParams['muperpx']
+                res['ss_mean'] = th['mean'][j]
+                res['ss_std'] = th['stdSS'][j]
+                res['pop_std'] = th['prom'][j]
+                res.update(grid)
+                meta = pf.image_meta(x, md, nsParams)
+            except Exception:
+                errors.append((x, traceback.format_exc()))
+                continue
+            for c in colsSweep:
+                v = meta[c] if c in meta else res[c]
+                if np.ndim(v) == 0:
+                    v = np.repeat(np.array([v], dtype=object if c in meta
+                                           else float), nCombos)
+                chunks[c].append(v)
+    columns = dict((c, np.concatenate(chunks[c]) if chunks[c] else
+                    np.array([])) for c in colsSweep)
+    return columns, errors
+
+
+def _sweep_task(task):
+    """Pool entry point: sweeps a chunk of images and never raises."""
+    chunk, nsParams, grid = task
+    try:
+        return sweep_images(chunk, nsParams, grid)
+    except Exception:
+        err = traceback.format_exc()
+        return dict((c, np.array([])) for c in colsSweep), \
+            [(x, err) for x, md in chunk]
+
+
+def summarize_sweep(dfSweep):
+    """Pools the per image sweep table into one row per combination."""
+    rows = []
+    for combo, df in dfSweep.groupby(colsSweepParams, sort=False):
+        ppm = df['average_peaks_per_micron']
+        rows.append(dict(zip(colsSweepParams, combo),
+                         images=len(df),
+                         total_peaks=df['total_peaks'].sum(),
+                         puncta_per_micron=(df['total_peaks'].sum()/
+                                            df['max_neurite_length'].sum()),
+                         mean_peaks_per_micron=ppm.mean(),
+                         std_peaks_per_micron=ppm.std(),
+                         average_ipd=df['average_ipd'].mean(),
+                         median_ipd=df['median_ipd'].median()))
+    return pandas.DataFrame(rows, columns=colsSweepSummary)
+
+
+def run_sweep(dirCCPs, prepID, nsID, channel='green', grid=None, width=None,
+              processes=None, chunksize=16):
+    """Sweeps the grid over one neurite set and returns (dfSweep, dfSummary).
+
+    grid defaults to sweep_grid(heightSDs, promFactors, relHeights) and width
+    (minimum peak width in pixels) to peakParams['width']. processes defaults
+    to the number of CPUs; with processes=1 the images are swept in this
+    process.
+    """
+    today, now, timestamp = pf.get_timestamp()
+    CH, chExt = pf.CHANNELS[channel]
+    if grid is None:
+        grid = sweep_grid(heightSDs, promFactors, relHeights)
+    pathRes = dirCCPs+prepID+"/Analysis/"+timestamp+'/'
+    nsParams, tasks, dfExclusions, dfPixInd = pf.prepare_neurite_set(
+            dirCCPs, prepID, nsID, CH, chExt, pathRes, timestamp)
+    if width is not None:
+        nsParams['peakParams']['width'] = width
+
+    jobs = [(tasks[i:i+chunksize], nsParams, grid)
+            for i in range(0, len(tasks), chunksize)]
+    if processes == 1:
+        results = [_sweep_task(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_sweep_task, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    columns = dict((c, []) for c in colsSweep)
+    for chunkCols, errors in results:
+        for x, err in errors:
+            print("Error. Image "+x+" could not be analyzed:\n"+err)
+        for c in colsSweep:
+            columns[c].append(chunkCols[c])
+    dfSweep = pandas.DataFrame(
+        dict((c, np.concatenate(columns[c]) if columns[c] else np.array([]))
+             for c in colsSweep), columns=colsSweep).infer_objects()
+    dfSummary = summarize_sweep(dfSweep)
+
+    if not os.path.isdir(pathRes):
+        os.makedirs(pathRes)
+    pf.write_readme(pathRes, prepID, timestamp,
+                    ["Peak criteria sweep of "+nsID+" "+channel+" channel"])
+    fnRes = 'PACC_PFSweep.'+prepID+'.'+nsID+'.'+chExt+'.'+timestamp
+    dfSweep.to_csv(pathRes+fnRes+'.csv', index=False)
+    dfSummary.to_csv(pathRes+fnRes+'.summary.csv', index=False)
+    return dfSweep, dfSummary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep the PACC peak '
+                                     'finding criteria over a neurite set.')
+    parser.add_argument('--ccps', default=pf.dirCCPs,
+                        help='directory holding all CCP preps')
+    parser.add_argument('--prep', default=pf.prepID, help='CCP prep, e.g. '
+                        'CCP_127')
+    parser.add_argument('--ns', default=pf.nsID, help='neurite set, e.g. '
+                        'NS_02.01')
+    parser.add_argument('--channel', choices=sorted(pf.CHANNELS),
+                        default='green')
+    parser.add_argument('--height-sd', type=float, nargs='+',
+                        default=heightSDs,
+                        help='minimum height = ss_mean + HEIGHT_SD*ss_std')
+    parser.add_argument('--prom-factor', type=float, nargs='+',
+                        default=promFactors,
+                        help='minimum prominence = PROM_FACTOR*pop std')
+    parser.add_argument('--rel-height', type=float, nargs='+',
+                        default=relHeights,
+                        help='rel_height of the peak width measurement')
+    parser.add_argument('--width', type=float, default=None,
+                        help='minimum peak width in pixels (default: '
+                             'peakParams width)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: all CPUs)')
+    parser.add_argument('--chunksize', type=int, default=16,
+                        help='images a worker profiles together')
+    args = parser.parse_args()
+
+    grid = sweep_grid(args.height_sd, args.prom_factor, args.rel_height)
+    dfSweep, dfSummary = run_sweep(os.path.join(args.ccps, ''), args.prep,
+                                   args.ns, args.channel, grid, args.width,
+                                   args.processes, args.chunksize)
+    print(dfSummary.to_string(index=False))
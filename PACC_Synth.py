@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Synth.py
+
+Synthetic neurite sets for benchmarking PACC_PeakFinder without real data.
+make_neurite_set() writes a neurite set in the same layout as
+PACC_NeuTrace.ijm:
+
+    dirCCPs/<prep>/Images/Cropped/<NS>/<image>.C<i>.JN0.tif    (and/or JN1)
+    dirCCPs/<prep>/Metadata/<prep>.MetaD.IM.csv
+    dirCCPs/<prep>/Metadata/<prep>.MetaD.<NS>.csv
+
+plus the ground truth, dirCCPs/<prep>/Metadata/<prep>.Truth.<NS>.csv, with
+the position (in um) of every punctum that was drawn.
+
+Each straightened image is line_width rows by length/muperpx columns of
+background + Gaussian noise. The neurite is a band of round(1/muperpx) rows
+in the middle of the image (the rows PACC_PeakFinder samples) with a dim
+shaft signal, and the puncta are 2D Gaussian spots on its center line.
+Punctum centers follow a renewal process: the spacing is minSpacingUm plus
+an exponential gap, so the mean density is the requested puncta per micron.
+
+Parameters (synthParams):
+    lengthUm       (min, max) neurite length in um, uniform per image
+    lineWidth      image height in pixels (MetaD.NS line_width)
+    muperpx        calibration, 0.126 or 0.252 um/pix
+    density        mean puncta per micron
+    widthUm        (min, max) punctum FWHM in um, uniform per punctum
+    minSpacingUm   smallest distance between puncta
+    snr            punctum peak amplitude / pixel noise std
+    noise          pixel noise std
+    background     mean background intensity
+    shaft          neurite shaft intensity above background
+"""
+#LIBRARIES
+import os
+import json
+import imageio
+import numpy as np
+import pandas
+
+#Default generator settings
+synthParams = {'lengthUm': (20, 80), 'lineWidth': 32, 'muperpx': 0.126,
+               'density': 0.25, 'widthUm': (0.4, 0.8), 'minSpacingUm': 1.5,
+               'snr': 5, 'noise': 4, 'background': 20, 'shaft': 5}
+
+#Color planes & file extensions, as in PACC_PeakFinder.CHANNELS
+SYNTH_CHANNELS = {'green': (1, 'JN0'), 'red': (0, 'JN1')}
+
+#Columns of the ground truth table
+colsTruth = ['image_id','channel','position','amplitude','fwhm']
+
+
+def punctum_positions(rng, lengthUm, density, minSpacingUm, marginUm):
+    """Draws punctum centers (um) along a neurite of length lengthUm."""
+    meanGap = 1./density-minSpacingUm
+    if meanGap <= 0:
+        raise ValueError("density "+str(density)+" puncta/um is too high "
+                         "for a minimum spacing of "+str(minSpacingUm)+" um")
+    nMax = int(lengthUm*density*2)+10
+    gaps = minSpacingUm+rng.exponential(meanGap, nMax)
+    pos = marginUm+rng.uniform(0, 1./density)+np.concatenate(([0.],
+                                                   np.cumsum(gaps[1:])))
+    return pos[pos <= lengthUm-marginUm]
+
+
+def synth_plane(rng, widthPx, params, puncta=True):
+    """Draws one color plane; returns (plane, positions, amplitudes, fwhms).
+
+    plane is float (rows, columns); positions are in um.
+    """
+    muperpx = params['muperpx']
+    h = params['lineWidth']
+    plane = params['background']+rng.normal(0, params['noise'], (h, widthPx))
+    if not puncta:
+        return plane, np.array([]), np.array([]), np.array([])
+    # Neurite band: the rows get_pixel_indices samples as neurite
+    bandSize = int(round(1/muperpx))
+    band0 = (h-bandSize)//2
+    plane[band0:band0+bandSize] += params['shaft']
+    lengthUm = (widthPx-1)*muperpx
+    wMax = max(params['widthUm'])
+    pos = punctum_positions(rng, lengthUm, params['density'],
+                            params['minSpacingUm'], wMax)
+    fwhm = rng.uniform(params['widthUm'][0], params['widthUm'][1], len(pos))
+    amp = np.full(len(pos), params['snr']*params['noise'])
+    # Sum of 2D Gaussian spots on the center line, each cut off at 4 sigma
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))/muperpx
+    rows = np.arange(h)-(h-1)/2.
+    cols = np.arange(widthPx)
+    for p, s, a in zip(pos/muperpx, sigma, amp):
+        c0, c1 = max(int(p-4*s), 0), min(int(p+4*s)+2, widthPx)
+        spot = np.exp(-(cols[c0:c1]-p)**2/(2*s*s))
+        plane[:, c0:c1] += a*np.outer(np.exp(-rows**2/(2*s*s)), spot)
+    return plane, pos, amp, fwhm
+
+
+def synth_image(rng, params, channels=('green',)):
+    """Draws one straightened RGB image with puncta in the given channels.
+
+    Returns (img, truth) where img is a uint8 (rows, columns, 3) array and
+    truth maps each channel to its (positions, amplitudes, fwhms).
+    """
+    lengthUm = rng.uniform(params['lengthUm'][0], params['lengthUm'][1])
+    widthPx = int(round(lengthUm/params['muperpx']))+1
+    img = np.zeros((params['lineWidth'], widthPx, 3))
+    truth = {}
+    chans = dict((SYNTH_CHANNELS[c][0], c) for c in channels)
+    for CH in range(3):
+        plane, pos, amp, fwhm = synth_plane(rng, widthPx, params,
+                                            puncta=CH in chans)
+        img[:, :, CH] = plane
+        if CH in chans:
+            truth[chans[CH]] = (pos, amp, fwhm)
+    return np.clip(np.round(img), 0, 255).astype(np.uint8), truth
+
+
+def make_neurite_set(dirCCPs, prepID, nsID, nImages, channels=('green',),
+                     seed=0, **params):
+    """Writes a synthetic neurite set; returns its ground truth dataframe.
+
+    params override synthParams. The images of one neurite set share
+    lineWidth and muperpx. Rows of this NS already in MetaD.IM.csv are
+    replaced, other rows are kept.
+    """
+    prm = dict(synthParams)
+    prm.update(params)
+    rng = np.random.RandomState(seed)
+    dirNS = dirCCPs+prepID+"/Images/Cropped/"+nsID+"/"
+    dirMetaD = dirCCPs+prepID+"/Metadata/"
+    for d in (dirNS, dirMetaD):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    names = []
+    truth = dict((c, []) for c in colsTruth)
+    for i in range(nImages):
+        name = prepID+'_'+nsID+'_im'+str(i).zfill(5)
+        img, imTruth = synth_image(rng, prm, channels)
+        for channel in channels:
+            x = name+'.C'+str(i)+'.'+SYNTH_CHANNELS[channel][1]+'.tif'
+            imageio.imwrite(dirNS+x, img)
+            pos, amp, fwhm = imTruth[channel]
+            truth['image_id'].append(np.repeat(np.array([x], dtype=object),
+                                               len(pos)))
+            truth['channel'].append(np.repeat(np.array([channel],
+                                                       dtype=object), len(pos)))
+            truth['position'].append(pos)
+            truth['amplitude'].append(amp)
+            truth['fwhm'].append(fwhm)
+        names.append(name)
+
+    # *** METADATA ***
+    dfIM = pandas.DataFrame({'image_name': names,
+                             'acquisition_date': '2020-01-01',
+                             'strain': 'SYNTH',
+                             'tiv': 0,
+                             'pattern_geom': 'none',
+                             'surface_proteins': 'none',
+                             'calibration_um/pix': prm['muperpx']},
+                            columns=['image_name','acquisition_date','strain',
+                                     'tiv','pattern_geom','surface_proteins',
+                                     'calibration_um/pix'])
+    fnIM = dirMetaD+prepID+'.MetaD.IM.csv'
+    if os.path.exists(fnIM):
+        dfOld = pandas.read_csv(fnIM)
+        dfOld = dfOld[~dfOld['image_name'].astype(str)
+                      .str.startswith(prepID+'_'+nsID+'_im')]
+        dfIM = pandas.concat([dfOld, dfIM], ignore_index=True)
+    dfIM.to_csv(fnIM, index=False)
+    dfNS = pandas.DataFrame({'image_name': names,
+                             'ns_processed': 'YES',
+                             'line_width': prm['lineWidth'],
+                             'in_or_out': 'in',
+                             'exclusion_reason': 'None'},
+                            columns=['image_name','ns_processed','line_width',
+                                     'in_or_out','exclusion_reason'])
+    dfNS.to_csv(dirMetaD+prepID+'.MetaD.'+nsID+'.csv', index=False)
+
+    dfTruth = pandas.DataFrame(dict((c, np.concatenate(truth[c]) if truth[c]
+                                     else np.array([])) for c in colsTruth),
+                               columns=colsTruth)
+    dfTruth.to_csv(dirMetaD+prepID+'.Truth.'+nsID+'.csv', index=False)
+    with open(dirMetaD+prepID+'.Synth.'+nsID+'.json', 'w') as f:
+        json.dump({'nImages': nImages, 'channels': list(channels),
+                   'seed': seed, 'params': prm}, f, sort_keys=True)
+    return dfTruth
+
+
+def load_truth(dirCCPs, prepID, nsID):
+    """Reads the ground truth written by make_neurite_set."""
+    return pandas.read_csv(dirCCPs+prepID+'/Metadata/'+prepID+'.Truth.'+nsID+
+                           '.csv')
+
+
+def synth_settings(dirCCPs, prepID, nsID):
+    """Returns the settings a synthetic NS was made with (None if unknown)."""
+    try:
+        with open(dirCCPs+prepID+'/Metadata/'+prepID+'.Synth.'+nsID+
+                  '.json') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
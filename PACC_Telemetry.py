@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Telemetry.py
+
+Run telemetry for PACC_PeakFinder: wall time, CPU time and the process's
+maximum RSS at the end of each stage and image, plus counters (images,
+pixels, peaks, bytes read, ...).
+
+Stages timed in the process that drives the run:
+    prepare     metadata, pixel indices & the list of images
+    analyze     analyze_batch calls (cache lookups, hashing & the stages below
+                when the images are analyzed in this process)
+    output      adding the results to the output backend
+    figures     queueing QC figures & waiting for them at the end
+    write       write_results (building & writing the workbook)
+
+Stages timed per image, wherever the image was analyzed (see
+analyze_images), and summed here:
+    load        read_channel
+    profile     batch_profiles (the batch time shared equally by its images)
+    threshold   batch_thresholds (shared the same way)
+    find_peaks  find_peaks & assembling the image's result
+
+Images taken from the result cache have no per-image times.
+process_maxrss_mb is the maximum resident set size of the process since it
+started (getrusage ru_maxrss) when a stage or image ended. It is cumulative,
+not the memory used by that stage or image: once the largest image has been
+analyzed every later row repeats its value, and per image it is the
+maximum of the pool worker that analyzed it (over all its earlier images).
+
+write() saves <prep>_Telemetry.<timestamp>.json, a stage/counter table
+(<prep>_Telemetry.<timestamp>.csv) and a per-image table
+(<prep>_Telemetry.<timestamp>.images.csv) next to the _AnalysisRDME file.
+sheet() is the stage/counter table for the Telemetry sheet of the results
+workbook. The workbook is written during the 'write' stage, so the sheet
+does not include that stage; the JSON and CSV files do.
+
+Profiling is switched on with the PACC_PROFILE environment variable, e.g.
+PACC_PROFILE=cprofile, PACC_PROFILE=tracemalloc or both separated by a comma.
+cProfile stats are saved to <prep>_Profile.<timestamp>.prof (open with
+pstats or snakeviz) and the top allocations to
+<prep>_Tracemalloc.<timestamp>.txt. Only the driving process is profiled.
+"""
+#LIBRARIES
+import os
+import sys
+import json
+import time
+import timeit
+import contextlib
+import numpy as np
+import pandas
+
+try:
+    import resource
+except ImportError:                                                            # Not available on Windows
+    resource = None
+
+clock = timeit.default_timer
+
+#Stages in report order (worker stages are reported per image too)
+STAGES = ['prepare','load','profile','threshold','find_peaks','analyze',
+          'output','figures','write']
+IMAGE_STAGES = ['load','profile','threshold','find_peaks']
+
+#Columns of the stage/counter table & the per-image table
+colsTelemetry = ['name','kind','calls','wall_s','cpu_s',
+                 'process_maxrss_mb','value']
+colsTelemetryImage = (['image_id','read_method','bytes_read','pixels',
+                       'peaks']+
+                      [s+'_'+m for s in IMAGE_STAGES for m in ('wall_s',
+                                                               'cpu_s')]+
+                      ['process_maxrss_mb'])
+
+PROFILE_ENV = 'PACC_PROFILE'
+
+
+def process_maxrss_mb():
+    """Returns the maximum resident set size of this process since it
+    started, in MB (or NaN)."""
+    if resource is None:
+        return np.nan
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss/2.**20 if sys.platform == 'darwin' else rss/2.**10
+
+
+def clocks():
+    """Returns the current (wall, CPU) times in seconds."""
+    return clock(), time.process_time()
+
+
+def elapsed(start):
+    """Returns the (wall, CPU) seconds since start = clocks()."""
+    wall, cpu = clocks()
+    return [wall-start[0], cpu-start[1]]
+
+
+class Telemetry(object):
+    """Collects the stage, image & counter telemetry of one analysis run.
+
+    profile is a list with 'cprofile' and/or 'tracemalloc'; it defaults to
+    the comma separated PACC_PROFILE environment variable.
+    """
+
+    def __init__(self, profile=None):
+        if profile is None:
+            profile = [p.strip().lower() for p in
+                       os.environ.get(PROFILE_ENV, '').split(',') if p.strip()]
+        unknown = set(profile)-set(['cprofile', 'tracemalloc'])
+        if unknown:
+            raise ValueError("Unknown profiler(s) "+', '.join(sorted(unknown))+
+                             " in "+PROFILE_ENV+"; use cprofile and/or "
+                             "tracemalloc")
+        self.profile = profile
+        self.stages = dict((s, {'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                'process_maxrss_mb': np.nan})
+                           for s in STAGES)
+        self.counters = dict((c, 0) for c in ['images','failed_images',
+                                              'cached_images','pixels',
+                                              'peaks','bytes_read'])
+        self.images = dict((c, []) for c in colsTelemetryImage)
+        self._profiler = None
+        self._tracemalloc = None
+
+    # *** PROFILING HOOKS ***
+    def start(self):
+        """Starts the profilers selected in self.profile (if any)."""
+        if 'cprofile' in self.profile:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        if 'tracemalloc' in self.profile:
+            import tracemalloc
+            self._tracemalloc = tracemalloc
+            tracemalloc.start()
+
+    def stop(self, pathRes, prepID, timestamp, top=50):
+        """Stops the profilers and saves their output."""
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(pathRes+prepID+'_Profile.'+timestamp+
+                                      '.prof')
+            self._profiler = None
+        if self._tracemalloc is not None:
+            snapshot = self._tracemalloc.take_snapshot()
+            current, peak = self._tracemalloc.get_traced_memory()
+            self._tracemalloc.stop()
+            with open(pathRes+prepID+'_Tracemalloc.'+timestamp+'.txt',
+                      'w') as f:
+                f.write('Traced memory: current '+str(current)+' B, peak '+
+                        str(peak)+' B\n\nTop allocations by line:\n')
+                for stat in snapshot.statistics('lineno')[:top]:
+                    f.write(str(stat)+'\n')
+            self._tracemalloc = None
+
+    # *** RECORDING ***
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the enclosed block as (one call of) a stage."""
+        start = clocks()
+        try:
+            yield
+        finally:
+            wall, cpu = elapsed(start)
+            self.add(name, wall, cpu, process_maxrss_mb())
+
+    def add(self, name, wall, cpu, maxrssMB=np.nan, calls=1):
+        """Adds time spent in a stage."""
+        st = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.,
+                                           'cpu_s': 0.,
+                                           'process_maxrss_mb': np.nan})
+        st['calls'] += calls
+        st['wall_s'] += wall
+        st['cpu_s'] += cpu
+        st['process_maxrss_mb'] = np.nanmax([st['process_maxrss_mb'],
+                                             maxrssMB])
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0)+n
+
+    def add_image(self, res):
+        """Records an analyzed image (an analyze_images result)."""
+        timing = res.get('timing', {})
+        io = res.get('io', {})
+        row = {'image_id': res['meta']['image_id'],
+               'read_method': io.get('read_method'),
+               'bytes_read': io.get('bytes_read', 0),
+               'pixels': timing.get('pixels', 0),
+               'peaks': res['Analysis']['total_peaks'],
+               'process_maxrss_mb': timing.get('process_maxrss_mb',
+                                               np.nan)}
+        for s in IMAGE_STAGES:
+            wall, cpu = timing.get(s, (np.nan, np.nan))
+            row[s+'_wall_s'] = wall
+            row[s+'_cpu_s'] = cpu
+            if s in timing:
+                self.add(s, wall, cpu, row['process_maxrss_mb'])
+        for c in colsTelemetryImage:
+            self.images[c].append(row[c])
+        self.count('images')
+        self.count('pixels', row['pixels'])
+        self.count('peaks', row['peaks'])
+        self.count('bytes_read', row['bytes_read'])
+        if row['read_method'] == 'cache':
+            self.count('cached_images')
+
+    # *** REPORTS ***
+    def sheet(self):
+        """Returns the stage & counter table (colsTelemetry)."""
+        names = STAGES+sorted(set(self.stages)-set(STAGES))
+        rows = [dict(self.stages[s], name=s, kind='stage') for s in names]
+        rows += [{'name': c, 'kind': 'counter', 'value': self.counters[c]}
+                 for c in sorted(self.counters)]
+        return pandas.DataFrame(rows, columns=colsTelemetry)
+
+    def image_table(self):
+        """Returns the per-image table (colsTelemetryImage)."""
+        return pandas.DataFrame(self.images, columns=colsTelemetryImage)
+
+    def write(self, pathRes, prepID, timestamp):
+        """Saves the JSON & CSV telemetry files to the run directory."""
+        fnBase = pathRes+prepID+'_Telemetry.'+timestamp
+        dfSheet = self.sheet()
+        dfImages = self.image_table()
+        dfSheet.to_csv(fnBase+'.csv', index=False)
+        dfImages.to_csv(fnBase+'.images.csv', index=False)
+
+        def records(df):
+            # NaN is not valid JSON
+            return [dict((k, None if pandas.isnull(v) else v) for k, v in
+                         row.items()) for row in
+                    json.loads(df.to_json(orient='records'))]
+        with open(fnBase+'.json', 'w') as f:
+            json.dump({'timestamp': timestamp, 'prep_id': prepID,
+                       'stages': records(dfSheet[dfSheet['kind'] == 'stage']
+                                         .drop(columns=['kind', 'value'])),
+                       'counters': dict((k, int(v)) for k, v in
+                                        self.counters.items()),
+                       'images': records(dfImages)}, f, indent=1)
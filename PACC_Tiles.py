@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Tiles.py
+
+Bounded-memory analysis of very long straightened neurites, e.g. stitched
+acquisitions that are tens of thousands of pixels long and may be spread
+over several image files. The neurite is streamed in tiles of tileWidth
+columns and the three steps of PACC_PeakFinder are done without ever
+holding the whole neurite:
+
+    1. Profiles. The neurite & background means of a column only depend on
+       that column, so each tile is profiled on its own (batch_profiles) and
+       its profiles are spilled to a temporary, memory-mapped file
+       (TiledProfile). Mergeable running moments (Moments) of the signal
+       give the mean & max used by annf/mnnf, the population std (the
+       prominence cutoff) and the range of nf.
+    2. Thresholds. Q3 of nf and the median of the pixels below Q3 are exact
+       order statistics found by streaming histogram refinement
+       (order_statistic): every pass counts the values of the current range
+       in histBins bins, keeps the bin that holds the wanted rank and
+       narrows down until that bin holds at most sortMax values, which are
+       then sorted. The moments of the pixels below Q3 are merged tile by
+       tile (Chan et al.).
+    3. Peaks. find_peaks runs on every tile plus tileMargin columns on both
+       sides and keeps only the peaks inside the tile, so that a punctum on
+       a tile border is found once. The prominence (and so the width) of a
+       peak is exact once its base search ends inside the window, i.e. a
+       higher sample is found on both sides of it; when it does not the
+       margin of that tile is doubled, up to maxMargin, and the tile is
+       searched again.
+
+Working memory is O(tileWidth+2*maxMargin) columns plus a bounded number of
+histogram bins & sorted values; the profile itself lives in the temporary
+file (7 float64 values per column, the Data sheet columns). The results
+match the full-array path (batch_profiles, batch_thresholds & find_peaks)
+up to the rounding of the merged sums. The only exception are peaks whose
+base search needs more than maxMargin columns on one side: their
+prominence is measured within the window, so it can be smaller.
+
+PACC_PeakFinder analyzes images longer than tiledLength columns this way;
+analyze_stitched() in PACC_PeakFinder (python PACC_PeakFinder.py --stitch)
+analyzes the images of a neurite set as one neurite stitched from several
+files. Only the analysis itself is bounded, not the whole run:
+
+    - A long single image is read whole (its sampled row bands, all
+      columns) before it is tiled; a stitched neurite holds one file at a
+      time, so memory grows with its longest file.
+    - The result's Data table is copied out of the temporary profile file
+      (see PACC_PeakFinder.tiled_result) and added to the output in one
+      piece: the Excel output keeps every row until the end, the Parquet
+      output builds all rows of the image into one table before writing
+      them.
+    - A QC figure reads its whole image again; stitched neurites get none.
+
+Running this file compares the tiled & full-array paths on a synthetic
+neurite:
+
+    python PACC_Tiles.py --length 20000 [--tile-width 4096] [--margin 256]
+"""
+#LIBRARIES
+import tempfile
+import argparse
+import numpy as np
+
+from PACC_ImageIO import read_channel
+from PACC_Profiles import batch_profiles
+
+# *** TILING ***
+tileWidth = 8192                                                               # Columns analyzed at a time
+tileMargin = 512                                                               # Columns added on both sides of a tile when finding peaks
+maxMargin = 65536                                                              # Largest margin tried for peaks whose base search leaves the window
+
+# *** ORDER STATISTICS ***
+histBins = 4096                                                                # Bins per refinement pass
+sortMax = 65536                                                                # Values sorted once the wanted bin is this small
+
+#Rows of the spilled profile, in Data sheet order
+PROFILE_ROWS = ['distance','normalized_distance','raw_intensity',
+                'background_intensity','neurite_intensity',
+                'avg_norm_neu_int','max_norm_neu_int']
+
+
+class Moments(object):
+    """Count, mean, sum of squared deviations, min & max of a stream.
+
+    Chunks are added with add() and two Moments of disjoint data combine with
+    merge() (Chan et al.), so the result does not depend on the tiling.
+    NaN values are skipped.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = np.nan
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        x = x[~np.isnan(x)]
+        if len(x):
+            chunk = Moments()
+            chunk.n = len(x)
+            chunk.mean = np.mean(x)
+            chunk.m2 = float(np.sum((x-chunk.mean)**2))
+            chunk.min = np.min(x)
+            chunk.max = np.max(x)
+            self.merge(chunk)
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+        else:
+            n = self.n+other.n
+            delta = other.mean-self.mean
+            self.mean = self.mean+delta*other.n/n
+            self.m2 = self.m2+other.m2+delta*delta*self.n*other.n/n
+            self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def std(self, ddof=1):
+        return np.sqrt(self.m2/(self.n-ddof)) if self.n > ddof else np.nan
+
+
+def order_statistic(chunks, k, lo, hi, bins=None, maxSort=None):
+    """Returns the k-th smallest value (k from 0) of a stream.
+
+    chunks() returns a new iterator over the (NaN free) data and lo/hi are
+    the smallest & largest values. Every pass reads the stream once. bins
+    and maxSort default to histBins and sortMax.
+    """
+    if bins is None:
+        bins = histBins
+    if maxSort is None:
+        maxSort = sortMax
+    while True:
+        edges = np.linspace(lo, hi, bins+1)
+        counts = np.zeros(bins, dtype=np.int64)
+        below = 0
+        vMin, vMax = np.inf, -np.inf
+        for c in chunks():
+            below += int(np.count_nonzero(c < lo))
+            c = c[(c >= lo) & (c <= hi)]
+            if len(c):
+                counts += np.bincount(np.clip(np.searchsorted(edges, c,
+                                                              side='right')-1,
+                                              0, bins-1), minlength=bins)
+                vMin, vMax = min(vMin, c.min()), max(vMax, c.max())
+        if not vMax > vMin:
+            return vMin                                                        # Every candidate has the same value
+        b = min(int(np.searchsorted(below+np.cumsum(counts), k,
+                                    side='right')), bins-1)
+        if counts[b] <= maxSort:
+            lo, hi = edges[b], edges[b+1]
+            below = 0
+            values = []
+            for c in chunks():
+                below += int(np.count_nonzero(c < lo))
+                values.append(c[(c >= lo) & (c <= hi)])
+            values = np.sort(np.concatenate(values))
+            return values[min(k-below, len(values)-1)]
+        if (edges[b], edges[b+1]) == (lo, hi):
+            # lo & hi are adjacent floats: only these two values are left
+            nLo = sum(int(np.count_nonzero(c == lo)) for c in chunks())
+            return lo if below+nLo > k else hi
+        lo, hi = edges[b], edges[b+1]
+
+
+def percentile(chunks, q, n, lo, hi):
+    """Percentile q of a stream of n values with linear interpolation, as in
+    numpy.percentile (NaN if n is 0)."""
+    if n == 0:
+        return np.nan
+    p = q/100.*(n-1)
+    k = int(np.floor(p))
+    a = order_statistic(chunks, k, lo, hi)
+    if p == k:
+        return a
+    b = order_statistic(chunks, k+1, a, hi)
+    return a+(b-a)*(p-k)
+
+
+def array_tiles(img, width=None):
+    """Yields column tiles of an image that is already in memory (width
+    defaults to tileWidth)."""
+    if width is None:
+        width = tileWidth
+    for c0 in range(0, np.shape(img)[1], width):
+        yield img[:, c0:c0+width]
+
+
+def file_tiles(paths, CH, rows=None, width=None, io=None):
+    """Yields the column tiles of a neurite stitched from several files.
+
+    paths are the image files in order along the neurite; each is read with
+    read_channel (one file is held at a time, so memory grows with the
+    longest file). io, if given, gets the total 'bytes_read' and the
+    'read_method' of the last file.
+    """
+    for path in paths:
+        img, nBytes, method = read_channel(path, CH, rows)
+        if io is not None:
+            io['bytes_read'] = io.get('bytes_read', 0)+nBytes
+            io['read_method'] = method
+        for tile in array_tiles(img, width):
+            yield tile
+        del img
+
+
+class TiledProfile(object):
+    """The Data sheet profiles of a neurite, built one tile at a time.
+
+    tiles is an iterable of 2D (rows, columns) tiles in order along the
+    neurite and pxN/pxB are the row ranges of get_pixel_indices. The
+    profiles are memory-mapped rows of a temporary file in dirTmp
+    (PROFILE_ROWS; data maps each name to its row). raw holds the Moments
+    of the background subtracted signal before negatives are set to zero,
+    nf those of neurite_intensity. chunkWidth (default tileWidth) is the
+    number of columns processed at a time. Used as a context manager the
+    temporary file is deleted on exit (see close).
+    """
+
+    def __init__(self, tiles, pxN, pxB, muperpx, dirTmp=None,
+                 chunkWidth=None):
+        if chunkWidth is None:
+            chunkWidth = tileWidth
+        self.chunkWidth = chunkWidth
+        self.raw = Moments()
+        self.nf = Moments()
+        # Pass 1: raw & background profiles, appended to a scratch file
+        with tempfile.TemporaryFile(dir=dirTmp) as f:
+            width = 0
+            for tile in tiles:
+                prof = batch_profiles([tile], pxN, pxB)
+                rawf, bgf = prof['rawf'][0], prof['bgf'][0]
+                self.raw.add(rawf-bgf)
+                f.write(np.ascontiguousarray(np.vstack((rawf, bgf)).T)
+                        .tobytes())
+                width += len(rawf)
+            if width == 0:
+                raise ValueError("The neurite has no columns")
+            f.flush()
+            scratch = np.memmap(f, dtype=np.float64, mode='r',
+                                shape=(width, 2))
+            # Pass 2: every Data column, one contiguous row each
+            self._file = tempfile.TemporaryFile(dir=dirTmp)
+            self.values = np.memmap(self._file, dtype=np.float64, mode='w+',
+                                    shape=(len(PROFILE_ROWS), width))
+            self.width = width
+            length = (width-1)*muperpx
+            for c0 in range(0, width, chunkWidth):
+                c1 = min(c0+chunkWidth, width)
+                rawf, bgf = scratch[c0:c1, 0], scratch[c0:c1, 1]
+                nf = rawf-bgf
+                dist = np.arange(c0, c1)*muperpx
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    rows = [dist, dist/length, rawf, bgf,
+                            np.where(nf < 0, 0., nf),
+                            nf/self.raw.mean, nf/self.raw.max]
+                for i, r in enumerate(rows):
+                    self.values[i, c0:c1] = r
+                self.nf.add(rows[4])
+            del scratch
+        self.values.flush()
+        self.data = dict((name, self.values[i]) for i, name in
+                         enumerate(PROFILE_ROWS))
+
+    def chunks(self, name='neurite_intensity', below=None):
+        """Returns a function that iterates over a profile in chunks
+        (optionally only the values below a cutoff)."""
+        def iterate():
+            x = self.data[name]
+            for c0 in range(0, self.width, self.chunkWidth):
+                c = np.asarray(x[c0:c0+self.chunkWidth])
+                c = c[~np.isnan(c)]
+                yield c if below is None else c[c < below]
+        return iterate
+
+    def close(self):
+        """Deletes the temporary file (the data rows become invalid).
+
+        The file is unmapped once no other reference to its rows is left;
+        copy the rows that are still needed (np.array) before closing.
+        """
+        self.data = None
+        self.values = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def tiled_thresholds(profile, heightSD=2):
+    """batch_thresholds for one TiledProfile; returns a dict of scalars."""
+    mom = profile.nf
+    chunks = profile.chunks()
+    # 1. Third quartile of all neurite pixels
+    qTh = percentile(chunks, 75, mom.n, mom.min, mom.max)
+    # 2./3. Stats of the pixels below the third quartile
+    below = profile.chunks(below=qTh)
+    ss = Moments()
+    for c in below():
+        ss.add(c)
+    median = percentile(below, 50, ss.n, mom.min, qTh)
+    stdSS = ss.std()
+    # 4./5. Cutoffs
+    return {'qTh': qTh, 'mean': ss.mean, 'median': median, 'stdSS': stdSS,
+            'n': float(ss.n), 'minHeight': ss.mean+heightSD*stdSS,
+            'prom': mom.std()}
+
+
+def _open_sides(x, peaks):
+    """For each peak, whether no sample left/right of it is higher (the
+    prominence base search runs into the end of x)."""
+    if len(peaks) == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    leftMax = np.maximum.accumulate(x)
+    rightMax = np.maximum.accumulate(x[::-1])[::-1]
+    left = leftMax[peaks-1] <= x[peaks]
+    right = rightMax[np.minimum(peaks+1, len(x)-1)] <= x[peaks]
+    return left, right
+
+
+def tiled_find_peaks(x, height, prominence, width=0, rel_height=0.5,
+                     tile=None, margin=None, largestMargin=None):
+    """find_peaks(x, height=, prominence=, width=, rel_height=) tile by tile.
+
+    x is a 1D (memory-mapped) array that is only read in windows of tile
+    columns plus the margins. height, prominence and width are minimums.
+    tile, margin and largestMargin default to tileWidth, tileMargin and
+    maxMargin. Returns (peaks, widths) like find_peaks' peaks and
+    properties['widths'].
+    """
+    from scipy.signal import find_peaks, peak_prominences, peak_widths
+    if tile is None:
+        tile = tileWidth
+    if margin is None:
+        margin = tileMargin
+    if largestMargin is None:
+        largestMargin = maxMargin
+    L = len(x)
+    allPeaks, allWidths = [], []
+    for s in range(0, L, tile):
+        e = min(s+tile, L)
+        m = margin
+        while True:
+            a, b = max(0, s-m), min(L, e+m)
+            w = np.asarray(x[a:b], dtype=float)
+            cand = find_peaks(w, height=height)[0]
+            cand = cand[(cand+a >= s) & (cand+a < e)]                          # Peaks owned by this tile
+            left, right = _open_sides(w, cand)
+            cut = (left & (a > 0)) | (right & (b < L))                         # Base search was cut off by the window
+            if cut.any() and m < largestMargin and (a > 0 or b < L):
+                m = min(2*m, largestMargin)
+                continue
+            break
+        prom, lb, rb = peak_prominences(w, cand)
+        with np.errstate(invalid='ignore'):
+            keep = prom >= prominence
+        cand, prom, lb, rb = cand[keep], prom[keep], lb[keep], rb[keep]
+        widths = peak_widths(w, cand, rel_height=rel_height,
+                             prominence_data=(prom, lb, rb))[0]
+        if width is not None:
+            keep = widths >= width
+            cand, widths = cand[keep], widths[keep]
+        allPeaks.append(cand+a)
+        allWidths.append(widths)
+    return (np.concatenate(allPeaks).astype(np.intp),
+            np.concatenate(allWidths))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare tiled & full-array '
+                                     'peak finding on a synthetic neurite.')
+    parser.add_argument('--length', type=float, default=2500,
+                        help='neurite length in um')
+    parser.add_argument('--tile-width', type=int, default=tileWidth)
+    parser.add_argument('--margin', type=int, default=tileMargin)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import PACC_PeakFinder as pf
+    from PACC_Synth import synthParams, synth_image
+    from PACC_Telemetry import clocks, elapsed
+    prm = dict(synthParams, lengthUm=(args.length, args.length))
+    img = synth_image(np.random.RandomState(args.seed), prm)[0][:, :, 1]
+    pxN, pxB, dfPixInd = pf.get_pixel_indices(prm['lineWidth'],
+                                              prm['muperpx'])
+    peakParams = pf.peakParams
+    pf.find_peaks(np.zeros(3))                                                 # Import scipy before timing
+
+    start = clocks()
+    prof = batch_profiles([img], pxN, pxB)
+    th = pf.batch_thresholds(prof['nf'], peakParams['heightSD'])
+    peaks = pf.find_peaks(prof['nf'][0], height=th['minHeight'][0],
+                          prominence=th['prom'][0],
+                          width=peakParams['width'],
+                          rel_height=peakParams['relHeight'])
+    tFull = elapsed(start)
+
+    start = clocks()
+    tp = TiledProfile(array_tiles(img, args.tile_width), pxN, pxB,
+                      prm['muperpx'], chunkWidth=args.tile_width)
+    tth = tiled_thresholds(tp, peakParams['heightSD'])
+    tPeaks, tWidths = tiled_find_peaks(tp.data['neurite_intensity'],
+                                       tth['minHeight'], tth['prom'],
+                                       peakParams['width'],
+                                       peakParams['relHeight'],
+                                       args.tile_width, args.margin)
+    tTiled = elapsed(start)
+
+    print("Columns: "+str(img.shape[1])+", tiles of "+str(args.tile_width))
+    for k in ['qTh','mean','median','stdSS','n','minHeight','prom']:
+        print("  %-10s full %.10g  tiled %.10g" % (k, th[k][0], tth[k]))
+    for name, key in [('raw_intensity', 'rawf'), ('avg_norm_neu_int', 'annf'),
+                      ('max_norm_neu_int', 'mnnf'),
+                      ('neurite_intensity', 'nf')]:
+        print("  max |%s difference| %.3g" % (
+            name, np.max(np.abs(np.asarray(tp.data[name])-prof[key][0]))))
+    same = (len(tPeaks) == len(peaks[0]) and
+            (tPeaks == peaks[0]).all())
+    print("Peaks: full "+str(len(peaks[0]))+", tiled "+str(len(tPeaks))+
+          (", identical" if same else ", DIFFERENT"))
+    if same:
+        print("  max |width difference| %.3g px" % (
+            np.max(np.abs(tWidths-peaks[1]['widths'])) if len(tPeaks)
+            else 0))
+    print("Wall time: full %.3f s, tiled %.3f s" % (tFull[0], tTiled[0]))
+    tp.close()
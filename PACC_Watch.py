@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PACC_Watch.py
+
+Streaming analysis of a neurite set while it is being traced. PACC_NeuTrace.ijm
+saves the straightened images of each cell (<image>.C<i>.JN0.tif/.JN1.tif)
+into Images/Cropped/<NS>/ and then updates MetaD.<NS>.csv. Instead of
+running PACC_PeakFinder once tracing is done, watch_neurite_set() polls the
+NS directory and analyzes every image as soon as it has been written, so the
+results are ready when the last neurite has been traced:
+
+    python PACC_Watch.py --ccps /path/to/CCPs/ --prep CCP_127 --ns NS_02.01
+                         [--channel green red] [--poll 2] [--settle 5]
+
+A file counts as written once its size & modification time have not
+changed for settleTime seconds. The images of a cell are analyzed together
+once the files of every requested channel are there (with two channels
+their puncta are colocalized as in PACC_Channels.py). MetaD.IM.csv and
+MetaD.<NS>.csv are read again whenever they change; images that are not
+(yet) in MetaD.IM.csv wait until they are. Files are analyzed once, later
+changes to an analyzed file are ignored.
+
+Results are added to the output as the images are analyzed and flushed after
+every poll (Parquet row groups, by default). The run ends, and the output
+is closed, when:
+    - every row of MetaD.<NS>.csv has ns_processed YES and every image file
+      has been analyzed (the macro saves the metadata after the images),
+    - no new image has appeared for idleTimeout seconds (if set), or
+    - the watch is interrupted with Ctrl-C.
+The run directory, file names, Exclusions sheet (from the final MetaD.<NS>)
+and telemetry are those of PACC_PeakFinder/PACC_Channels.
+"""
+#LIBRARIES
+import os
+import glob
+import time
+import argparse
+
+import PACC_PeakFinder as pf
+from PACC_Channels import (analyzed_pairs, channel_result, channel_tables,
+                           colocDistance, pair_key)
+from PACC_Figures import FigureRenderer
+from PACC_Metadata import image_index, report_text
+from PACC_Output import TeeOutput
+from PACC_Telemetry import Telemetry
+
+# *** POLLING ***
+pollInterval = 2.                                                              # Seconds between scans of the NS directory
+settleTime = 5.                                                                # A file is complete once unchanged for this many seconds
+idleTimeout = None                                                             # Stop after this many seconds without a new image (None = wait for MetaD.NS)
+
+
+def file_signature(path):
+    """Returns the (size, mtime) of a file (None if it does not exist)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class StableFiles(object):
+    """Finds the new files of a directory once they are completely written.
+
+    patterns are glob patterns inside directory. A file is returned by poll()
+    once, after its (size, mtime) has stayed the same and non-empty for
+    settleTime seconds.
+    """
+
+    def __init__(self, directory, patterns, settleTime=settleTime):
+        self.directory = directory
+        self.patterns = list(patterns)
+        self.settleTime = settleTime
+        self.pending = {}                                                      # File -> (signature, time it was first seen)
+        self.done = set()
+
+    def poll(self):
+        """Returns the sorted names of the files that became stable."""
+        now = time.time()
+        stable = []
+        for pattern in self.patterns:
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                x = os.path.basename(path)
+                if x in self.done:
+                    continue
+                sig = file_signature(path)
+                if sig is None:
+                    continue
+                seen = self.pending.get(x)
+                if seen is None or seen[0] != sig:
+                    self.pending[x] = (sig, now)                               # New or still being written
+                elif sig[0] > 0 and now-seen[1] >= self.settleTime:
+                    del self.pending[x]
+                    self.done.add(x)
+                    stable.append(x)
+        return sorted(stable)
+
+    def busy(self):
+        """True while some files are still being written."""
+        return bool(self.pending)
+
+
+class NeuriteSetMetadata(object):
+    """MetaD.IM.csv & MetaD.<NS>.csv, read again whenever either changes."""
+
+    def __init__(self, dirCCPs, prepID, nsID):
+        self.paths = list(pf.metadata_paths(dirCCPs, prepID, nsID))
+        self.dirCCPs = dirCCPs
+        self.prepID = prepID
+        self.nsID = nsID
+        self.signatures = None
+        self.dfMDim = None
+        self.dfMDns = None
+        self.imaging = None                                                    # PACC_Metadata.ImagingMetadata of MetaD.IM
+
+    def poll(self):
+        """Reads the metadata if it changed; returns True if it was read.
+
+        A file that is missing or can't be parsed (e.g. while it is being
+        saved) keeps the last version that was read.
+        """
+        sigs = [file_signature(p) for p in self.paths]
+        if None in sigs or sigs == self.signatures:
+            return False
+        try:
+            dfMDim, dfMDns = pf.load_metadata(self.dirCCPs, self.prepID,
+                                              self.nsID)
+            dfMDns['exclusion_reason']                                         # Columns the analysis needs
+            dfMDns.loc[0, 'line_width']
+            dfMDim.loc[0, 'calibration_um/pix']
+            imaging = image_index(self.paths[0])
+        except Exception:
+            return False
+        self.dfMDim, self.dfMDns, self.imaging = dfMDim, dfMDns, imaging
+        self.signatures = sigs
+        return True
+
+    def loaded(self):
+        return self.dfMDim is not None
+
+    def complete(self):
+        """True once every cell of the NS has been traced (or excluded)."""
+        if self.dfMDns is None or 'ns_processed' not in self.dfMDns:
+            return False
+        done = self.dfMDns['ns_processed'].astype(str).str.strip().str.upper()
+        return bool(len(done)) and bool((done == 'YES').all())
+
+
+def watch_neurite_set(dirCCPs, prepID, nsID, channels=('green',),
+                      pathRes=None, outputFormat='parquet', excelSummary=True,
+                      figureMode='all', figureProcesses=None, cache=None,
+                      rdmeNote=None, batchSize=pf.batchSize,
+                      maxDist=colocDistance, store=None, compactData=None,
+                      pollInterval=pollInterval, settleTime=settleTime,
+                      idleTimeout=idleTimeout):
+    """Analyzes a neurite set image by image while it is being traced.
+
+    Arguments are those of PACC_Channels.analyze_channels plus the polling
+    settings (seconds). With a single channel the output has the sheets of
+    PACC_PeakFinder.analyze_neurite_set. Returns the same kind of run
+    summary.
+    """
+    channels = list(channels)
+    extChannel = dict((pf.CHANNELS[c][1], c) for c in channels)
+    today, now, timestamp = pf.get_timestamp()
+    telemetry = Telemetry()
+    telemetry.start()
+
+    if pathRes is None:
+        pathRes = dirCCPs+prepID+"/Analysis/"+timestamp+'/'
+    pathRes = os.path.join(pathRes, '')
+    if not os.path.isdir(pathRes):
+        os.makedirs(pathRes)
+    fnRes = 'PACC_PFAnalysis.'+prepID+'.'+nsID+'.'+timestamp
+    if rdmeNote is None:
+        rdmeNote = [' & '.join(c.capitalize() for c in channels)+
+                    " channel analysis (watched while tracing)"]
+    pf.write_readme(pathRes, prepID, timestamp, rdmeNote)
+    dirNS = dirCCPs+prepID+"/Images/Cropped/"+nsID+"/"
+
+    # *** WAIT FOR THE NS METADATA ***
+    metadata = NeuriteSetMetadata(dirCCPs, prepID, nsID)
+    with telemetry.stage('prepare'):
+        if not metadata.poll():
+            print("Waiting for "+' & '.join(metadata.paths))
+        while not metadata.loaded():
+            time.sleep(pollInterval)
+            metadata.poll()
+
+    def parameters():
+        params = {}
+        for channel in channels:
+            CH, chExt = pf.CHANNELS[channel]
+            params[channel] = pf.ns_parameters(metadata.dfMDim,
+                                               metadata.dfMDns, prepID, nsID,
+                                               CH, chExt, dirNS, pathRes,
+                                               timestamp)
+        return params
+    params = parameters()
+    nsParamsByCh = dict((c, p[0]) for c, p in params.items())
+
+    if len(channels) == 1:
+        tables = pf.tablesResults
+        summaryTables = ['Analysis']
+    else:
+        tables = channel_tables(channels)
+        summaryTables = [name for name, cols in tables if
+                         name.startswith('Analysis.') or
+                         name == 'Colocalization.Analysis']
+    output = pf.open_output(pathRes, fnRes, outputFormat, excelSummary, tables,
+                            summaryTables, compactData)
+    if store is not None:
+        output = TeeOutput([output, store.open_run(prepID, nsID, channels,
+                                                   timestamp, pathRes)])
+    renderer = FigureRenderer(figureMode, figureProcesses, cache=cache)
+    files = StableFiles(dirNS, ['*.'+pf.CHANNELS[c][1]+'.tif' for c in
+                                channels], settleTime)
+    cells = {}                                                                 # pair_key -> {channel: file} of files not yet analyzed
+    reported = set()                                                           # (image_name, problem) already reported
+
+    def ready_pairs(final):
+        """Returns the cells whose files are all written & in MetaD.IM.
+
+        They stay in cells until run_analysis has handled them (see
+        analyzed), so a cell in flight when the watch is stopped is analyzed
+        by the final pass instead of being lost.
+        """
+        keys = [key for key in sorted(cells) if final or
+                len(cells[key]) == len(channels)]                              # Otherwise the other channel is still to come
+        tasks, report = metadata.imaging.resolve(sorted(cells[key].values())[0]
+                                                 for key in keys)
+        new = [(name, problem) not in reported for name, problem in
+               zip(report['image_name'], report['problem'])]
+        if any(new):
+            reported.update(zip(report['image_name'], report['problem']))
+            print(report_text(report[new], waiting=True))
+        return [(pair_key(x), dict((c, (xc, md)) for c, xc in
+                                   cells[pair_key(x)].items()))
+                for x, md in tasks]
+
+    def analyzed(key):
+        cells.pop(key, None)
+
+    def watched_batches():
+        """Source of analyzed batches for run_analysis: polls the NS
+        directory & metadata and analyzes the cells that are ready, until the
+        NS is complete or idle."""
+        lastNew = time.time()
+        while True:
+            if metadata.poll():
+                telemetry.count('metadata_reads')
+                params.update(parameters())
+                for channel, (nsParams, dfExcl, dfPix) in params.items():
+                    old = nsParamsByCh[channel]
+                    if (old['muperpx'], old['pxTot']) != (nsParams['muperpx'],
+                                                          nsParams['pxTot']):
+                        print("Warning. The calibration or line width of "+
+                              nsID+" changed; new images use the new values")
+                    nsParamsByCh[channel] = nsParams
+            new = files.poll()
+            for x in new:
+                cells.setdefault(pair_key(x), {})[
+                    extChannel[x.rsplit('.', 2)[1]]] = x
+            if new:
+                lastNew = time.time()
+            complete = metadata.complete() and not files.busy()
+            idle = (idleTimeout is not None and
+                    time.time()-lastNew >= idleTimeout)
+            for batch in analyzed_pairs(ready_pairs(complete or idle),
+                                        nsParamsByCh, channels, maxDist,
+                                        cache, telemetry, batchSize):
+                yield batch
+            if complete and not cells:
+                print("All cells of "+nsID+" have been traced")
+                return
+            if idle:
+                print("No new images for "+str(idleTimeout)+" s")
+                return
+            time.sleep(pollInterval)
+
+    # *** WATCH THE NS DIRECTORY ***
+    rename = None if len(channels) == 1 else channel_result
+    print("Watching "+dirNS+" (Ctrl-C to stop)")
+    try:
+        try:
+            pf.run_analysis(watched_batches(), nsParamsByCh, output, renderer,
+                            telemetry, rename, flush=True, verbose=True,
+                            done=analyzed)
+        except KeyboardInterrupt:
+            print("Watch stopped")
+            for x in sorted(files.pending):
+                print("Image file "+x+" was still being written & was not "
+                      "analyzed")
+            pf.run_analysis(analyzed_pairs(ready_pairs(True), nsParamsByCh,
+                                           channels, maxDist, cache,
+                                           telemetry, batchSize),
+                            nsParamsByCh, output, renderer, telemetry, rename,
+                            flush=True, verbose=True, done=analyzed)
+    finally:
+        with telemetry.stage('figures'):
+            renderer.close()
+    if cells:
+        tasks, report = metadata.imaging.resolve(sorted(cells[key].values())[0]
+                                                 for key in sorted(cells))
+        print(report_text(report[report['problem'] == 'missing']))
+    for x, reasons in renderer.flagged:
+        print("Flagged "+x+": "+', '.join(reasons))
+
+    nsParams, dfExclusions, dfPixInd = params[channels[0]]
+    with telemetry.stage('write'):
+        pf.write_results(output, dfExclusions, dfPixInd, today, now,
+                         nsParams['muperpx'], telemetry)
+    telemetry.stop(pathRes, prepID, timestamp)
+    telemetry.write(pathRes, prepID, timestamp)
+    return {'pathRes': pathRes, 'fnRes': fnRes,
+            'images': telemetry.counters['images'],
+            'failed_images': telemetry.counters['failed_images'],
+            'flagged': renderer.flagged, 'telemetry': telemetry}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze a neurite set '
+                                     'while it is being traced.')
+    pf.add_run_arguments(parser, output='parquet')                             # Parquet tables are written as the images are analyzed
+    pf.add_neurite_set_arguments(parser, ['green'])
+    parser.add_argument('--poll', type=float, default=pollInterval,
+                        help='seconds between scans of the NS directory')
+    parser.add_argument('--settle', type=float, default=settleTime,
+                        help='seconds a file must stay unchanged before it '
+                             'is analyzed')
+    parser.add_argument('--idle-timeout', type=float, default=idleTimeout,
+                        help='stop after this many seconds without a new '
+                             'image (default: when MetaD.NS is complete)')
+    args = parser.parse_args()
+
+    dirCCPs, cache, store = pf.open_resources(args)
+    try:
+        run = watch_neurite_set(
+            dirCCPs, args.prep, args.ns, list(dict.fromkeys(args.channel)),
+            args.out_dir, args.output, not args.no_excel_summary,
+            args.figures, args.figure_processes, cache,
+            [args.note] if args.note else None, pf.batchSize,
+            args.coloc_distance, store, not args.full_data, args.poll,
+            args.settle, args.idle_timeout)
+        print("Analyzed "+str(run['images'])+" images into "+run['pathRes'])
+    finally:
+        pf.close_resources(cache, store)
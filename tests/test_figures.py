@@ -0,0 +1,30 @@
+import os
+
+import imageio
+import numpy as np
+
+import PACC_PeakFinder as pf
+from PACC_Figures import FigureRenderer, flag_image
+
+
+def test_flagged_image_with_undefined_threshold_is_drawn(tmp_path):
+    dirNS = str(tmp_path)+'/'
+    x = 'CCP_001_NS_01.01_im00.C0.JN0.tif'
+    imageio.imwrite(dirNS+x, np.zeros((32, 5, 3), dtype=np.uint8))           # Flat image: no signal, no threshold
+    muperpx = .126
+    pxN, pxB, dfPixInd = pf.get_pixel_indices(32, muperpx)
+    nsParams = {'prepID': 'CCP_001', 'nsID': 'NS_01.01', 'CH': 1,
+                'chExt': 'JN0', 'dirNS': dirNS, 'pathRes': dirNS,
+                'timestamp': 'test', 'muperpx': muperpx, 'pxTot': 32,
+                'pxBgndSize': 8, 'pxN': pxN, 'pxB': pxB,
+                'peakParams': dict(pf.peakParams), 'tiledLength': None}
+    md = {'date': '2020-01-01', 'strain': 'N2', 'tiv': 14,
+          'pattern_geom': 'lines', 'surface_proteins': 'PLL'}
+    res = pf.analyze_image(x, md, nsParams)
+    assert 'undefined threshold' in flag_image(res['Analysis'])
+
+    renderer = FigureRenderer('flagged', processes=0)
+    renderer.submit(res, nsParams)
+    assert renderer.close() == 1
+    assert renderer.errors == []
+    assert os.path.isfile(dirNS+x[:-4]+'_pf.png')
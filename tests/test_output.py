@@ -0,0 +1,43 @@
+import numpy as np
+import pandas
+import pytest
+
+from PACC_Output import ExcelOutput
+
+metaCols = ['image_id']
+columns = ['image_id', 'distance', 'neurite_intensity']
+
+
+def image(i, n):
+    return {'meta': {'image_id': 'im%02d' % i},
+            'Data': {'distance': np.arange(n, dtype=float),
+                     'neurite_intensity': np.full(n, float(i))}}
+
+
+@pytest.mark.parametrize('compact', [('Data',), ()])
+def test_oversize_table_continues_on_new_sheets(tmp_path, compact):
+    out = ExcelOutput(str(tmp_path)+'/', 'run', [('Data', columns)],
+                      metaCols, compact, chunkRows=4, sheetRows=10)
+    sizes = [7, 9, 3, 6]                                                      # 25 rows: Data, Data_2 & Data_3
+    for i, n in enumerate(sizes):
+        out.add(image(i, n))
+    out.close([('Parameters', pandas.DataFrame({'a': [1]}))])
+
+    sheets = pandas.read_excel(out.fnRes, sheet_name=None, index_col=0)
+    assert list(sheets) == ['Data', 'Data_2', 'Data_3', 'Parameters']
+    assert [len(sheets[s]) for s in ['Data', 'Data_2', 'Data_3']] == [10, 10, 5]
+    df = pandas.concat([sheets[s] for s in ['Data', 'Data_2', 'Data_3']])
+    assert list(df.columns) == columns
+    assert list(df['image_id']) == ['im%02d' % i for i, n in
+                                    enumerate(sizes) for j in range(n)]
+    assert list(df['distance']) == [float(j) for n in sizes for j in range(n)]
+
+
+def test_table_that_fits_stays_on_one_sheet(tmp_path):
+    out = ExcelOutput(str(tmp_path)+'/', 'run', [('Data', columns)],
+                      metaCols, ('Data',), chunkRows=4, sheetRows=10)
+    out.add(image(0, 10))
+    out.close([])
+    sheets = pandas.read_excel(out.fnRes, sheet_name=None, index_col=0)
+    assert list(sheets) == ['Data']
+    assert len(sheets['Data']) == 10